@@ -0,0 +1,126 @@
+# audio_postprocess.py
+import threading
+from math import gcd
+
+import numpy as np
+
+import config # To access AUDIO_* settings
+
+# --- Audio post-processing ---
+# Runs on every synthesized clip before it is cached and played, all vectorized:
+# 1. trim leading/trailing silence by frame energy (no gaps between segments)
+# 2. loudness normalization with a per-model gain, capped so peaks never clip
+# 3. one resample to the output rate (Discord plays 48 kHz; FFmpeg then passes it through)
+# 4. clipping conversion to int16
+# Runs of a mixed-language message are joined with a short crossfade.
+
+model_gains = {} # model_name -> smoothed linear gain, so each voice settles at the same loudness
+_lock = threading.Lock() # process() runs in executor threads (gains, scipy import)
+_resample_poly = None # scipy.signal.resample_poly, imported on first use (False if scipy is missing)
+
+
+def _db_to_linear(db: float) -> float:
+    return float(10 ** (db / 20))
+
+
+def to_float32(audio: np.ndarray) -> np.ndarray:
+    """Returns samples as float32 in [-1, 1]."""
+    if audio.dtype == np.int16:
+        return audio.astype(np.float32) / 32768.0
+    return audio.astype(np.float32, copy=False)
+
+
+def to_int16(samples: np.ndarray) -> np.ndarray:
+    """Converts float samples to int16, clipping instead of wrapping around."""
+    if samples.dtype == np.int16:
+        return samples
+    return (np.clip(samples, -1.0, 1.0) * 32767.0).astype(np.int16)
+
+
+def trim_silence(samples: np.ndarray, sr: int, threshold_db: float = None, pad_ms: float = 30.0) -> np.ndarray:
+    """Cuts leading/trailing frames quieter than `threshold_db` below the loudest frame."""
+    threshold_db = config.AUDIO_TRIM_DB if threshold_db is None else threshold_db
+    frame = max(1, sr // 100) # 10 ms frames
+    frame_count = len(samples) // frame
+    if frame_count == 0:
+        return samples
+    energy = np.square(samples[:frame_count * frame].reshape(frame_count, frame)).mean(axis=1)
+    peak_energy = energy.max()
+    if peak_energy <= 0.0:
+        return samples # Pure silence (e.g. stub inference): nothing to measure against
+    voiced = np.flatnonzero(energy >= peak_energy * _db_to_linear(threshold_db) ** 2)
+    pad = int(sr * pad_ms / 1000)
+    start = max(0, voiced[0] * frame - pad)
+    end = min(len(samples), (voiced[-1] + 1) * frame + pad)
+    return samples[start:end]
+
+
+def normalize_loudness(samples: np.ndarray, model_name: str = None) -> np.ndarray:
+    """Scales towards AUDIO_TARGET_RMS_DB with a per-model smoothed gain, limited by AUDIO_PEAK_DB."""
+    peak = float(np.abs(samples).max()) if len(samples) else 0.0
+    rms = float(np.sqrt(np.square(samples).mean())) if len(samples) else 0.0
+    if peak <= 0.0 or rms <= 0.0:
+        return samples
+    clip_gain = min(_db_to_linear(config.AUDIO_TARGET_RMS_DB) / rms, _db_to_linear(config.AUDIO_MAX_GAIN_DB))
+    with _lock:
+        previous = model_gains.get(model_name)
+        gain = clip_gain if previous is None else previous + 0.2 * (clip_gain - previous)
+        model_gains[model_name] = gain
+    gain = min(gain, _db_to_linear(config.AUDIO_PEAK_DB) / peak) # Never push peaks past the ceiling
+    return samples * np.float32(gain)
+
+
+def _load_resample_poly():
+    global _resample_poly
+    with _lock:
+        if _resample_poly is None:
+            try:
+                from scipy.signal import resample_poly # Listed in requirements.txt; imported late, it is slow to load
+                _resample_poly = resample_poly
+            except ImportError:
+                print("Warning: scipy is not installed; resampling falls back to linear interpolation (lower quality).")
+                _resample_poly = False
+    return _resample_poly
+
+
+def resample(samples: np.ndarray, sr: int, target_sr: int):
+    """Returns (target_sr, samples) using polyphase filtering (scipy) or linear interpolation."""
+    if not target_sr or sr == target_sr or len(samples) == 0:
+        return sr, samples
+    resample_poly = _load_resample_poly()
+    if resample_poly:
+        divisor = gcd(sr, target_sr)
+        return target_sr, resample_poly(samples, target_sr // divisor, sr // divisor).astype(np.float32)
+    positions = np.arange(int(len(samples) * target_sr / sr)) * (sr / target_sr)
+    return target_sr, np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def process(sr: int, audio: np.ndarray, model_name: str = None):
+    """Full post-processing chain for one synthesized clip. Returns (sample rate, int16 audio)."""
+    if not config.AUDIO_POSTPROCESS:
+        return sr, to_int16(to_float32(audio))
+    samples = trim_silence(to_float32(audio), sr)
+    samples = normalize_loudness(samples, model_name)
+    sr, samples = resample(samples, sr, config.AUDIO_OUTPUT_RATE)
+    return sr, to_int16(samples)
+
+
+def crossfade_concat(parts: list, sr: int, fade_ms: float = None) -> np.ndarray:
+    """Joins int16 clips, overlapping consecutive clips with an equal-power crossfade."""
+    fade_ms = config.AUDIO_CROSSFADE_MS if fade_ms is None else fade_ms
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return np.zeros(0, dtype=np.int16)
+    fade = int(sr * fade_ms / 1000)
+    if fade <= 0 or len(parts) == 1:
+        return np.concatenate(parts)
+
+    ramp = np.linspace(0.0, np.pi / 2, fade, dtype=np.float32)
+    fade_in, fade_out = np.sin(ramp), np.cos(ramp)
+    result = to_float32(parts[0])
+    for part in parts[1:]:
+        samples = to_float32(part)
+        overlap = min(fade, len(result), len(samples))
+        mixed = result[-overlap:] * fade_out[fade - overlap:] + samples[:overlap] * fade_in[:overlap]
+        result = np.concatenate([result[:-overlap], mixed, samples[overlap:]])
+    return to_int16(result)
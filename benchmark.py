@@ -0,0 +1,159 @@
+# benchmark.py
+import argparse
+import asyncio
+import itertools
+import statistics
+import time
+
+import numpy as np
+from style_bert_vits2.constants import Languages
+
+import config
+import tts_setup
+import inference_service
+import tts_processing
+import loop_watchdog
+from loop_watchdog import percentile
+import audio_postprocess
+
+# --- Synthesis latency benchmark ---
+# Measures synthesis latency for every combination of per-user parameters
+# (speed x pitch x style), so the cost of personalization can be compared
+# against the default voice, plus the cost of audio post-processing per clip.
+#
+#   python benchmark.py --speeds 1.0,1.5 --pitches 1.0,1.1 --styles Neutral,Happy
+#   python benchmark.py --transport stub   # Exercise the pipeline without a model
+
+SAMPLE_TEXTS = [
+    "こんにちは",
+    "が入室しました。",
+    "今日はいい天気ですね、散歩に行きましょう。",
+    "www",
+]
+
+
+def _split_list(value: str, cast=str) -> list:
+    return [cast(v) for v in value.split(",") if v.strip()]
+
+
+async def time_synthesis(model_name: str, params: dict, repeat: int) -> list:
+    """Returns per-call latencies (ms) for SAMPLE_TEXTS synthesized `repeat` times."""
+    transport = inference_service.transport
+    await transport.synthesize(SAMPLE_TEXTS[0], Languages.JP, model_name, params) # Warm-up (model load, kernels)
+    latencies = []
+    for _ in range(repeat):
+        for text in SAMPLE_TEXTS:
+            start = time.perf_counter()
+            await transport.synthesize(text, Languages.JP, model_name, params)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+async def time_cache_hits(model_name: str, params: dict, repeat: int) -> list:
+    """Returns per-call latencies (ms) of synthesize_item() when served from the audio cache."""
+    latencies = []
+    for text in SAMPLE_TEXTS:
+        item = {"text": text, "language": Languages.JP, "model_name": model_name, "params": params}
+        await tts_processing.synthesize_item(item) # Fill the cache
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await tts_processing.synthesize_item(item)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def _synthetic_clip(sr: int, seconds: float) -> np.ndarray:
+    """Speech-like test clip: a tone burst with silence before and after."""
+    rng = np.random.default_rng(0)
+    t = np.arange(int(sr * seconds)) / sr
+    voiced = 0.3 * np.sin(2 * np.pi * 180 * t) * (1 + 0.5 * np.sin(2 * np.pi * 3 * t)) + 0.01 * rng.standard_normal(len(t))
+    silence = np.zeros(int(sr * 0.4))
+    return (np.concatenate([silence, voiced, silence]) * 32767).astype(np.int16)
+
+
+def time_postprocess(repeat: int, sr: int = 44100) -> dict:
+    """Returns {stage label: latencies (ms)} for each post-processing stage on synthetic clips."""
+    stages = {}
+    for seconds in (1.0, 5.0):
+        clip = _synthetic_clip(sr, seconds)
+        samples = audio_postprocess.to_float32(clip)
+        runs = {
+            f"trim silence ({seconds:.0f} s clip)": lambda: audio_postprocess.trim_silence(samples, sr),
+            f"normalize ({seconds:.0f} s clip)": lambda: audio_postprocess.normalize_loudness(samples, "benchmark"),
+            f"resample -> {config.AUDIO_OUTPUT_RATE} ({seconds:.0f} s clip)": lambda: audio_postprocess.resample(samples, sr, config.AUDIO_OUTPUT_RATE),
+            f"full chain ({seconds:.0f} s clip)": lambda: audio_postprocess.process(sr, clip, "benchmark"),
+            f"crossfade 3 runs ({seconds:.0f} s clips)": lambda: audio_postprocess.crossfade_concat([clip, clip, clip], sr),
+        }
+        for label, func in runs.items():
+            latencies = []
+            for _ in range(max(repeat, 1) * 5):
+                start = time.perf_counter()
+                func()
+                latencies.append((time.perf_counter() - start) * 1000)
+            stages[label] = latencies
+    return stages
+
+
+def print_row(label: str, latencies: list, baseline_mean: float = None):
+    mean = statistics.mean(latencies)
+    cost = f"{mean - baseline_mean:+9.1f}" if baseline_mean is not None else f"{'(base)':>9}"
+    print(f"{label:<40} {mean:9.1f} {percentile(latencies, 50):9.1f} {percentile(latencies, 95):9.1f} {cost}")
+
+
+async def run_benchmark(args):
+    watchdog = loop_watchdog.start_watchdog(force=args.watchdog)
+    if args.transport == "stub":
+        inference_service.transport = inference_service.StubInferenceTransport(latency=args.stub_latency)
+    else:
+        inference_service.init_transport()
+        if inference_service.transport.uses_local_models:
+            tts_setup.initialize_tts_system()
+    transport = inference_service.transport
+    await transport.refresh_models()
+    if not transport.models:
+        print("No TTS models available; nothing to benchmark.")
+        return
+
+    model_name = args.model or next(iter(transport.models))
+    print(f"Model: {model_name} | texts: {len(SAMPLE_TEXTS)} | repeat: {args.repeat}")
+    print(f"{'speed / pitch / style':<40} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'cost ms':>9}")
+
+    baseline_mean = None
+    combos = itertools.product(
+        _split_list(args.speeds, float), _split_list(args.pitches, float), _split_list(args.styles) or [None]
+    )
+    for speed, pitch, style in combos:
+        user_prefs = {"speed": speed, "pitch": pitch, "style": style}
+        params = tts_processing.build_synthesis_params(user_prefs, model_name)
+        latencies = await time_synthesis(model_name, params, args.repeat)
+        print_row(f"{speed} / {pitch} / {style or '-'}", latencies, baseline_mean)
+        if baseline_mean is None:
+            baseline_mean = statistics.mean(latencies)
+
+    if config.TTS_AUDIO_CACHE_SIZE > 0:
+        print_row("audio cache hit (default params)", await time_cache_hits(model_name, {}, args.repeat), baseline_mean)
+
+    print(f"\n{'post-processing stage':<40} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for label, latencies in time_postprocess(args.repeat).items():
+        print(f"{label:<40} {statistics.mean(latencies):9.2f} {percentile(latencies, 50):9.2f} {percentile(latencies, 95):9.2f}")
+
+    await transport.close()
+    if watchdog is not None: # Synthesis must never block the event loop
+        print()
+        for line in watchdog.summary_lines():
+            print(line)
+        watchdog.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark TTS synthesis latency per parameter combination')
+    parser.add_argument('--transport', choices=['configured', 'stub'], default='configured',
+                        help='"configured" uses INFERENCE_* / SBV2_API_* settings; "stub" fakes inference')
+    parser.add_argument('--model', help='Model name (defaults to the first available model)')
+    parser.add_argument('--speeds', default='1.0,1.5', help='Comma-separated speed multipliers')
+    parser.add_argument('--pitches', default='1.0,1.1', help='Comma-separated pitch scales')
+    parser.add_argument('--styles', default='', help='Comma-separated style names (default: model default)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stub-latency', type=float, default=0.05, help='Seconds per call for --transport stub')
+    parser.add_argument('--watchdog', action='store_true', help='Report event-loop lag and blocking calls (also LOOP_WATCHDOG=true)')
+    asyncio.run(run_benchmark(parser.parse_args()))
@@ -1,12 +1,18 @@
 # bot_commands.py
 import discord
-import csv
+import asyncio
+import io
 from pathlib import Path
 
 import config # For file paths, JSON helpers
-import tts_setup # For models list
-import tts_processing # For to_fullwidth (used in set_dict)
-from style_bert_vits2.nlp.japanese.user_dict import update_dict # Direct import for updating dict
+import inference_service # For models list
+import tts_setup # For locally loaded models (memory diagnostics)
+import shared_weights # For memory diagnostics
+import device_manager # For device placement (memory diagnostics)
+import loop_watchdog # For event-loop health (!get loop)
+import voice_sessions # For lingering connections and intentional disconnects
+import user_dictionary # Indexed dictionary (search, bulk import/export)
+import tts_processing # For to_fullwidth and cache invalidation (used in set_dict)
 
 
 async def handle_join_command(message: discord.Message):
@@ -31,6 +37,7 @@ async def handle_join_command(message: discord.Message):
         return
 
     if message.guild.voice_client and message.guild.voice_client.is_connected():
+        voice_sessions.cancel_disconnect(message.guild.id) # Keep a lingering connection
         if message.guild.voice_client.channel == channel:
             await message.channel.send(f"既にボイスチャンネル `{channel.name}` に参加しています。")
         else:
@@ -38,7 +45,7 @@ async def handle_join_command(message: discord.Message):
             await message.channel.send(f"ボイスチャンネル `{channel.name}` に移動しました。")
     else:
         try:
-            await channel.connect()
+            await voice_sessions.connect(channel)
             await message.channel.send(f"ボイスチャンネル `{channel.name}` に参加しました。")
         except discord.ClientException as e:
             await message.channel.send(f"ボイスチャンネルへの参加に失敗しました: {e}")
@@ -60,7 +67,7 @@ async def handle_leave_command(message: discord.Message):
         server_info
     )
     if message.guild.voice_client and message.guild.voice_client.is_connected():
-        await message.guild.voice_client.disconnect()
+        await voice_sessions.disconnect(message.guild) # Intentional: no automatic reconnect
         await message.channel.send("ボイスチャンネルから退出しました。")
     else:
         await message.channel.send("ボイスチャンネルに参加していません。")
@@ -75,35 +82,34 @@ async def _set_user_preference(user_id: str, key: str, value):
     config.save_json_file(config.USER_INFO_JSON_PATH, user_info)
 
 
+async def _compile_dictionary():
+    """Applies the edited dictionary CSV wherever inference runs and drops cached readings."""
+    # In this process (local transport) or on every inference server (http transport)
+    await inference_service.transport.reload_dictionary()
+    tts_processing.clear_text_caches() # Cached clips in this process predate the change
+
+
+async def _add_dictionary_entries(entries: list):
+    """Runs user_dictionary.add_entries off the event loop (it rewrites the whole CSV)."""
+    return await asyncio.get_running_loop().run_in_executor(None, user_dictionary.add_entries, entries)
+
+
 async def handle_set_dict_command(message: discord.Message, key: str, value: str):
     """Handles !set dict <key> <value>."""
     if not key or not value:
         await message.channel.send(";キーとバリューを両方指定してください。(例: !set dict 単語 ヨミ)")
         return
 
-    if not all('\u30A0' <= char <= '\u30FF' for char in value): # Value must be Katakana
-        await message.channel.send(";バリューは全角カタカナで入力してください。")
+    key_fw = tts_processing.to_fullwidth(key.strip())
+    value = value.strip()
+    error = user_dictionary.validate_entry(key_fw, value) # Same rules as !import dict
+    if error:
+        await message.channel.send(f";{error}。")
         return
-        
-    key_fw = tts_processing.to_fullwidth(key)
+
     try:
-        # Ensure the CSV file exists and is writable
-        dict_p = config.DICT_CSV_PATH
-        dict_p.parent.mkdir(parents=True, exist_ok=True)
-
-        with open(dict_p, 'a', encoding='utf-8', newline='') as f:
-            writer = csv.writer(f)
-            # surface,left_id,right_id,cost,pos1,pos2,pos3,pos4,pos5,pos6,surface_form,yomi,pron,accent_type,mora_len
-            # This structure matches common user dictionary formats for pyopenjtalk.
-            writer.writerow([
-                key_fw, '', '', '8609', '名詞', '固有名詞', '一般', '*', '*', '*',
-                key_fw, value, value, '0/0', '*' # Default accent, mora length can be auto
-            ])
-        
-        update_dict(
-            default_dict_path=dict_p,
-            compiled_dict_path=config.COMPILED_DICT_PATH
-        )
+        await _add_dictionary_entries([(key_fw, value)]) # Same word again updates its reading
+        await _compile_dictionary()
         await message.channel.send(f";辞書に `{key_fw}`: `{value}` を追加しました。")
     except Exception as e:
         await message.channel.send(f";辞書への追加中にエラーが発生しました: {e}")
@@ -116,7 +122,7 @@ async def handle_set_voice_command(message: discord.Message, model_name_to_set:
         await message.channel.send(";`!set voice` コマンドにはモデル名が必要です。")
         return
 
-    available_models = tts_setup.get_available_model_names()
+    available_models = inference_service.get_available_model_names()
     if model_name_to_set in available_models:
         await _set_user_preference(str(message.author.id), "model", model_name_to_set)
         await message.channel.send(f";あなたのボイスモデルを `{model_name_to_set}` に設定しました。")
@@ -155,6 +161,104 @@ async def handle_set_nickname_command(message: discord.Message, nickname_to_set:
     await message.channel.send(f";あなたの名前の読み上げ設定を `{nickname_to_set}` に設定しました。")
 
 
+def _current_model_name(user_id: str):
+    """The user's model, or the default one TTS submission falls back to."""
+    model_name = config.load_json_file(config.USER_INFO_JSON_PATH, {}).get(user_id, {}).get("model")
+    available_models = inference_service.transport.models
+    if model_name not in available_models and available_models:
+        model_name = next(iter(available_models))
+    return model_name
+
+
+def _parse_float_in_range(value_str: str, value_range: tuple):
+    """Parses a float and checks it against (min, max). Returns None if invalid."""
+    try:
+        value = float(value_str)
+    except (TypeError, ValueError):
+        return None
+    if not value_range[0] <= value <= value_range[1]:
+        return None
+    return value
+
+
+async def handle_set_speed_command(message: discord.Message, speed_str: str):
+    """Handles !set speed <float>."""
+    low, high = tts_processing.SPEED_RANGE
+    speed = _parse_float_in_range(speed_str, tts_processing.SPEED_RANGE)
+    if speed is None:
+        await message.channel.send(f";`!set speed` コマンドには {low} から {high} までの数値を指定してください。(例: !set speed 1.2)")
+        return
+
+    await _set_user_preference(str(message.author.id), "speed", speed)
+    await message.channel.send(f";あなたの読み上げ速度を `{speed}` に設定しました。")
+
+
+async def handle_set_pitch_command(message: discord.Message, pitch_str: str):
+    """Handles !set pitch <float>."""
+    if not inference_service.supports_param("pitch_scale"):
+        await message.channel.send(";現在の音声合成サーバーは声の高さの変更に対応していません。")
+        return
+    low, high = tts_processing.PITCH_RANGE
+    pitch = _parse_float_in_range(pitch_str, tts_processing.PITCH_RANGE)
+    if pitch is None:
+        await message.channel.send(f";`!set pitch` コマンドには {low} から {high} までの数値を指定してください。(例: !set pitch 1.05)")
+        return
+
+    await _set_user_preference(str(message.author.id), "pitch", pitch)
+    await message.channel.send(f";あなたの声の高さを `{pitch}` に設定しました。")
+
+
+async def handle_set_style_command(message: discord.Message, style_name: str, weight_str: str):
+    """Handles !set style <style_name> [weight]."""
+    if not style_name:
+        await message.channel.send(";`!set style` コマンドにはスタイル名が必要です。(例: !set style Happy 5)")
+        return
+
+    user_id = str(message.author.id)
+    model_name = _current_model_name(user_id)
+    model_styles = inference_service.transport.models.get(model_name, {}).get("styles")
+    if model_styles and style_name not in model_styles:
+        await message.channel.send(
+            f";モデル `{model_name}` にスタイル `{style_name}` はありません。利用可能なスタイル:\n" +
+            "\n".join([f";  `{st}`" for st in model_styles])
+        )
+        return
+
+    style_weight = None
+    if weight_str:
+        low, high = tts_processing.STYLE_WEIGHT_RANGE
+        style_weight = _parse_float_in_range(weight_str, tts_processing.STYLE_WEIGHT_RANGE)
+        if style_weight is None:
+            await message.channel.send(f";スタイルの強さには {low} から {high} までの数値を指定してください。")
+            return
+
+    await _set_user_preference(user_id, "style", style_name)
+    await _set_user_preference(user_id, "style_weight", style_weight)
+    weight_note = f" (強さ `{style_weight}`)" if style_weight is not None else ""
+    await message.channel.send(f";あなたの音声スタイルを `{style_name}`{weight_note} に設定しました。")
+
+
+async def handle_set_speaker_command(message: discord.Message, speaker_id_str: str):
+    """Handles !set speaker <id>."""
+    if not speaker_id_str or not speaker_id_str.isdigit():
+        await message.channel.send(";`!set speaker` コマンドには話者ID (0以上の整数) を指定してください。")
+        return
+
+    user_id = str(message.author.id)
+    speaker_id = int(speaker_id_str)
+    model_name = _current_model_name(user_id)
+    speakers = inference_service.transport.models.get(model_name, {}).get("speakers")
+    if speakers and speaker_id not in speakers.values():
+        await message.channel.send(
+            f";モデル `{model_name}` に話者ID `{speaker_id}` はありません。利用可能な話者:\n" +
+            "\n".join([f";  `{sid}`: {name}" for name, sid in sorted(speakers.items(), key=lambda kv: kv[1])])
+        )
+        return
+
+    await _set_user_preference(user_id, "speaker_id", speaker_id)
+    await message.channel.send(f";あなたの話者IDを `{speaker_id}` に設定しました。")
+
+
 async def handle_set_talk_command(message: discord.Message, talk_setting_str: str):
     """Handles !set talking <true|false>."""
     if not talk_setting_str:
@@ -180,38 +284,76 @@ async def handle_set_talk_command(message: discord.Message, talk_setting_str: st
     await message.channel.send(f";発話設定を `{talk_setting_lower}` に設定しました。")
 
 
-async def handle_get_dict_command(message: discord.Message):
-    """Handles !get dict."""
-    current_dictionary = {}
+DICT_PAGE_SIZE = 20
+
+async def handle_get_dict_command(message: discord.Message, args: list):
+    """Handles !get dict [prefix] [page]."""
+    page = 1
+    if args and args[-1].isdigit():
+        page = int(args.pop())
+    prefix = args[0] if args else ""
+
+    entries, total, page_count = user_dictionary.search(prefix, page, DICT_PAGE_SIZE)
+    if total == 0:
+        await message.channel.send(f";`{prefix}` で始まる単語は辞書にありません。" if prefix else ";辞書は空です。")
+        return
+
+    page = min(max(1, page), page_count)
+    first = (page - 1) * DICT_PAGE_SIZE + 1
+    header = f";辞書{f' (`{prefix}`～)' if prefix else ''}: {first}-{first + len(entries) - 1} / {total}件 (ページ {page}/{page_count})"
+    dict_output_lines = [header] + [f";  `{k}`: `{v}`" for k, v in entries]
+    if page < page_count:
+        dict_output_lines.append(f";次のページ: `!get dict {prefix + ' ' if prefix else ''}{page + 1}`")
+    await message.channel.send("\n".join(dict_output_lines)[:2000]) # Discord message limit
+
+
+async def handle_import_dict_command(message: discord.Message):
+    """Handles !import dict (with an attached .csv or .json file)."""
+    if not message.attachments:
+        await message.channel.send(";CSV または JSON ファイルを添付してください。(例: `単語,ヨミ` の行、または {\"単語\": \"ヨミ\"})")
+        return
+    attachment = message.attachments[0]
+    if attachment.size > config.DICT_IMPORT_MAX_BYTES:
+        await message.channel.send(f";ファイルが大きすぎます。({config.DICT_IMPORT_MAX_BYTES // 1024}KB まで)")
+        return
+
     try:
-        with open(config.DICT_CSV_PATH, 'r', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if len(row) >= 12: # surface (idx 0) and yomi (idx 11)
-                    current_dictionary[row[0]] = row[11]
-    except FileNotFoundError:
-        await message.channel.send(";辞書ファイルが見つかりません。")
+        data = await attachment.read()
+        entries, errors = await asyncio.get_running_loop().run_in_executor(
+            None, user_dictionary.parse_import, data, attachment.filename
+        )
+    except (UnicodeDecodeError, ValueError, TypeError) as e: # json.JSONDecodeError is a ValueError
+        await message.channel.send(f";ファイルを読み込めませんでした: {e}")
         return
+
+    try:
+        added, updated = await _add_dictionary_entries(entries)
+        if added or updated:
+            await _compile_dictionary() # Once for the whole file
     except Exception as e:
-        await message.channel.send(f";辞書の読み込み中にエラーが発生しました: {e}")
+        await message.channel.send(f";辞書の一括登録中にエラーが発生しました: {e}")
+        print(f"Error importing dictionary: {e}")
         return
 
-    if not current_dictionary:
-        await message.channel.send(";辞書は空です。")
-        return
+    report_lines = [f";辞書に {added} 件追加、{updated} 件更新しました。(変更なし {len(entries) - added - updated} 件、エラー {len(errors)} 件)"]
+    report_lines += [f";  {line}" for line in errors[:10]]
+    if len(errors) > 10:
+        report_lines.append(f";  ...ほか {len(errors) - 10} 件")
+    await message.channel.send("\n".join(report_lines)[:2000])
 
-    dict_output_lines = [";現在の辞書内容:"]
-    for k, v in current_dictionary.items():
-        dict_output_lines.append(f";  `{k}`: `{v}`")
-    
-    response = ""
-    for line in dict_output_lines:
-        if len(response) + len(line) + 1 > 2000: # Discord message limit
-            await message.channel.send(response)
-            response = ""
-        response += line + "\n"
-    if response:
-            await message.channel.send(response)
+
+async def handle_export_dict_command(message: discord.Message, fmt: str):
+    """Handles !export dict [csv|json]."""
+    fmt = (fmt or "csv").lower()
+    if fmt not in ("csv", "json"):
+        await message.channel.send(";形式は `csv` か `json` を指定してください。")
+        return
+    _, total, _ = user_dictionary.search()
+    data = await asyncio.get_running_loop().run_in_executor(None, user_dictionary.export_bytes, fmt)
+    await message.channel.send(
+        f";辞書をエクスポートしました。({total}件)",
+        file=discord.File(io.BytesIO(data), filename=f"user_dict.{fmt}")
+    )
 
 
 async def handle_get_nickname_command(message: discord.Message):
@@ -225,7 +367,7 @@ async def handle_get_nickname_command(message: discord.Message):
 
 async def handle_get_voice_command(message: discord.Message):
     """Handles !get voice."""
-    available_models = tts_setup.get_available_model_names()
+    available_models = inference_service.get_available_model_names()
     if available_models:
         voice_output = ";利用可能なボイスモデル:\n" + "\n".join(
             [f";  `{m}`" for m in available_models]
@@ -235,6 +377,33 @@ async def handle_get_voice_command(message: discord.Message):
         await message.channel.send(";現在利用可能なボイスモデルはありません。")
 
 
+async def handle_get_memory_command(message: discord.Message):
+    """Handles !get memory."""
+    if not tts_setup.models:
+        await message.channel.send(";このプロセスにはボイスモデルが読み込まれていません。(推論サーバー側で確認してください)")
+        return
+
+    report_lines = [";メモリ使用状況:"] + [f";  {line}" for line in shared_weights.memory_report(tts_setup.models)]
+    report_lines += [";デバイス配置:"] + [f";  {line}" for line in device_manager.summary_lines()]
+    response = ""
+    for line in report_lines:
+        if len(response) + len(line) + 1 > 2000: # Discord message limit
+            await message.channel.send(response)
+            response = ""
+        response += line + "\n"
+    if response:
+        await message.channel.send(response)
+
+
+async def handle_get_loop_command(message: discord.Message):
+    """Handles !get loop."""
+    if loop_watchdog.watchdog is None:
+        await message.channel.send(";イベントループの監視は無効です。(LOOP_WATCHDOG=true で有効になります)")
+        return
+    report_lines = [";イベントループの状態:"] + [f";  {line}" for line in loop_watchdog.watchdog.summary_lines()]
+    await message.channel.send("\n".join(report_lines)[:2000]) # Discord message limit
+
+
 async def process_command(message: discord.Message, command_string: str):
     """Main dispatcher for all bot commands."""
     parts = command_string.split(maxsplit=1)
@@ -248,7 +417,7 @@ async def process_command(message: discord.Message, command_string: str):
     elif command_name == 'set':
         set_parts = args_str.split(maxsplit=2)
         if len(set_parts) < 1:
-            await message.channel.send(";`!set` コマンドにはターゲットを指定してください (dict, voice, call, nickname, talking)。")
+            await message.channel.send(";`!set` コマンドにはターゲットを指定してください (dict, voice, call, nickname, talking, speed, pitch, style, speaker)。")
             return
         target = set_parts[0].lower()
         key = set_parts[1] if len(set_parts) > 1 else ""
@@ -264,23 +433,46 @@ async def process_command(message: discord.Message, command_string: str):
             await handle_set_nickname_command(message, key) # key is nickname
         elif target == 'talking':
             await handle_set_talk_command(message, key) # key is 'true'/'false'
+        elif target == 'speed':
+            await handle_set_speed_command(message, key) # key is speed multiplier
+        elif target == 'pitch':
+            await handle_set_pitch_command(message, key) # key is pitch scale
+        elif target == 'style':
+            await handle_set_style_command(message, key, value) # key is style name, value is optional weight
+        elif target == 'speaker':
+            await handle_set_speaker_command(message, key) # key is speaker id
         else:
             await message.channel.send(f";不明な設定ターゲット `{target}` です。")
             
     elif command_name == 'get':
-        get_parts = args_str.split(maxsplit=0) # No args needed after 'get <target>'
-        if not args_str or not get_parts : # target is args_str itself
+        get_parts = args_str.split()
+        if not get_parts:
              await message.channel.send(";`!get` コマンドにはターゲットを指定してください (dict, voice)。")
              return
-        target = args_str.lower() # The first word after 'get' is the target
+        target = get_parts[0].lower() # The first word after 'get' is the target
 
         if target == 'dict':
-            await handle_get_dict_command(message)
+            await handle_get_dict_command(message, get_parts[1:]) # Optional prefix and page
         elif target == 'voice':
             await handle_get_voice_command(message)
         elif target == 'nickname':
             await handle_get_nickname_command(message)
+        elif target == 'memory':
+            await handle_get_memory_command(message)
+        elif target == 'loop':
+            await handle_get_loop_command(message)
         else:
             await message.channel.send(f";不明な取得ターゲット `{target}` です。")
+    elif command_name == 'import':
+        if args_str.strip().lower() == 'dict':
+            await handle_import_dict_command(message)
+        else:
+            await message.channel.send(";`!import dict` にファイルを添付して実行してください。")
+    elif command_name == 'export':
+        export_parts = args_str.split()
+        if export_parts and export_parts[0].lower() == 'dict':
+            await handle_export_dict_command(message, export_parts[1] if len(export_parts) > 1 else "csv")
+        else:
+            await message.channel.send(";`!export dict [csv|json]` の形式で実行してください。")
     else:
         await message.channel.send(f";不明なコマンド `{command_name}` です。")
\ No newline at end of file
@@ -2,8 +2,6 @@
 import os
 from pathlib import Path
 from dotenv import load_dotenv
-import nltk
-from style_bert_vits2.nlp.japanese.user_dict import update_dict
 import json
 
 load_dotenv()
@@ -23,23 +21,133 @@ SERVER_INFO_JSON_PATH = os.getenv(
 DICT_CSV_PATH = Path(
     os.getenv("DICT_CSV", str(ROOT_DIR / "dict_data/default.csv")))
 COMPILED_DICT_PATH = ROOT_DIR / "dict_data/user.dic"
+# Prebuilt startup snapshot (parsed model configs, tokenizers). Set STARTUP_CACHE= (empty) to disable.
+STARTUP_CACHE_DIR = os.getenv("STARTUP_CACHE", str(ROOT_DIR / ".startup_cache"))
+# Memory-map .safetensors weights (CPU models) so processes on one host share them
+TTS_WEIGHTS_MMAP = os.getenv("TTS_WEIGHTS_MMAP", "false").lower() == "true"
 
 # --- Discord Settings ---
 VC_TEXT_CHANNEL_NAME = os.getenv('VC_TEXT_CHANNEL', 'vc-text')
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 AUTO_JOIN_VC_NAME = os.getenv("AUTO_JOIN_VOICE_CHANNEL_NAME")
 
+# --- TTS Queue Persistence ---
+# Path to an SQLite database for pending TTS jobs. Unset disables persistence.
+TTS_QUEUE_DB_PATH = os.getenv("TTS_QUEUE_DB")
+TTS_QUEUE_JOB_TTL = float(os.getenv("TTS_QUEUE_JOB_TTL", "300")) # Seconds before a pending job is dropped
+
+# --- Sharding ---
+# Set BOT_SHARDED=true to run the gateway with AutoShardedBot. To split shards across
+# processes, give each process the same SHARD_COUNT and its own SHARD_IDS (e.g. "0,1").
+BOT_SHARDED = os.getenv("BOT_SHARDED", "false").lower() == "true"
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_IDS = [int(i) for i in os.getenv("SHARD_IDS", "").split(",") if i.strip()] or None
+if SHARD_IDS is not None and SHARD_COUNT is None:
+    # discord.py rejects shard_ids without shard_count
+    raise ValueError("SHARD_IDS requires SHARD_COUNT (the total number of shards across all processes).")
+if SHARD_IDS is not None and any(not 0 <= i < SHARD_COUNT for i in SHARD_IDS):
+    raise ValueError(f"SHARD_IDS must be between 0 and SHARD_COUNT - 1 ({SHARD_COUNT - 1}).")
+
+# --- Inference Service ---
+# INFERENCE_TRANSPORT: "local" (in-process), "http" (inference servers), "sbv2_http"
+# (Style-Bert-VITS2's FastAPI server) or "stub" (tests). Defaults to "http" when
+# INFERENCE_SERVER_URLS is set, "sbv2_http" when TTS_BACKEND=sbv2_http, otherwise "local".
+INFERENCE_TRANSPORT = os.getenv("INFERENCE_TRANSPORT", "").lower()
+INFERENCE_SERVER_URLS = [u.strip() for u in os.getenv("INFERENCE_SERVER_URLS", "").split(",") if u.strip()]
+INFERENCE_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", "60"))
+INFERENCE_SERVER_HOST = os.getenv("INFERENCE_SERVER_HOST", "127.0.0.1")
+INFERENCE_SERVER_PORT = int(os.getenv("INFERENCE_SERVER_PORT", "8765"))
+# Shared secret for the inference servers' admin endpoints (POST /dictionary/reload).
+# Shards send it after every dictionary edit; servers without it refuse reloads.
+# The servers read DICT_CSV_PATH themselves, so they must share dict_data/ with the shards.
+INFERENCE_SERVER_TOKEN = os.getenv("INFERENCE_SERVER_TOKEN", "")
+
+# --- Synthesis Cache ---
+# Number of synthesized clips kept in memory (names, join/leave phrases, repeated stamps). 0 disables it.
+TTS_AUDIO_CACHE_SIZE = int(os.getenv("TTS_AUDIO_CACHE_SIZE", "128"))
+TTS_AUDIO_CACHE_MAX_TEXT = int(os.getenv("TTS_AUDIO_CACHE_MAX_TEXT", "50")) # Longer texts are not cached
+G2P_CACHE_SIZE = int(os.getenv("G2P_CACHE_SIZE", "2048")) # Memoized text -> phoneme/tone results (0 disables)
+
+# --- Audio Post-processing ---
+# Silence trimming, per-model loudness normalization and resampling (see audio_postprocess.py)
+AUDIO_POSTPROCESS = os.getenv("AUDIO_POSTPROCESS", "true").lower() == "true"
+AUDIO_OUTPUT_RATE = int(os.getenv("AUDIO_OUTPUT_RATE", "48000")) # Discord's rate; 0 keeps the model's rate
+AUDIO_TRIM_DB = float(os.getenv("AUDIO_TRIM_DB", "-40")) # Frames this far below the loudest one count as silence
+AUDIO_TARGET_RMS_DB = float(os.getenv("AUDIO_TARGET_RMS_DB", "-20"))
+AUDIO_PEAK_DB = float(os.getenv("AUDIO_PEAK_DB", "-1"))
+AUDIO_MAX_GAIN_DB = float(os.getenv("AUDIO_MAX_GAIN_DB", "12"))
+AUDIO_CROSSFADE_MS = float(os.getenv("AUDIO_CROSSFADE_MS", "15")) # Between language runs of one message
+
+# --- Load Control ---
+# Degrade quality (shorter messages, no name readout, faster speech, lighter model)
+# when the TTS backlog or inference latency grows. See load_controller.py.
+LOAD_CONTROL = os.getenv("LOAD_CONTROL", "false").lower() == "true"
+LOAD_DEGRADED_QUEUE = int(os.getenv("LOAD_DEGRADED_QUEUE", "20")) # Queued items across all guilds
+LOAD_CRITICAL_QUEUE = int(os.getenv("LOAD_CRITICAL_QUEUE", "60"))
+LOAD_DEGRADED_RTF = float(os.getenv("LOAD_DEGRADED_RTF", "0.5")) # Inference seconds per second of audio (moving average)
+LOAD_CRITICAL_RTF = float(os.getenv("LOAD_CRITICAL_RTF", "1.0")) # Slower than real time: playback can't keep up
+LOAD_RTF_HALF_LIFE = float(os.getenv("LOAD_RTF_HALF_LIFE", "20")) # Seconds for the average to halve without new inferences
+LOAD_RECOVERY_RATIO = float(os.getenv("LOAD_RECOVERY_RATIO", "0.6")) # Step down once below this fraction of a threshold...
+LOAD_RECOVERY_SECONDS = float(os.getenv("LOAD_RECOVERY_SECONDS", "15")) # ...for this long
+LOAD_LIGHT_MODEL = os.getenv("LOAD_LIGHT_MODEL") or None # Model used in critical mode (optional)
+
+# --- TTS Queue Priorities ---
+# Announcements go before chat; chat waiting longer than the aging time is promoted,
+# and chat older than the stale time is skipped (0 = never skip). See tts_priority_queue.py.
+TTS_QUEUE_AGING_SECONDS = float(os.getenv("TTS_QUEUE_AGING_SECONDS", "20"))
+TTS_CHAT_STALE_SECONDS = float(os.getenv("TTS_CHAT_STALE_SECONDS", "120"))
+
+# --- Event-Loop Watchdog ---
+# Samples loop lag and logs the stack of any callback blocking the loop longer than the threshold.
+LOOP_WATCHDOG = os.getenv("LOOP_WATCHDOG", "false").lower() == "true"
+LOOP_WATCHDOG_THRESHOLD_MS = float(os.getenv("LOOP_WATCHDOG_THRESHOLD_MS", "250"))
+LOOP_WATCHDOG_INTERVAL_MS = float(os.getenv("LOOP_WATCHDOG_INTERVAL_MS", "100"))
+
+# --- Voice Sessions ---
+VOICE_LINGER_SECONDS = float(os.getenv("VOICE_LINGER_SECONDS", "30")) # Stay connected after the last listener leaves (0 = leave at once)
+VOICE_RECONNECT_ATTEMPTS = int(os.getenv("VOICE_RECONNECT_ATTEMPTS", "3")) # Retries of a failed voice handshake (0 = never)
+VOICE_RECONNECT_WAIT_SECONDS = float(os.getenv("VOICE_RECONNECT_WAIT_SECONDS", "10")) # Playback waits this long for discord.py to resume; then the session is rebuilt
+
+# --- Dictionary Import ---
+DICT_IMPORT_MAX_BYTES = int(os.getenv("DICT_IMPORT_MAX_BYTES", str(2 * 1024 * 1024))) # Largest file accepted by !import dict
+
+# --- Style-Bert-VITS2 API Server ---
+# Used by INFERENCE_TRANSPORT=sbv2_http. TTS_BACKEND=sbv2_http is still accepted for it.
+TTS_BACKEND = os.getenv("TTS_BACKEND", "inprocess").lower()
+SBV2_API_URL = os.getenv("SBV2_API_URL", "http://127.0.0.1:5000")
+SBV2_API_URLS = [u.strip() for u in SBV2_API_URL.split(",") if u.strip()] # Comma-separated for failover
+SBV2_API_TIMEOUT = float(os.getenv("SBV2_API_TIMEOUT", "60"))
+SBV2_API_MAX_INFLIGHT = int(os.getenv("SBV2_API_MAX_INFLIGHT", "4")) # Concurrent (pipelined) requests
+
+# --- Devices ---
+# TTS_BERT_DEVICE / TTS_VITS_DEVICE: "auto" (GPU with the most budget left, else CPU), "cpu", "cuda" or "cuda:N".
+TTS_BERT_DEVICE = os.getenv("TTS_BERT_DEVICE", "auto").lower()
+TTS_VITS_DEVICE = os.getenv("TTS_VITS_DEVICE", "auto").lower()
+DEVICE_MEMORY_FRACTION = float(os.getenv("DEVICE_MEMORY_FRACTION", "0.9")) # Share of each device models may be planned into
+DEVICE_MODEL_OVERHEAD = float(os.getenv("DEVICE_MODEL_OVERHEAD", "1.5")) # Planned bytes per checkpoint byte (activations, workspace)
+DEVICE_CACHE_PRESSURE = float(os.getenv("DEVICE_CACHE_PRESSURE", "0.85")) # Empty the CUDA cache once cached blocks fill this share of the memory not held by tensors
+# Simulated GPUs for testing placement on CPU-only machines, e.g. "cuda:0=8192,cuda:1=4096" (MB). Inference still runs on the CPU.
+TTS_SIMULATED_DEVICES = os.getenv("TTS_SIMULATED_DEVICES", "")
+
 # --- NLTK ---
-try:
-    nltk.data.find('taggers/averaged_perceptron_tagger_eng')
-except LookupError:
-    print("Downloading NLTK's averaged_perceptron_tagger_eng...")
-    nltk.download('averaged_perceptron_tagger_eng')
+# Imported lazily: only English g2p needs the tagger, and looking it up (or
+# downloading it) shouldn't delay importing config.
+
+
+def ensure_nltk_tagger():
+    import nltk
+    try:
+        nltk.data.find('taggers/averaged_perceptron_tagger_eng')
+    except LookupError:
+        print("Downloading NLTK's averaged_perceptron_tagger_eng...")
+        nltk.download('averaged_perceptron_tagger_eng')
 
 # --- JTalk Dictionary Update ---
 
 
 def initialize_jtalk_dictionary():
+    from style_bert_vits2.nlp.japanese.user_dict import update_dict
+
     os.makedirs(DICT_CSV_PATH.parent, exist_ok=True)
     if not DICT_CSV_PATH.exists():
         print(
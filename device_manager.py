@@ -0,0 +1,309 @@
+# device_manager.py
+import argparse
+import json
+import os
+import threading
+from pathlib import Path
+
+import config # To access TTS_*_DEVICE and DEVICE_* settings
+
+# --- Device placement ---
+# Models are placed on devices by memory budget instead of one global device:
+# - TTS_BERT_DEVICE / TTS_VITS_DEVICE pick a device ("cpu", "cuda", "cuda:N") or "auto".
+# - "auto" (and a pinned device that is missing or full) takes the GPU with the most
+#   budget left that still fits the model, and falls back to CPU.
+# - Budgets are planned bytes, not live readings: DEVICE_MEMORY_FRACTION of each device
+#   (capped by the memory free at discovery) minus the models already placed on it.
+# - TTS_SIMULATED_DEVICES declares GPUs that don't exist (e.g. "cuda:0=8192,cuda:1=4096",
+#   in MB), so placement and the cache policy can be exercised on CPU-only machines.
+#   Models placed on a simulated device still run on the CPU; the device counts its
+#   planned models as allocated and grows its cache by SIMULATED_CACHE_GROWTH per inference.
+# After inference, the CUDA caching allocator is only emptied under memory pressure
+# (cached blocks, i.e. reserved - allocated, above DEVICE_CACHE_PRESSURE of the memory
+# not held by tensors) or after an out-of-memory error, so the allocator can reuse its
+# blocks between calls. Resident weights never count as pressure.
+
+SIMULATED_CACHE_GROWTH = 256 * 2**20 # Cached blocks a simulated inference leaves behind
+
+
+class Device:
+    """A device descriptor with a planning budget."""
+
+    def __init__(self, name: str, total_bytes: int, free_bytes: int = None, simulated: bool = False):
+        self.name = name # "cpu", "cuda:0", ...
+        self.total_bytes = total_bytes
+        self.simulated = simulated
+        usable = int(total_bytes * config.DEVICE_MEMORY_FRACTION)
+        self.budget_bytes = usable if free_bytes is None else min(usable, free_bytes)
+        self.planned = {} # label -> planned bytes
+        self.simulated_cached = 0 # Allocator cache of simulated GPUs (reserved - allocated)
+        self.cache_empties = 0
+
+    @property
+    def is_gpu(self) -> bool:
+        return self.name.startswith("cuda")
+
+    @property
+    def torch_device(self) -> str:
+        """Device string handed to torch (simulated GPUs run on the CPU)."""
+        return "cpu" if self.simulated else self.name
+
+    @property
+    def remaining_bytes(self) -> int:
+        return self.budget_bytes - sum(self.planned.values())
+
+    def fits(self, required_bytes: int) -> bool:
+        return required_bytes <= self.remaining_bytes
+
+    def allocated_bytes(self) -> int:
+        """Memory held by live tensors (0 for the CPU; the planned models on a simulated GPU)."""
+        if not self.is_gpu:
+            return 0
+        if self.simulated:
+            return min(sum(self.planned.values()), self.total_bytes)
+        import torch # Already loaded by the models at this point
+        return torch.cuda.memory_allocated(self.name)
+
+    def reserved_bytes(self) -> int:
+        """Memory held by the CUDA caching allocator, live tensors included (0 for the CPU)."""
+        if not self.is_gpu:
+            return 0
+        if self.simulated:
+            return self.allocated_bytes() + self.simulated_cached
+        import torch
+        return torch.cuda.memory_reserved(self.name)
+
+    def simulate_inference(self):
+        """Grows a simulated GPU's cache the way the caching allocator keeps freed activations."""
+        if self.simulated and self.is_gpu:
+            headroom = self.total_bytes - self.allocated_bytes()
+            self.simulated_cached = min(self.simulated_cached + SIMULATED_CACHE_GROWTH, max(0, headroom))
+
+    def empty_cache(self):
+        """Returns the allocator's cached blocks to the driver."""
+        self.cache_empties += 1
+        if self.simulated:
+            self.simulated_cached = 0
+        elif self.is_gpu:
+            import torch
+            with torch.cuda.device(self.name):
+                torch.cuda.empty_cache()
+
+    def describe(self) -> str:
+        kind = "simulated " if self.simulated else ""
+        placed = ", ".join(self.planned) or "-"
+        line = (f"{self.name} ({kind}{self.total_bytes / 2**20:.0f} MB): planned {sum(self.planned.values()) / 2**20:.0f}"
+                f" / {self.budget_bytes / 2**20:.0f} MB [{placed}]")
+        if self.is_gpu:
+            line += f", cache emptied {self.cache_empties} time(s)"
+        return line
+
+
+def _cpu_total_bytes() -> int:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError): # Not available on Windows
+        return 0
+
+
+def parse_simulated_devices(spec: str) -> list:
+    """Parses "cuda:0=8192,cuda:1=4096" (MB) into simulated Device descriptors."""
+    devices = []
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        name, _, megabytes = entry.partition("=")
+        name = name.strip().lower()
+        if name == "cuda":
+            name = f"cuda:{len(devices)}"
+        if not name.startswith("cuda:") or not megabytes.strip():
+            raise ValueError(f"Invalid simulated device '{entry.strip()}' (expected cuda:N=MB)")
+        devices.append(Device(name, int(float(megabytes) * 2**20), simulated=True))
+    return devices
+
+
+def discover_devices(simulated_spec: str = None) -> list:
+    """Returns the CPU plus real (or simulated) GPUs, without importing torch for simulated ones."""
+    simulated_spec = config.TTS_SIMULATED_DEVICES if simulated_spec is None else simulated_spec
+    if simulated_spec:
+        gpus = parse_simulated_devices(simulated_spec)
+    else:
+        import torch
+        gpus = []
+        for index in range(torch.cuda.device_count() if torch.cuda.is_available() else 0):
+            free_bytes, total_bytes = torch.cuda.mem_get_info(index)
+            gpus.append(Device(f"cuda:{index}", total_bytes, free_bytes))
+    cpu_total = _cpu_total_bytes()
+    cpu = Device("cpu", cpu_total)
+    if not cpu_total:
+        cpu.budget_bytes = float("inf") # Unknown RAM size: never plan the CPU as full
+    return gpus + [cpu]
+
+
+# --- Module-level device table (initialized by init_devices) ---
+devices = []
+placements = {} # label -> Device
+_lock = threading.Lock() # empty_cache decisions happen in executor threads
+
+
+def init_devices(simulated_spec: str = None) -> list:
+    """Discovers devices once and prints them."""
+    global devices
+    if not devices:
+        devices = discover_devices(simulated_spec)
+        for device in devices:
+            print(f"Device: {device.describe()}")
+    return devices
+
+
+def get_device(name: str):
+    """Returns the descriptor for "cpu", "cuda" (first GPU) or "cuda:N", or None."""
+    name = name.lower()
+    if name == "cuda":
+        name = "cuda:0"
+    return next((device for device in init_devices() if device.name == name), None)
+
+
+def place(label: str, required_bytes: int, preference: str = "auto") -> Device:
+    """Picks a device for a model needing `required_bytes` and reserves that budget on it."""
+    init_devices()
+    cpu = get_device("cpu")
+    chosen = None
+    if preference and preference != "auto":
+        pinned = get_device(preference)
+        if pinned is None:
+            print(f"Warning: device '{preference}' for {label} is not available; placing it automatically.")
+        elif pinned.fits(required_bytes) or not pinned.is_gpu:
+            chosen = pinned
+        else:
+            print(f"Warning: {label} needs {required_bytes / 2**20:.0f} MB but {pinned.name} has "
+                  f"{pinned.remaining_bytes / 2**20:.0f} MB left; placing it automatically.")
+    if chosen is None:
+        gpus = [device for device in devices if device.is_gpu and device.fits(required_bytes)]
+        chosen = max(gpus, key=lambda device: device.remaining_bytes) if gpus else cpu
+        if chosen is cpu and not cpu.fits(required_bytes):
+            print(f"Warning: no device has {required_bytes / 2**20:.0f} MB left for {label}; using the CPU anyway.")
+    chosen.planned[label] = required_bytes
+    placements[label] = chosen
+    print(f"Placed {label} on {chosen.name} ({required_bytes / 2**20:.0f} MB planned)")
+    return chosen
+
+
+def estimate_checkpoint_bytes(path) -> int:
+    """Planned memory for a model loaded from `path` (checkpoint size x DEVICE_MODEL_OVERHEAD)."""
+    return int(Path(path).stat().st_size * config.DEVICE_MODEL_OVERHEAD)
+
+
+def module_bytes(module) -> int:
+    """Parameter and buffer bytes of a loaded torch module."""
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+# --- Inference-time policies ---
+# These take the placement Device (placements[model_name]), not the torch device string:
+# models on a simulated GPU run on "cpu" but still go through the policy.
+def relieve_pressure(device: Device, force: bool = False) -> bool:
+    """Empties the CUDA cache when cached blocks take over DEVICE_CACHE_PRESSURE of the free headroom (or `force`)."""
+    if device is None or not device.is_gpu:
+        return False
+    with _lock:
+        if not force:
+            allocated = device.allocated_bytes()
+            cached = device.reserved_bytes() - allocated
+            if cached <= (device.total_bytes - allocated) * config.DEVICE_CACHE_PRESSURE:
+                return False
+        device.empty_cache()
+    return True
+
+
+def after_inference(device: Device):
+    """Called after each inference on `device` (replaces emptying the cache every call)."""
+    if device is None:
+        return
+    device.simulate_inference()
+    relieve_pressure(device)
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    # torch.cuda.OutOfMemoryError subclasses RuntimeError; older versions only set the message
+    return isinstance(error, RuntimeError) and "out of memory" in str(error).lower()
+
+
+def run_with_oom_retry(func, device: Device):
+    """Runs `func()`; on a CUDA out-of-memory error on `device`, empties the cache and retries once."""
+    try:
+        return func()
+    except RuntimeError as e:
+        if device is None or not device.is_gpu or not is_out_of_memory(e):
+            raise
+        print(f"Out of memory on {device.name}; emptying the cache and retrying once.")
+        relieve_pressure(device, force=True)
+        return func()
+
+
+# --- BERT device ---
+# Style-Bert-VITS2 extracts BERT features on the device of the TTS model being run.
+# install_bert_device() wraps the extract_bert_feature used by its inference so the
+# BERT models stay on their own device; the features are moved to the VITS device by infer().
+bert_device = None
+_original_extract_bert_feature = None
+
+
+def _extract_bert_feature_on_bert_device(text, word2ph, language, device, *args, **kwargs):
+    return _original_extract_bert_feature(text, word2ph, language, bert_device.torch_device, *args, **kwargs)
+
+
+def place_bert_models(bert_modules: dict) -> Device:
+    """Places the loaded BERT models (language -> module) together on one device and moves them there."""
+    global bert_device
+    required_bytes = sum(module_bytes(module) for module in bert_modules.values())
+    bert_device = place("BERT", required_bytes, config.TTS_BERT_DEVICE)
+    for module in bert_modules.values():
+        module.to(bert_device.torch_device)
+    return bert_device
+
+
+def install_bert_device():
+    """Routes BERT feature extraction to bert_device for in-process inference."""
+    global _original_extract_bert_feature
+    if bert_device is None or _original_extract_bert_feature is not None:
+        return
+    from style_bert_vits2.models import infer as sbv2_infer # Already imported with the models
+
+    _original_extract_bert_feature = sbv2_infer.extract_bert_feature
+    sbv2_infer.extract_bert_feature = _extract_bert_feature_on_bert_device
+
+
+def summary_lines() -> list:
+    """One line per device: budget, planned models, cache empties."""
+    return [device.describe() for device in devices]
+
+
+# --- Placement plan (dry run) ---
+def plan_from_model_info(model_info_path: str, bert_mb: float) -> list:
+    """Places BERT and every model in model_info.json without loading anything."""
+    with open(model_info_path) as f:
+        model_infos = json.load(f)
+    place("BERT", int(bert_mb * 2**20), config.TTS_BERT_DEVICE)
+    for model_name, model_data in model_infos.items():
+        model_path = config.ASSETS_ROOT / model_name / model_data["model"]
+        if not model_path.exists():
+            print(f"Warning: Model file for {model_name} not found at {model_path}")
+            continue
+        place(model_name, estimate_checkpoint_bytes(model_path), config.TTS_VITS_DEVICE)
+    return summary_lines()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show how models would be placed across devices (nothing is loaded)')
+    parser.add_argument('--devices', default=None,
+                        help='Simulated GPUs, e.g. "cuda:0=8192,cuda:1=4096" (MB). Defaults to TTS_SIMULATED_DEVICES or the real GPUs')
+    parser.add_argument('--model-info', default=config.MODEL_INFO_JSON_PATH)
+    parser.add_argument('--bert-mb', type=float, default=3300, help='Planned memory for the JP + EN BERT models')
+    args = parser.parse_args()
+
+    init_devices(args.devices)
+    print("")
+    for line in plan_from_model_info(args.model_info, args.bert_mb):
+        print(line)
@@ -0,0 +1,408 @@
+# inference_service.py
+import abc
+import argparse
+import asyncio
+import hmac
+import io
+import itertools
+import time
+from pathlib import Path
+
+import aiohttp
+import numpy as np
+import soundfile as sf
+from aiohttp import web
+
+from style_bert_vits2.constants import Languages
+
+import config # To access INFERENCE_*, SBV2_API_* settings and model_info.json
+import tts_setup # For locally loaded models
+
+# --- Inference transports ---
+# Discord-facing processes never call TTSModel directly: they go through `transport`,
+# which runs inference in this process (local, default), forwards jobs to our inference
+# servers (http, INFERENCE_SERVER_URLS), calls Style-Bert-VITS2's own FastAPI server
+# (sbv2_http, SBV2_API_URL) or fakes it (stub, for tests). The inference server serves
+# whatever local transport it is configured with.
+# Every transport exposes `models` (name -> {"language": ..., "styles": [...], "speakers": {name: id}})
+# and `synthesize(text, language, model_name, params, timings) -> (sample_rate, int16 ndarray)`.
+# When a `timings` dict is passed, transports set timings["inference_s"] to the inference
+# time alone (no local queueing), which feeds the load controller.
+# `params` holds optional TTSModel.infer keyword arguments (length, style, speaker_id, ...);
+# `supported_params` lists the ones a transport can honour (None = all of them).
+# `reload_dictionary()` applies an edited user dictionary CSV wherever inference runs
+# (and drops the readings cached there); the shard that saved the edit calls it.
+
+
+class InferenceTransport(abc.ABC):
+    """Interface for inference transports."""
+    uses_local_models = False
+    pipeline_depth = 1 # How many jobs a queue processor may keep in flight
+    supported_params = None
+
+    def __init__(self):
+        self.models = {}
+
+    async def refresh_models(self):
+        pass
+
+    @abc.abstractmethod
+    async def synthesize(self, text: str, language: Languages, model_name: str, params: dict = None,
+                         timings: dict = None):
+        """Returns (sample_rate, int16 ndarray)."""
+
+    @abc.abstractmethod
+    async def reload_dictionary(self):
+        """Recompiles the user dictionary where inference runs."""
+
+    async def close(self):
+        pass
+
+
+class LocalInferenceTransport(InferenceTransport):
+    """Runs Style-Bert-VITS2's TTSModel in this process (models loaded by tts_setup)."""
+    uses_local_models = True
+
+    async def refresh_models(self):
+        self.models = {
+            name: {
+                "language": data.get("language"),
+                "styles": list(data["model"].style2id.keys()),
+                "speakers": dict(data["model"].spk2id)
+            }
+            for name, data in tts_setup.models.items()
+        }
+
+    async def synthesize(self, text: str, language: Languages, model_name: str, params: dict = None,
+                         timings: dict = None):
+        import tts_processing # Imported here: tts_processing imports this module
+
+        model_data = tts_setup.models.get(model_name)
+        if model_data is None:
+            raise KeyError(f"TTS model '{model_name}' is not loaded")
+        return await tts_processing.synthesize_audio(
+            text, language, model_data["model"], params, timings, device=model_data.get("device")
+        )
+
+    async def reload_dictionary(self):
+        import tts_processing
+
+        await tts_processing.reload_user_dictionary()
+
+
+class HttpTransportBase(InferenceTransport):
+    """Shared HTTP client: one pooled keep-alive session, round-robin over servers with failover.
+
+    A server that can't be reached, times out or answers with a 5xx status is skipped
+    and the job is retried on the next one. Other error statuses fail the job.
+    """
+
+    def __init__(self, base_urls: list, timeout: float = 60.0, max_inflight: int = None):
+        super().__init__()
+        if not base_urls:
+            raise ValueError(f"{type(self).__name__} needs at least one server URL")
+        self.base_urls = [url.rstrip("/") for url in base_urls]
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_inflight = max_inflight # Concurrent requests across all guilds (None = unlimited)
+        self._next_url = itertools.cycle(self.base_urls)
+        self._session = None
+        self._inflight = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            # One pooled session per process; keep-alive connections are reused across jobs
+            self._session = aiohttp.ClientSession(
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit_per_host=self.max_inflight or 8, keepalive_timeout=60)
+            )
+            if self.max_inflight:
+                self._inflight = asyncio.Semaphore(self.max_inflight)
+        return self._session
+
+    @abc.abstractmethod
+    async def _fetch_models(self, session: aiohttp.ClientSession, base_url: str) -> dict:
+        """Returns the server's models in the `models` format."""
+
+    async def refresh_models(self):
+        session = self._get_session()
+        for base_url in self.base_urls:
+            try:
+                self.models = await self._fetch_models(session, base_url)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Could not fetch model list from {base_url}: {e}")
+        print("Warning: No inference server answered; TTS functionality will be unavailable.")
+
+    @abc.abstractmethod
+    async def _request(self, session: aiohttp.ClientSession, base_url: str, text: str,
+                       language: Languages, model_name: str, params: dict, timings: dict):
+        """Sends one job; returns (sample_rate, int16 ndarray) or raises for a non-200 response."""
+
+    async def synthesize(self, text: str, language: Languages, model_name: str, params: dict = None,
+                         timings: dict = None):
+        session = self._get_session()
+        timings = {} if timings is None else timings
+        last_error = None
+        for _ in range(len(self.base_urls)):
+            base_url = next(self._next_url)
+            try:
+                if self._inflight is None:
+                    return await self._request(session, base_url, text, language, model_name, params or {}, timings)
+                async with self._inflight:
+                    return await self._request(session, base_url, text, language, model_name, params or {}, timings)
+            except aiohttp.ClientResponseError as e:
+                if e.status < 500:
+                    raise RuntimeError(f"{base_url} returned {e.status}: {e.message}") from e
+                last_error = e # Unhealthy server: try the next one
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                last_error = e # Try the next server
+        raise RuntimeError(f"All inference servers failed: {last_error}")
+
+    @staticmethod
+    async def _raise_for_status(resp: aiohttp.ClientResponse):
+        if resp.status != 200:
+            raise aiohttp.ClientResponseError(
+                resp.request_info, resp.history, status=resp.status, message=(await resp.text())[:200]
+            )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class HttpInferenceTransport(HttpTransportBase):
+    """Sends synthesis jobs to our inference servers (see run_server)."""
+
+    def __init__(self, base_urls: list, timeout: float = 60.0):
+        super().__init__(base_urls, timeout)
+        self.pipeline_depth = len(self.base_urls) # One job in flight per server
+
+    async def _fetch_models(self, session: aiohttp.ClientSession, base_url: str) -> dict:
+        async with session.get(f"{base_url}/models") as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def _request(self, session, base_url, text, language, model_name, params, timings):
+        payload = {"text": text, "language": str(language), "model": model_name, "params": params}
+        async with session.post(f"{base_url}/synthesize", json=payload) as resp:
+            await self._raise_for_status(resp)
+            sr = int(resp.headers["X-Sample-Rate"])
+            if "X-Inference-Ms" in resp.headers: # Measured by the server, without its queueing
+                timings["inference_s"] = float(resp.headers["X-Inference-Ms"]) / 1000
+            audio = np.frombuffer(await resp.read(), dtype="<i2").astype(np.int16, copy=False)
+            return sr, audio
+
+    async def _reload_dictionary_on(self, session: aiohttp.ClientSession, base_url: str):
+        headers = {"Authorization": f"Bearer {config.INFERENCE_SERVER_TOKEN}"}
+        async with session.post(f"{base_url}/dictionary/reload", headers=headers) as resp:
+            await self._raise_for_status(resp)
+
+    async def reload_dictionary(self):
+        """Reloads the dictionary on every server (each one synthesizes with its own pyopenjtalk)."""
+        session = self._get_session()
+        results = await asyncio.gather(
+            *(self._reload_dictionary_on(session, base_url) for base_url in self.base_urls), return_exceptions=True
+        )
+        failed = [f"{base_url} ({error})" for base_url, error in zip(self.base_urls, results) if error is not None]
+        if failed:
+            raise RuntimeError(f"Dictionary reload failed on {', '.join(failed)}")
+
+
+class SBV2ApiTransport(HttpTransportBase):
+    """Client for Style-Bert-VITS2's FastAPI server (server_fastapi.py, `/voice`).
+
+    Up to `max_inflight` requests are sent concurrently, so queue processors can pipeline
+    the next segments while earlier ones are still being synthesized or played.
+    """
+
+    # infer() keyword -> /voice query parameter (pitch_scale / intonation_scale are not exposed by /voice)
+    PARAM_NAMES = {
+        "length": "length", "style": "style", "style_weight": "style_weight",
+        "speaker_id": "speaker_id", "sdp_ratio": "sdp_ratio", "noise": "noise", "noise_w": "noisew",
+    }
+    supported_params = frozenset(PARAM_NAMES)
+
+    def __init__(self, base_urls: list, timeout: float = 60.0, max_inflight: int = 4):
+        super().__init__(base_urls, timeout, max_inflight)
+        self.pipeline_depth = max_inflight
+        self._warned_params = set()
+
+    async def _fetch_models(self, session: aiohttp.ClientSession, base_url: str) -> dict:
+        async with session.get(f"{base_url}/models/info") as resp:
+            resp.raise_for_status()
+            models_info = await resp.json()
+        # The server keys models by id; the model name is its directory under model_assets.
+        # Languages aren't reported, so reuse model_info.json entries with the same name.
+        local_infos = config.load_json_file(config.MODEL_INFO_JSON_PATH, {})
+        models = {}
+        for info in models_info.values():
+            name = Path(info.get("model_path", "")).parent.name
+            if name:
+                models[name] = {
+                    "language": local_infos.get(name, {}).get("language"),
+                    "styles": list(info.get("style2id", {}).keys()),
+                    "speakers": dict(info.get("spk2id", {}))
+                }
+        return models
+
+    async def _request(self, session, base_url, text, language, model_name, params, timings):
+        query = {"text": text, "model_name": model_name, "language": str(language)}
+        for key, value in params.items():
+            if key in self.PARAM_NAMES:
+                query[self.PARAM_NAMES[key]] = str(value)
+            elif key not in self._warned_params: # !set refuses these; settings saved earlier may still carry them
+                self._warned_params.add(key)
+                print(f"Warning: the Style-Bert-VITS2 API server does not support '{key}'; ignoring it.")
+        start = time.perf_counter()
+        async with session.post(f"{base_url}/voice", params=query) as resp:
+            await self._raise_for_status(resp)
+            wav_bytes = await resp.read()
+        timings["inference_s"] = time.perf_counter() - start # Round trip; /voice reports no inference time
+        audio, sr = sf.read(io.BytesIO(wav_bytes), dtype="int16")
+        return sr, audio
+
+    async def reload_dictionary(self):
+        # server_fastapi.py keeps its own user dictionary and has no endpoint to reload it
+        if "dictionary" not in self._warned_params:
+            self._warned_params.add("dictionary")
+            print("Warning: the Style-Bert-VITS2 API server does not load our user dictionary; edits only change !get dict.")
+
+
+class StubInferenceTransport(InferenceTransport):
+    """Returns silence after a fixed delay. Used by tests and load simulations."""
+
+    def __init__(self, latency: float = 0.05, sample_rate: int = 44100, model_names=None):
+        super().__init__()
+        self.latency = latency
+        self.sample_rate = sample_rate
+        self.models = {name: {"language": None} for name in (model_names or ["stub"])}
+        self.calls = 0
+        self.dictionary_reloads = 0
+
+    async def synthesize(self, text: str, language: Languages, model_name: str, params: dict = None,
+                         timings: dict = None):
+        if model_name not in self.models:
+            raise KeyError(f"TTS model '{model_name}' is not loaded")
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if timings is not None:
+            timings["inference_s"] = self.latency
+        # Roughly 0.1s of audio per character, like short TTS phrases
+        return self.sample_rate, np.zeros(int(self.sample_rate * 0.1 * max(len(text), 1)), dtype=np.int16)
+
+    async def reload_dictionary(self):
+        self.dictionary_reloads += 1
+
+
+# --- Module-level transport (initialized by init_transport) ---
+transport = LocalInferenceTransport()
+
+
+def init_transport(serving: bool = False):
+    """Selects the transport from INFERENCE_TRANSPORT (or INFERENCE_SERVER_URLS / TTS_BACKEND).
+
+    `serving` is set by the inference server, which never forwards to other inference servers.
+    """
+    global transport
+    kind = config.INFERENCE_TRANSPORT or ("http" if config.INFERENCE_SERVER_URLS and not serving else "")
+    kind = kind or ("sbv2_http" if config.TTS_BACKEND == "sbv2_http" else "local")
+    if kind == "http" and serving:
+        print("Warning: INFERENCE_TRANSPORT=http is ignored by the inference server; using local models.")
+        kind = "local"
+    if kind == "http":
+        transport = HttpInferenceTransport(config.INFERENCE_SERVER_URLS, config.INFERENCE_TIMEOUT)
+        print(f"Using inference servers: {', '.join(transport.base_urls)}")
+    elif kind == "sbv2_http":
+        transport = SBV2ApiTransport(config.SBV2_API_URLS, config.SBV2_API_TIMEOUT, config.SBV2_API_MAX_INFLIGHT)
+        print(f"Using Style-Bert-VITS2 API server: {', '.join(transport.base_urls)}")
+    elif kind == "stub":
+        transport = StubInferenceTransport()
+        print("Using stub inference transport (no audio will be synthesized).")
+    else:
+        transport = LocalInferenceTransport()
+    return transport
+
+
+def get_available_model_names():
+    return list(transport.models.keys())
+
+
+def supports_param(name: str) -> bool:
+    """Whether the current transport honours the infer() keyword `name`."""
+    return transport.supported_params is None or name in transport.supported_params
+
+
+# --- Inference server ---
+async def _handle_models(request: web.Request):
+    await transport.refresh_models()
+    return web.json_response(transport.models)
+
+
+async def _handle_synthesize(request: web.Request):
+    try:
+        data = await request.json()
+        text = data["text"]
+        model_name = data["model"]
+        language = Languages(data.get("language") or Languages.JP)
+        params = dict(data.get("params") or {})
+    except (ValueError, KeyError, TypeError) as e:
+        return web.json_response({"error": f"Invalid request: {e}"}, status=400)
+
+    try:
+        timings = {}
+        sr, audio = await transport.synthesize(text, language, model_name, params, timings=timings)
+    except KeyError as e: # Model (or style) not loaded here
+        return web.json_response({"error": f"Not found: {e}"}, status=404)
+    except (ValueError, TypeError) as e:
+        # Deterministic for these arguments (bad style weight, speaker id, ...): a 4xx makes
+        # the client fail the job at once instead of re-running it on every server
+        return web.json_response({"error": f"Invalid synthesis parameters: {e}"}, status=422)
+    return web.Response(
+        body=audio.astype("<i2", copy=False).tobytes(),
+        content_type="application/octet-stream",
+        headers={"X-Sample-Rate": str(sr), "X-Inference-Ms": f"{timings.get('inference_s', 0.0) * 1000:.1f}"}
+    )
+
+
+async def _handle_reload_dictionary(request: web.Request):
+    """Recompiles the user dictionary CSV after a shard saved an edit (needs INFERENCE_SERVER_TOKEN)."""
+    token = config.INFERENCE_SERVER_TOKEN
+    if not token:
+        return web.json_response({"error": "INFERENCE_SERVER_TOKEN is not set on this server"}, status=403)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return web.json_response({"error": "Unauthorized"}, status=401)
+    await transport.reload_dictionary() # Under generation_semaphore; clears the g2p and audio caches
+    return web.json_response({"status": "ok"})
+
+
+async def _handle_health(request: web.Request):
+    return web.json_response({"status": "ok"})
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/models", _handle_models)
+    app.router.add_post("/synthesize", _handle_synthesize)
+    app.router.add_post("/dictionary/reload", _handle_reload_dictionary)
+    app.router.add_get("/health", _handle_health)
+    return app
+
+
+def run_server(host: str, port: int):
+    """Loads the TTS models and user dictionary (for the local transport) and serves them until interrupted."""
+    init_transport(serving=True)
+    if transport.uses_local_models:
+        tts_setup.initialize_tts_system()
+        config.initialize_jtalk_dictionary() # Later edits arrive through POST /dictionary/reload
+    if not config.INFERENCE_SERVER_TOKEN:
+        print("Warning: INFERENCE_SERVER_TOKEN is not set; dictionary edits from the shards will be refused.")
+    print(f"Starting inference server on http://{host}:{port}")
+    web.run_app(create_app(), host=host, port=port, print=None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a TTS inference server for the Discord bot shards')
+    parser.add_argument('--host', default=config.INFERENCE_SERVER_HOST)
+    parser.add_argument('--port', type=int, default=config.INFERENCE_SERVER_PORT)
+    args = parser.parse_args()
+    run_server(args.host, args.port)
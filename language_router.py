@@ -0,0 +1,122 @@
+# language_router.py
+import functools
+
+from style_bert_vits2.constants import Languages
+
+import user_dictionary # For words registered with !set dict
+
+# --- Script classifier ---
+# Every BMP code point is classified once into a lookup table, so splitting a
+# message is a single pass of table lookups.
+NEUTRAL, LATIN, JAPANESE = 0, 1, 2
+
+
+def _build_script_table() -> bytearray:
+    table = bytearray([JAPANESE]) * 0x10000 # Non-Latin scripts go to the JP pipeline, as before
+    neutral_ranges = [
+        (0x0000, 0x007F), # ASCII (letters are set to LATIN below)
+        (0x0080, 0x00BF), # Latin-1 punctuation and symbols
+        (0x2000, 0x2BFF), # General punctuation, arrows, math, box drawing, misc symbols
+        (0x3000, 0x3003), # Ideographic space, 、。〃
+        (0x3008, 0x3011), # Brackets 「」『』【】...
+        (0xFE00, 0xFE0F), # Variation selectors (emoji presentation)
+        (0xFF01, 0xFF20), # Fullwidth punctuation and digits
+        (0xFF3B, 0xFF40),
+        (0xFF5B, 0xFF65),
+    ]
+    latin_ranges = [
+        (ord('A'), ord('Z')), (ord('a'), ord('z')),
+        (0x00C0, 0x024F), # Latin-1 letters, Latin Extended-A/B
+        (0xFF21, 0xFF3A), (0xFF41, 0xFF5A), # Fullwidth letters
+    ]
+    for ranges, script in ((neutral_ranges, NEUTRAL), (latin_ranges, LATIN)):
+        for start, end in ranges:
+            table[start:end + 1] = bytes([script]) * (end - start + 1)
+    table[0x00D7] = table[0x00F7] = NEUTRAL # × ÷
+    return table
+
+
+_SCRIPT_TABLE = _build_script_table()
+MIN_LATIN_RUN = 2 # Single Latin letters inside Japanese text ("Aさん") stay in the Japanese run
+
+
+def _script_of(char: str) -> int:
+    code = ord(char)
+    return _SCRIPT_TABLE[code] if code < 0x10000 else NEUTRAL # Emoji etc.
+
+
+def split_scripts(text: str) -> list:
+    """Splits text into [(run_text, script)] in one pass. Neutral characters join the current run."""
+    runs = [] # [start, end, script]
+    for index, char in enumerate(text):
+        script = _script_of(char)
+        if script == NEUTRAL:
+            continue
+        if runs and runs[-1][2] == script:
+            runs[-1][1] = index + 1
+        else:
+            if runs:
+                runs[-1][1] = index # Neutral characters so far belong to the previous run
+            runs.append([index if runs else 0, index + 1, script])
+    if not runs:
+        return [(text, NEUTRAL)]
+    runs[-1][1] = len(text)
+
+    # Fold short Latin runs into their Japanese neighbour, then merge same-script neighbours
+    merged = []
+    for start, end, script in runs:
+        letters = sum(1 for c in text[start:end] if _script_of(c) == LATIN)
+        if script == LATIN and letters < MIN_LATIN_RUN and len(runs) > 1:
+            script = JAPANESE
+        if merged and merged[-1][2] == script:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end, script])
+    return [(text[start:end], script) for start, end, script in merged]
+
+
+@functools.lru_cache(maxsize=4096)
+def _latin_run_language(run_text: str, dict_version) -> Languages:
+    """Latin runs containing a registered dictionary word are read in Japanese."""
+    run_fw = user_dictionary.to_fullwidth(run_text)
+    for surface in user_dictionary.get_latin_surfaces():
+        if surface in run_fw:
+            return Languages.JP
+    return Languages.EN
+
+
+@functools.lru_cache(maxsize=4096)
+def _route_cached(text: str, dict_version) -> tuple:
+    routed = []
+    for run_text, script in split_scripts(text):
+        if script == LATIN:
+            language = _latin_run_language(run_text.strip(), dict_version)
+        elif script == NEUTRAL:
+            language = Languages.EN if text.isascii() else Languages.JP
+        else:
+            language = Languages.JP
+        if routed and routed[-1][1] == language:
+            routed[-1] = (routed[-1][0] + run_text, language)
+        else:
+            routed.append((run_text, language))
+    return tuple(routed)
+
+
+def route_language_runs(text: str, model_lang_preference: str = None) -> list:
+    """Splits text into [(run_text, Languages)] for synthesis.
+
+    Models that only speak Japanese (language "JP" in model_info.json, e.g. JP-Extra)
+    get the whole text as one JP run. Results are cached per text and per Latin run,
+    and invalidated when the user dictionary changes.
+    """
+    if model_lang_preference == "JP" or not text:
+        return [(text, Languages.JP)]
+    return list(_route_cached(text, user_dictionary.version()))
+
+
+def dominant_language(runs: list) -> Languages:
+    """Returns the language covering the most characters."""
+    totals = {}
+    for run_text, language in runs:
+        totals[language] = totals.get(language, 0) + len(run_text)
+    return max(totals, key=totals.get) if totals else Languages.JP
@@ -0,0 +1,121 @@
+# load_controller.py
+import time
+
+import config # To access LOAD_* settings
+
+# --- Adaptive degradation under load ---
+# Picks a mode from the cross-guild TTS backlog and a moving average of the inference
+# real-time factor (seconds of inference per second of audio, so long messages don't
+# look like load and waiting in our own queues isn't counted twice). Higher modes trade
+# quality for throughput: shorter messages, no name readout, faster speech and (in
+# critical mode) an optional lighter model.
+# Modes go up as soon as a threshold is crossed and come down one step at a time,
+# only after load has stayed well below the threshold for LOAD_RECOVERY_SECONDS.
+# The average decays with a half-life of LOAD_RTF_HALF_LIFE seconds, so it falls back
+# after a burst even when no further inference happens.
+
+MODES = ("normal", "degraded", "critical")
+
+MODE_SETTINGS = {
+    "normal": {"max_chars": 140, "read_names": True, "speed_multiplier": 1.0, "light_model": None},
+    "degraded": {"max_chars": 100, "read_names": True, "speed_multiplier": 1.2, "light_model": None},
+    "critical": {"max_chars": 60, "read_names": False, "speed_multiplier": 1.4, "light_model": config.LOAD_LIGHT_MODEL},
+}
+
+
+class LoadController:
+    """Tracks queue depth and inference latency and switches between MODES."""
+
+    def __init__(self):
+        self.enabled = config.LOAD_CONTROL
+        # Entry thresholds for degraded / critical
+        self.queue_thresholds = (config.LOAD_DEGRADED_QUEUE, config.LOAD_CRITICAL_QUEUE)
+        self.rtf_thresholds = (config.LOAD_DEGRADED_RTF, config.LOAD_CRITICAL_RTF)
+        self.recovery_ratio = config.LOAD_RECOVERY_RATIO
+        self.recovery_seconds = config.LOAD_RECOVERY_SECONDS
+        self.ewma_alpha = 0.2
+        self.half_life = config.LOAD_RTF_HALF_LIFE
+
+        self.level = 0
+        self.rtf_ewma = 0.0
+        self._rtf_updated_at = None
+        self.queue_depth = 0
+        self._calm_since = None
+        self._queue_depth_source = None
+
+    @property
+    def mode(self) -> str:
+        return MODES[self.level]
+
+    @property
+    def settings(self) -> dict:
+        return MODE_SETTINGS[self.mode]
+
+    def set_queue_depth_source(self, source):
+        """Registers a callable returning the total number of queued TTS items."""
+        self._queue_depth_source = source
+
+    def _decay(self, now: float):
+        if self._rtf_updated_at is not None and self.half_life > 0:
+            self.rtf_ewma *= 0.5 ** ((now - self._rtf_updated_at) / self.half_life)
+        self._rtf_updated_at = now
+
+    def record_inference(self, inference_seconds: float, audio_seconds: float, now: float = None):
+        """Feeds one inference (cache hits excluded) and re-evaluates the mode."""
+        now = time.monotonic() if now is None else now
+        rtf = inference_seconds / max(audio_seconds, 0.25) # Very short clips are dominated by fixed costs
+        self._decay(now)
+        if self.rtf_ewma == 0.0:
+            self.rtf_ewma = rtf
+        else:
+            self.rtf_ewma += self.ewma_alpha * (rtf - self.rtf_ewma)
+        self.evaluate(now)
+
+    def _pressure_level(self, scale: float = 1.0) -> int:
+        level = 0
+        for index in range(len(self.queue_thresholds)):
+            if (self.queue_depth >= self.queue_thresholds[index] * scale
+                    or self.rtf_ewma >= self.rtf_thresholds[index] * scale):
+                level = index + 1
+        return level
+
+    def evaluate(self, now: float = None) -> str:
+        """Updates the mode from the current signals and returns it."""
+        if not self.enabled:
+            return self.mode
+        now = time.monotonic() if now is None else now
+        self._decay(now)
+        if self._queue_depth_source is not None:
+            self.queue_depth = self._queue_depth_source()
+
+        target = self._pressure_level()
+        if target > self.level:
+            self._switch(target)
+        elif self.level > 0 and self._pressure_level(self.recovery_ratio) < self.level:
+            # Well below the current mode's thresholds; step down once it stays that way
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.recovery_seconds:
+                self._switch(self.level - 1)
+        else:
+            self._calm_since = None
+        return self.mode
+
+    def _switch(self, level: int):
+        print(f"Load mode: {MODES[self.level]} -> {MODES[level]} "
+              f"(queued {self.queue_depth}, inference real-time factor ~{self.rtf_ewma:.2f})")
+        self.level = level
+        self._calm_since = None
+
+
+def apply_speed(params: dict, speed_multiplier: float) -> dict:
+    """Returns synthesis params with speech sped up by `speed_multiplier`."""
+    if speed_multiplier == 1.0:
+        return params
+    adjusted = dict(params)
+    adjusted["length"] = round(adjusted.get("length", 1.0) / speed_multiplier, 3)
+    return adjusted
+
+
+# --- Module-level controller ---
+controller = LoadController()
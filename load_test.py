@@ -0,0 +1,321 @@
+# load_test.py
+import argparse
+import asyncio
+import itertools
+import random
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import discord
+
+import config
+import main
+import inference_service
+import tts_processing
+import load_controller
+import loop_watchdog
+import voice_sessions
+from loop_watchdog import percentile
+
+# --- Load simulation with fake Discord objects ---
+# Drives main.on_message / main.on_voice_state_update for many guilds at once,
+# with the stub inference transport, fake voice clients that "play" audio for its
+# duration, and no Discord connection. Reports event-loop lag (loop_watchdog.py), task counts,
+# memory growth and enqueue -> playback latency.
+#
+#   python load_test.py --guilds 300 --message-rate 0.2 --duration 60
+#   python load_test.py --guilds 50 --stub-latency 0.5 --playback-scale 0.1
+
+SAMPLE_MESSAGES = [
+    "こんにちは",
+    "www",
+    "今日はいい天気ですね、散歩に行きましょう。",
+    "{mention} これ見て <:pepe:123456789012345678>",
+    "Googleで検索したら出てきたよ",
+    "OK、わかった。 See you later!",
+    "||ネタバレ注意|| 最終回すごかった",
+    "長文テスト。" * 30, # Exercises truncation and segmentation
+    "https://example.com/some/page",
+]
+
+
+# --- Fake Discord objects (only what main.py and tts_processing.py use) ---
+class FakeMember:
+    def __init__(self, member_id: int, name: str, guild=None, bot: bool = False):
+        self.id = member_id
+        self.name = name
+        self.display_name = name
+        self.guild = guild
+        self.bot = bot
+
+
+class FakeVoiceState:
+    def __init__(self, channel=None):
+        self.channel = channel
+
+
+class FakeAudioSource:
+    """Stands in for FFmpegPCMAudio; only knows how long the clip is."""
+
+    def __init__(self, buffer, sr: int):
+        # encode_wav_buffer writes 16-bit mono PCM after a 44-byte header
+        self.duration = max(0, len(buffer.getbuffer()) - 44) / (2 * sr)
+        buffer.close()
+
+
+class FakeVoiceClient:
+    def __init__(self, channel, playback_scale: float = 1.0):
+        self.channel = channel
+        self.guild = channel.guild
+        self.playback_scale = playback_scale
+        self.played = 0
+        self._connected = True
+        self._playing = False
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def is_playing(self) -> bool:
+        return self._playing
+
+    def play(self, source, after=None):
+        if self._playing:
+            raise discord.ClientException("Already playing audio.")
+        self._playing = True
+        self.played += 1
+
+        def _finish():
+            self._playing = False
+            if after:
+                after(None)
+        asyncio.get_running_loop().call_later(source.duration * self.playback_scale, _finish)
+
+    async def disconnect(self, force: bool = False):
+        self._connected = False
+        self._playing = False
+        if self.guild.voice_client is self:
+            self.guild.voice_client = None
+
+
+class FakeVoiceChannel:
+    def __init__(self, channel_id: int, name: str, guild, playback_scale: float):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.members = []
+        self.playback_scale = playback_scale
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self, self.playback_scale)
+        return self.guild.voice_client
+
+
+class FakeTextChannel:
+    def __init__(self, channel_id: int, name: str, guild):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, name: str):
+        self.id = guild_id
+        self.name = name
+        self.voice_client = None
+        self.voice_channels = []
+        self.text_channels = []
+        self.members = {}
+
+    def get_member(self, member_id: int):
+        return self.members.get(member_id)
+
+    def get_role(self, role_id: int):
+        return None
+
+    def get_channel(self, channel_id: int):
+        return next((c for c in self.voice_channels + self.text_channels if c.id == channel_id), None)
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, author, channel, content: str, mentions=None):
+        self.id = message_id
+        self.author = author
+        self.guild = channel.guild
+        self.channel = channel
+        self.content = content
+        self.mentions = mentions or []
+        self.stickers = []
+
+
+# --- Simulation ---
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.ids = itertools.count(10**17)
+        self.guilds = []
+        self.stats = {"messages": 0, "voice_events": 0, "handler_errors": 0}
+        self.task_counts = []
+
+    def build_guilds(self):
+        bot_user = FakeMember(next(self.ids), "tts-bot", bot=True) # Never logs in, so main.bot.user stays None
+        for index in range(self.args.guilds):
+            guild = FakeGuild(next(self.ids), f"guild-{index}")
+            voice_channel = FakeVoiceChannel(next(self.ids), config.AUTO_JOIN_VC_NAME or "general", guild,
+                                             self.args.playback_scale)
+            guild.voice_channels.append(voice_channel)
+            guild.text_channels.append(FakeTextChannel(next(self.ids), config.VC_TEXT_CHANNEL_NAME, guild))
+            for member_index in range(self.args.members):
+                member = FakeMember(next(self.ids), f"user{member_index}", guild)
+                guild.members[member.id] = member
+            # The first member never leaves, so the bot stays connected
+            voice_channel.members.extend([next(iter(guild.members.values())), bot_user])
+            guild.voice_client = FakeVoiceClient(voice_channel, self.args.playback_scale)
+            self.guilds.append(guild)
+
+    async def _sleep_until_next(self, rate: float, stop_at: float) -> bool:
+        """Sleeps for an exponential gap (Poisson arrivals); False once `stop_at` is reached."""
+        gap = self.rng.expovariate(rate)
+        remaining = stop_at - time.monotonic()
+        await asyncio.sleep(max(0.0, min(gap, remaining)))
+        return gap < remaining
+
+    async def drive_messages(self, guild: FakeGuild, stop_at: float):
+        text_channel = guild.text_channels[0]
+        members = list(guild.members.values())
+        if self.args.message_rate <= 0:
+            return
+        while await self._sleep_until_next(self.args.message_rate, stop_at):
+            author = self.rng.choice(members)
+            content = self.rng.choice(SAMPLE_MESSAGES).format(mention=f"<@{author.id}>")
+            message = FakeMessage(next(self.ids), author, text_channel, content, mentions=[author])
+            self.stats["messages"] += 1
+            try:
+                await main.on_message(message)
+            except Exception as e:
+                self.stats["handler_errors"] += 1
+                print(f"on_message error in {guild.name}: {e!r}")
+
+    async def drive_voice(self, guild: FakeGuild, stop_at: float):
+        voice_channel = guild.voice_channels[0]
+        movers = list(guild.members.values())[1:] # Everyone but the anchor member
+        if not movers or self.args.voice_rate <= 0:
+            return
+        while await self._sleep_until_next(self.args.voice_rate, stop_at):
+            member = self.rng.choice(movers)
+            if member in voice_channel.members:
+                voice_channel.members.remove(member)
+                before, after = FakeVoiceState(voice_channel), FakeVoiceState(None)
+            else:
+                voice_channel.members.append(member)
+                before, after = FakeVoiceState(None), FakeVoiceState(voice_channel)
+            self.stats["voice_events"] += 1
+            try:
+                await main.on_voice_state_update(member, before, after)
+            except Exception as e:
+                self.stats["handler_errors"] += 1
+                print(f"on_voice_state_update error in {guild.name}: {e!r}")
+
+    def queued_items(self) -> int:
+        return sum(q.qsize() for q in main.playback_queues.values()) + sum(q.qsize() for q in main.play_queues.values())
+
+    async def report_progress(self, started: float):
+        while True:
+            await asyncio.sleep(self.args.report_interval)
+            elapsed = time.monotonic() - started
+            tasks = len(asyncio.all_tasks())
+            self.task_counts.append(tasks)
+            memory_mb = tracemalloc.get_traced_memory()[0] / 2**20 if tracemalloc.is_tracing() else 0.0
+            recent_lags = list(itertools.islice(reversed(self.watchdog.lags), 200)) or [0.0]
+            print(f"[{elapsed:6.1f}s] messages {self.stats['messages']:6d} | voice events {self.stats['voice_events']:5d} "
+                  f"| queued {self.queued_items():5d} | tasks {tasks:5d} | lag p95 {percentile(recent_lags, 95):7.1f} ms "
+                  f"| mem {memory_mb:7.1f} MB | mode {load_controller.controller.mode}")
+
+    async def wait_for_drain(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while self.queued_items() and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+
+    async def run(self):
+        # Keep the simulation away from real user/server settings and the job database
+        work_dir = Path(tempfile.mkdtemp(prefix="tts_load_test_"))
+        config.USER_INFO_JSON_PATH = work_dir / "user_info.json"
+        config.SERVER_INFO_JSON_PATH = work_dir / "server_info.json"
+        config.DICT_CSV_PATH = work_dir / "user_dict.csv"
+        config.TTS_QUEUE_DB_PATH = None
+        tts_processing.audio_source_factory = FakeAudioSource
+        tts_processing.playback_delays.clear()
+        inference_service.transport = inference_service.StubInferenceTransport(latency=self.args.stub_latency)
+        await inference_service.transport.refresh_models()
+
+        if not self.args.no_memory:
+            tracemalloc.start()
+        self.build_guilds()
+        guilds_by_id = {guild.id: guild for guild in self.guilds}
+        voice_sessions.init_voice_sessions(guilds_by_id.get) # Fake guilds aren't in the bot's cache
+        for guild in self.guilds:
+            main.ensure_guild_queues_and_tasks(guild)
+        baseline_mb = tracemalloc.get_traced_memory()[0] / 2**20 if tracemalloc.is_tracing() else 0.0
+
+        started = time.monotonic()
+        stop_at = started + self.args.duration
+        self.watchdog = loop_watchdog.start_watchdog(force=True) # Also reports blocking callbacks with their stack
+        helpers = [asyncio.create_task(self.report_progress(started))]
+        drivers = [asyncio.create_task(self.drive_messages(guild, stop_at)) for guild in self.guilds]
+        drivers += [asyncio.create_task(self.drive_voice(guild, stop_at)) for guild in self.guilds]
+        await asyncio.gather(*drivers)
+        print(f"Load stopped after {time.monotonic() - started:.1f}s; draining queues (up to {self.args.drain}s)...")
+        await self.wait_for_drain(self.args.drain)
+
+        final_mb, peak_mb = (m / 2**20 for m in tracemalloc.get_traced_memory()) if tracemalloc.is_tracing() else (0.0, 0.0)
+        for task in helpers:
+            task.cancel()
+        self.watchdog.stop()
+        for gen_task, play_task in main.guild_tts_tasks.values():
+            gen_task.cancel()
+            play_task.cancel()
+        await asyncio.sleep(0) # Let cancelled processors exit
+        self.print_summary(time.monotonic() - started, baseline_mb, final_mb, peak_mb)
+
+    def print_summary(self, elapsed: float, baseline_mb: float, final_mb: float, peak_mb: float):
+        clip_count = len(tts_processing.playback_delays)
+        delays = list(tts_processing.playback_delays) or [0.0]
+        played = sum(guild.voice_client.played for guild in self.guilds if guild.voice_client)
+        dropped = sum(getattr(q, "dropped", 0) for q in main.playback_queues.values())
+        print("\n=== Load test summary ===")
+        print(f"guilds {self.args.guilds} | members/guild {self.args.members} | elapsed {elapsed:.1f}s")
+        print(f"messages {self.stats['messages']} | voice events {self.stats['voice_events']} "
+              f"| handler errors {self.stats['handler_errors']}")
+        print(f"inference calls {inference_service.transport.calls} | clips played {played} "
+              f"| stale items skipped {dropped} | left in queues {self.queued_items()}")
+        for line in self.watchdog.summary_lines():
+            print(line)
+        print(f"enqueue -> playback ms: p50 {percentile(delays, 50):.0f} | p95 {percentile(delays, 95):.0f} "
+              f"| p99 {percentile(delays, 99):.0f} | max {max(delays):.0f} ({clip_count} clips)")
+        print(f"asyncio tasks: peak {max(self.task_counts, default=0)} | at end {len(asyncio.all_tasks())}")
+        if tracemalloc.is_tracing():
+            print(f"traced memory MB: baseline {baseline_mb:.1f} | end {final_mb:.1f} | peak {peak_mb:.1f} "
+                  f"| growth {final_mb - baseline_mb:+.1f}")
+        print(f"final load mode: {load_controller.controller.mode}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulate many guilds against main.py with fake Discord objects')
+    parser.add_argument('--guilds', type=int, default=100)
+    parser.add_argument('--members', type=int, default=5, help='Members per guild')
+    parser.add_argument('--message-rate', type=float, default=0.2, help='Messages per second per guild')
+    parser.add_argument('--voice-rate', type=float, default=0.02, help='Voice join/leave events per second per guild')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds of generated load')
+    parser.add_argument('--drain', type=float, default=30, help='Max seconds to wait for queues to empty afterwards')
+    parser.add_argument('--stub-latency', type=float, default=0.05, help='Seconds per stub inference call')
+    parser.add_argument('--playback-scale', type=float, default=1.0, help='Fake playback time per second of audio')
+    parser.add_argument('--report-interval', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='Skip tracemalloc (it slows everything down)')
+    asyncio.run(Simulation(parser.parse_args()).run())
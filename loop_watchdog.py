@@ -0,0 +1,125 @@
+# loop_watchdog.py
+import asyncio
+import collections
+import sys
+import threading
+import time
+import traceback
+
+import config # To access LOOP_WATCHDOG_* settings
+
+# --- Event-loop health watchdog ---
+# A heartbeat coroutine wakes up every `interval` and records how late it woke
+# (loop lag). A separate thread watches the heartbeat; when the loop has not
+# come back for longer than `threshold_ms`, it captures the loop thread's stack
+# with sys._current_frames() while the blocking call is still running, so the
+# report points at the code that blocked rather than at the next await.
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile of a non-empty list (shared by benchmark.py and load_test.py)."""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class LoopWatchdog:
+    """Measures loop lag continuously and reports blocking callbacks with their stack."""
+
+    def __init__(self, threshold_ms: float = 250.0, interval: float = 0.1, max_samples: int = 6000):
+        self.threshold_ms = threshold_ms
+        self.interval = interval
+        self.lags = collections.deque(maxlen=max_samples) # ms, one sample per heartbeat
+        self.stalls = collections.deque(maxlen=20) # {"at", "blocked_ms", "stack"}, newest last
+        self.stall_count = 0
+        self._last_beat = None
+        self._loop_thread_id = None
+        self._heartbeat_task = None
+        self._monitor_thread = None
+        self._stop = threading.Event()
+        self._current_stall = None
+
+    def start(self):
+        """Starts the heartbeat on the running loop and the monitor thread."""
+        if self._heartbeat_task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._heartbeat_task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._monitor_thread = threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True)
+        self._monitor_thread.start()
+        print(f"Event-loop watchdog started (threshold {self.threshold_ms:.0f} ms, interval {self.interval * 1000:.0f} ms).")
+
+    def stop(self):
+        self._stop.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.lags.append(max(0.0, (now - expected) * 1000))
+            self._last_beat = now
+
+    def _monitor(self):
+        while not self._stop.wait(self.interval / 2):
+            blocked_ms = (time.monotonic() - self._last_beat) * 1000 - self.interval * 1000
+            stall = self._current_stall
+            if blocked_ms >= self.threshold_ms:
+                if stall is None:
+                    self._current_stall = self._capture(blocked_ms)
+                else:
+                    stall["blocked_ms"] = blocked_ms
+            elif stall is not None:
+                # The loop is back; report the stall once, with its final duration
+                self._current_stall = None
+                print(f"Event loop was blocked for {stall['blocked_ms']:.0f} ms in:\n{stall['stack']}")
+
+    def _capture(self, blocked_ms: float) -> dict:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = "".join(traceback.format_stack(frame, limit=25)) if frame is not None else "(stack unavailable)\n"
+        stall = {"at": time.time(), "blocked_ms": blocked_ms, "stack": stack}
+        self.stalls.append(stall)
+        self.stall_count += 1
+        return stall
+
+    def percentiles(self) -> dict:
+        """Returns loop lag percentiles (ms) over the recent samples."""
+        if not self.lags:
+            return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0, "samples": 0}
+        ordered = sorted(self.lags)
+        return {
+            "p50": percentile(ordered, 50), "p95": percentile(ordered, 95),
+            "p99": percentile(ordered, 99), "max": ordered[-1], "samples": len(ordered)
+        }
+
+    def summary_lines(self) -> list:
+        """Report lines: lag percentiles and where the most recent stalls happened."""
+        stats = self.percentiles()
+        lines = [
+            f"loop lag ms ({stats['samples']} samples): p50 {stats['p50']:.1f} | p95 {stats['p95']:.1f} "
+            f"| p99 {stats['p99']:.1f} | max {stats['max']:.1f}",
+            f"blocked > {self.threshold_ms:.0f} ms: {self.stall_count} time(s)",
+        ]
+        for stall in list(self.stalls)[-3:]:
+            innermost = stall["stack"].strip().splitlines()[-2:] # "File ..., in func" + source line
+            lines.append(f"  {time.strftime('%H:%M:%S', time.localtime(stall['at']))} "
+                         f"{stall['blocked_ms']:.0f} ms: {' / '.join(line.strip() for line in innermost)}")
+        return lines
+
+
+# --- Module-level watchdog (started by start_watchdog) ---
+watchdog = None
+
+
+def start_watchdog(force: bool = False):
+    """Starts the watchdog on the running loop if LOOP_WATCHDOG is enabled (or `force`)."""
+    global watchdog
+    if watchdog is None and (config.LOOP_WATCHDOG or force):
+        watchdog = LoopWatchdog(config.LOOP_WATCHDOG_THRESHOLD_MS, config.LOOP_WATCHDOG_INTERVAL_MS / 1000)
+        watchdog.start()
+    return watchdog
@@ -2,6 +2,8 @@
 import discord
 from discord.ext import commands
 import asyncio
+import argparse
+import time
 import os # For getenv if DISCORD_TOKEN is not in config for some reason
 
 # --- Project specific imports ---
@@ -9,6 +11,14 @@ import config
 import tts_setup
 import tts_processing
 import bot_commands
+import tts_queue_store
+import inference_service
+import startup_cache
+import language_router
+import load_controller
+import tts_priority_queue
+import loop_watchdog
+import voice_sessions
 from style_bert_vits2.constants import Languages # For direct use in handle_tts_message
 
 # --- Bot Setup ---
@@ -16,28 +26,119 @@ intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True # Essential for on_voice_state_update
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+if config.BOT_SHARDED:
+    # Gateway shards only; inference can live in separate processes (see inference_service.py)
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents,
+                                  shard_count=config.SHARD_COUNT, shard_ids=config.SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents)
+voice_sessions.init_voice_sessions(bot.get_guild) # Playback looks up each guild's current voice client
 
 # --- Global state for queues (managed by guild ID) ---
-# These dictionaries will hold asyncio.Queue objects for each guild
-playback_queues = {} # For TTS generation tasks
+# These dictionaries will hold queue objects for each guild
+playback_queues = {} # For TTS generation tasks (tts_priority_queue.PriorityTTSQueue)
 play_queues = {}     # For audio playback tasks
 guild_tts_tasks = {} # To keep track of running queue processor tasks
+load_controller.controller.set_queue_depth_source(lambda: sum(q.qsize() for q in playback_queues.values()))
 
 def ensure_guild_queues_and_tasks(guild: discord.Guild):
     """Initializes queues and processing tasks for a guild if not already present."""
     guild_id = guild.id
     if guild_id not in playback_queues:
-        playback_queues[guild_id] = asyncio.Queue()
+        playback_queues[guild_id] = tts_priority_queue.PriorityTTSQueue(
+            aging_seconds=config.TTS_QUEUE_AGING_SECONDS,
+            stale_seconds=config.TTS_CHAT_STALE_SECONDS,
+            on_drop=tts_queue_store.complete_job # Skipped stale chat is not resumed later
+        )
         play_queues[guild_id] = asyncio.Queue()
         
         # Start processor tasks for this guild
         # Store tasks to potentially manage them later (e.g., on bot shutdown or guild leave)
-        gen_task = bot.loop.create_task(tts_processing.tts_queue_processor(guild_id, playback_queues, play_queues))
-        play_task = bot.loop.create_task(tts_processing.play_queue_processor(guild_id, play_queues))
+        gen_task = asyncio.create_task(tts_processing.tts_queue_processor(guild_id, playback_queues, play_queues))
+        play_task = asyncio.create_task(tts_processing.play_queue_processor(guild_id, play_queues))
         guild_tts_tasks[guild_id] = (gen_task, play_task)
         print(f"Initialized TTS queues and tasks for guild: {guild.name} ({guild_id})")
 
+def enqueue_tts(guild_id: int, text: str, language, model_name: str, params: dict = None,
+                runs: list = None, priority: int = tts_priority_queue.CHAT, group=None):
+    """Puts a TTS job on the guild's generation queue (and in the persistent store, if enabled).
+
+    Items sharing a `group` (from playback_queues[guild_id].new_group()) are spoken together, in order.
+    """
+    item = {
+        "text": text, "language": language,
+        "model_name": model_name, "params": params or {},
+        "priority": priority, "group": group, "enqueued_at": time.monotonic()
+    }
+    if runs:
+        item["runs"] = runs # Mixed-language text: [(run_text, language)], synthesized run by run
+    tts_queue_store.persist_job(guild_id, item)
+    playback_queues[guild_id].put_nowait(item)
+
+def enqueue_text(guild_id: int, text: str, model_lang_pref, model_name: str, params: dict = None,
+                 priority: int = tts_priority_queue.CHAT, group=None):
+    """Routes text to language runs (see language_router.py) and enqueues it."""
+    runs = language_router.route_language_runs(text, model_lang_pref)
+    if len(runs) == 1:
+        enqueue_tts(guild_id, text, runs[0][1], model_name, params, priority=priority, group=group)
+    else:
+        enqueue_tts(guild_id, text, language_router.dominant_language(runs), model_name, params, runs,
+                    priority=priority, group=group)
+
+def resolve_user_model(user_prefs: dict):
+    """Returns (model_name, model_language) for the user's preferred model, or the first available one."""
+    available_models = inference_service.transport.models
+    model_name = user_prefs.get("model")
+    if not model_name or model_name not in available_models:
+        if not available_models:
+            return None, None
+        model_name = next(iter(available_models)) # Default to first available
+    return model_name, available_models[model_name].get("language") # e.g. "JP"
+
+def resolve_synthesis(user_prefs: dict):
+    """Returns (model_name, model_language, synthesis params) for a user, adjusted to the current load mode."""
+    model_name, model_lang_pref = resolve_user_model(user_prefs)
+    if not model_name:
+        return None, None, {}
+    load_controller.controller.evaluate() # Recovers the mode even when inference is idle
+    load_settings = load_controller.controller.settings
+    light_model = load_settings["light_model"]
+    available_models = inference_service.transport.models
+    if light_model and light_model != model_name and light_model in available_models:
+        model_name, model_lang_pref = light_model, available_models[light_model].get("language")
+    params = tts_processing.build_synthesis_params(user_prefs, model_name)
+    return model_name, model_lang_pref, load_controller.apply_speed(params, load_settings["speed_multiplier"])
+
+async def resume_persisted_jobs(guild: discord.Guild):
+    """Re-hydrates jobs left in the persistent store once the guild has a voice connection."""
+    if tts_queue_store.job_store is None or guild.id not in playback_queues:
+        return
+    vc = guild.voice_client
+    for _ in range(50): # The voice handshake may still be in progress right after connecting
+        if vc and vc.is_connected():
+            break
+        await asyncio.sleep(0.1)
+        vc = guild.voice_client
+    else:
+        return
+
+    jobs = await tts_queue_store.job_store.load_pending(guild.id)
+    resumed = 0
+    for job in jobs:
+        if job["model_name"] not in inference_service.transport.models:
+            print(f"Dropping persisted TTS job {job['job_id']}: model '{job['model_name']}' is not loaded.")
+            tts_queue_store.job_store.complete(job["job_id"])
+            continue
+        language = Languages(job["language"]) if job["language"] else Languages.JP
+        playback_queues[guild.id].put_nowait({
+            "text": job["text"], "language": language,
+            "model_name": job["model_name"], "job_id": job["job_id"],
+            "params": job["payload"].get("params", {}), "runs": job["payload"].get("runs")
+        })
+        resumed += 1
+    if resumed:
+        print(f"Resumed {resumed} persisted TTS job(s) for guild: {guild.name} ({guild.id})")
+
 
 # --- Event Handlers ---
 @bot.event
@@ -45,15 +146,22 @@ async def on_ready():
     print(f'Logged in as {bot.user.name} ({bot.user.id})')
     print(f"Discord.py version: {discord.__version__}")
     print(f"Connected to {len(bot.guilds)} guild(s).")
+    loop_watchdog.start_watchdog() # Before model loading, so a blocking load is reported too
     
-    if not tts_setup.models: # Check if models are loaded
+    if not inference_service.transport.uses_local_models:
+        print("Inference runs out of process; skipping local model loading.")
+    elif not tts_setup.models: # Check if models are loaded
         print("TTS system not yet initialized. Initializing now...")
         tts_setup.initialize_tts_system() # Load BERT, VITS models, and JTalk dict
     else:
         print("TTS system already initialized.")
+    await inference_service.transport.refresh_models()
 
+    await tts_queue_store.init_job_store()
     for guild in bot.guilds:
         ensure_guild_queues_and_tasks(guild)
+        if guild.voice_client:
+            asyncio.create_task(resume_persisted_jobs(guild))
     print("Bot is ready and listening.")
 
 @bot.event
@@ -62,100 +170,138 @@ async def on_guild_join(guild: discord.Guild):
     print(f"Joined new guild: {guild.name} ({guild.id})")
     ensure_guild_queues_and_tasks(guild)
 
+# --- Voice channel index (per guild, name -> channel) ---
+# Looking channels up by name with discord.utils.get scans every voice channel
+# of the guild on every voice event; large guilds fire these constantly.
+guild_voice_channel_index = {}
+
+def get_voice_channel_by_name(guild: discord.Guild, name: str):
+    """Returns the guild's voice channel called `name`, using a cached index."""
+    if not name:
+        return None
+    index = guild_voice_channel_index.get(guild.id)
+    if index is None:
+        index = {}
+        for channel in guild.voice_channels:
+            index.setdefault(channel.name, channel) # Keep the first match, like discord.utils.get
+        guild_voice_channel_index[guild.id] = index
+    return index.get(name)
+
+def invalidate_voice_channel_index(guild: discord.Guild):
+    """Drops the cached channel index so it is rebuilt on next lookup."""
+    guild_voice_channel_index.pop(guild.id, None)
+
+@bot.event
+async def on_guild_channel_create(channel):
+    if isinstance(channel, discord.VoiceChannel):
+        invalidate_voice_channel_index(channel.guild)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    if isinstance(channel, discord.VoiceChannel):
+        invalidate_voice_channel_index(channel.guild)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    if isinstance(after, discord.VoiceChannel) and before.name != after.name:
+        invalidate_voice_channel_index(after.guild)
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    invalidate_voice_channel_index(guild)
+
 @bot.event
 async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
-    if member.id == bot.user.id: # Ignore bot's own state changes
+    if bot.user is not None and member.id == bot.user.id: # Ignore bot's own state changes
+        voice_sessions.handle_bot_voice_state(member.guild, before, after) # Tracks intentional vs external disconnects
+        if after.channel and not before.channel: # Bot (re)connected: pick up persisted jobs
+            asyncio.create_task(resume_persisted_jobs(member.guild))
         return
 
     voice_client = member.guild.voice_client
     guild = member.guild
-    
-    designated_channel = discord.utils.get(guild.voice_channels, name=config.AUTO_JOIN_VC_NAME)
-    if not designated_channel: # discord.utils.get for voice_channels already ensures it's a VoiceChannel
-        print(f"DEBUG: Voice channel named '{config.AUTO_JOIN_VC_NAME}' not found in guild {guild.name}.")
-    
-    # User leaves a voice channel the bot is in
-    if before.channel and not after.channel: # User disconnected from a channel
 
-        if before.channel.members.__len__() == 0:  # If no members left in the channel
-            server_info = config.load_json_file(config.SERVER_INFO_JSON_PATH, {})
-            server_id = str(guild.id)
-            if server_id not in server_info:
-                server_info[server_id] = {}
-            server_info[server_id]["auto_join"] = True # Set auto-join to True
-            server_info[server_id]["talking"] = True # Set talking to True
-            config.save_json_file(config.SERVER_INFO_JSON_PATH, server_info)
+    # User left a channel and it is now empty: re-arm auto-join for the server.
+    # This must run before the fast path so `!leave` is reset the same way as before.
+    if before.channel and not after.channel and not before.channel.members:
+        server_info = config.load_json_file(config.SERVER_INFO_JSON_PATH, {})
+        server_id = str(guild.id)
+        if server_id not in server_info:
+            server_info[server_id] = {}
+        server_info[server_id]["auto_join"] = True # Set auto-join to True
+        server_info[server_id]["talking"] = True # Set talking to True
+        config.save_json_file(config.SERVER_INFO_JSON_PATH, server_info)
+
+    # --- Fast path: ignore events that touch neither the bot's channel nor the auto-join channel ---
+    designated_channel = get_voice_channel_by_name(guild, config.AUTO_JOIN_VC_NAME)
+    bot_channel = voice_client.channel if voice_client else None
+    relevant_channel_ids = {c.id for c in (bot_channel, designated_channel) if c is not None}
+    if not ((before.channel and before.channel.id in relevant_channel_ids) or
+            (after.channel and after.channel.id in relevant_channel_ids)):
+        return
 
+    # Someone (re)joined the bot's channel: keep a lingering connection
+    if voice_client and after.channel == voice_client.channel and before.channel != after.channel:
+        voice_sessions.cancel_disconnect(guild.id)
+
+    # User leaves a voice channel the bot is in
+    if before.channel and not after.channel: # User disconnected from a channel
         if voice_client and voice_client.channel == before.channel:
             # Check if bot is alone in the channel
             # Non-bot members in the channel:
-            human_members = [m for m in before.channel.members if not m.bot]
-            if not human_members: # If list is empty, bot is alone
-                print(f"Last user left {before.channel.name}. Disconnecting bot.")
-                await voice_client.disconnect()
+            if not any(not m.bot for m in before.channel.members): # Bot is alone
+                print(f"Last user left {before.channel.name}. Disconnecting bot (linger {config.VOICE_LINGER_SECONDS:.0f}s).")
+                await voice_sessions.release(guild)
                 # Note: Queues and tasks for this guild are not stopped/cleared here.
                 # They will persist and resume if the bot rejoins a VC.
                 # If you want to clear/stop them, that logic would go here.
+                return
 
-    auto_joined = config.load_json_file(config.SERVER_INFO_JSON_PATH, {}).get(str(guild.id), {}).get("auto_join", True) == True
+    # Load server settings once per event (auto_join and talking live in the same file)
+    server_settings = config.load_json_file(config.SERVER_INFO_JSON_PATH, {}).get(str(guild.id), {})
+    auto_joined = server_settings.get("auto_join", True) == True
     # Auto-join logic (optional, can be complex to get right)
     # This is a very simple auto-join if a user enters a channel and the bot is not connected.
     # Consider making this configurable or command-driven.
-    if auto_joined:
+    if auto_joined and designated_channel:
         if after.channel and not voice_client:  # User joined a channel, bot is not in any VC
             if after.channel.id == designated_channel.id and isinstance(after.channel, discord.VoiceChannel) and any(not m.bot for m in after.channel.members):
                 try:
                     print(f"User {member.display_name} joined {after.channel.name}. Bot auto-joining.")
-                    await after.channel.connect()
-                except discord.ClientException as e:
+                    await voice_sessions.connect(after.channel)
+                except (discord.ClientException, asyncio.TimeoutError) as e:
                     print(f"Error auto-joining voice channel: {e}")
 
     vc = member.guild.voice_client
-    if not tts_setup.models:
+    if not vc or vc.channel not in (before.channel, after.channel): # Announce only for the bot's channel
+        return
+    if not inference_service.transport.models:
         print("TTS models not loaded, cannot process TTS message.")
         return
     user_prefs = config.load_json_file(config.USER_INFO_JSON_PATH, {}).get(str(member.id), {})
     member_name = user_prefs.get("nickname", member.display_name)
     # Determine model for the user
-    model_name = user_prefs.get("model")
-    if not model_name or model_name not in tts_setup.models:
-        available_models = tts_setup.get_available_model_names()
-        if available_models:
-            model_name = available_models[0] # Default to first available
-        else:
-            print("No TTS models available to process message.")
-            return
-
-    selected_model_data = tts_setup.models[model_name]
-    tts_model_instance = selected_model_data["model"]
-    model_lang_pref = selected_model_data.get("language") # e.g. "JP"
-
-    is_talking = config.load_json_file(config.SERVER_INFO_JSON_PATH, {}).get(str(member.guild.id), {}).get("talking", True)
-    if is_talking and vc:
+    model_name, model_lang_pref, synthesis_params = resolve_synthesis(user_prefs)
+    if not model_name:
+        print("No TTS models available to process message.")
+        return
+
+    is_talking = server_settings.get("talking", True)
+    if is_talking:
+        # Announcements are SYSTEM priority: they go ahead of queued chat
+        group = playback_queues[member.guild.id].new_group()
         if before.channel is None and after.channel is not None:
-            lang_for_name = await tts_processing.determine_language_for_tts(member_name, model_lang_pref)
-            playback_queues[member.guild.id].put_nowait({
-                "text": member_name, "language": lang_for_name,
-                "voice_client": vc, "model_instance": tts_model_instance
-            })
+            enqueue_text(member.guild.id, member_name, model_lang_pref, model_name, synthesis_params,
+                         tts_priority_queue.NAME, group)
             segment = "が入室しました。"
-            lang_for_segment = await tts_processing.determine_language_for_tts(segment, model_lang_pref)
-            playback_queues[member.guild.id].put_nowait({
-                "text": segment, "language": lang_for_segment,
-                "voice_client": vc, "model_instance": tts_model_instance
-            })
+            enqueue_text(member.guild.id, segment, model_lang_pref, model_name, synthesis_params,
+                         tts_priority_queue.SYSTEM, group)
         elif before.channel is not None and after.channel is None:
-            lang_for_name = await tts_processing.determine_language_for_tts(member_name, model_lang_pref)
-            playback_queues[member.guild.id].put_nowait({
-                "text": member_name, "language": lang_for_name,
-                "voice_client": vc, "model_instance": tts_model_instance
-            })
+            enqueue_text(member.guild.id, member_name, model_lang_pref, model_name, synthesis_params,
+                         tts_priority_queue.NAME, group)
             segment = "が退室しました。"
-            lang_for_segment = await tts_processing.determine_language_for_tts(segment, model_lang_pref)
-            playback_queues[member.guild.id].put_nowait({
-                "text": segment, "language": lang_for_segment,
-                "voice_client": vc, "model_instance": tts_model_instance
-            })
+            enqueue_text(member.guild.id, segment, model_lang_pref, model_name, synthesis_params,
+                         tts_priority_queue.SYSTEM, group)
 
 
 @bot.event
@@ -189,35 +335,28 @@ async def handle_tts_submission(message: discord.Message, text_content: str):
         # await message.channel.send("ボイスチャンネルに接続していません。", delete_after=10)
         return
 
-    if not tts_setup.models:
+    if not inference_service.transport.models:
         print("TTS models not loaded, cannot process TTS message.")
         return
 
     user_prefs = config.load_json_file(config.USER_INFO_JSON_PATH, {}).get(str(message.author.id), {})
     
     # Determine model for the user
-    model_name = user_prefs.get("model")
-    if not model_name or model_name not in tts_setup.models:
-        available_models = tts_setup.get_available_model_names()
-        if available_models:
-            model_name = available_models[0] # Default to first available
-        else:
-            print("No TTS models available to process message.")
-            return
-
-    selected_model_data = tts_setup.models[model_name]
-    tts_model_instance = selected_model_data["model"]
-    model_lang_pref = selected_model_data.get("language", None) # e.g. "JP"
+    model_name, model_lang_pref, synthesis_params = resolve_synthesis(user_prefs)
+    if not model_name:
+        print("No TTS models available to process message.")
+        return
+    text_content = tts_processing.normalize_discord_text(text_content, message)
+    load_settings = load_controller.controller.settings
+    max_chars = load_settings["max_chars"] # 140 normally, less under load
+    group = playback_queues[message.guild.id].new_group() # Name + segments are read as one unit
 
     # Read user's name?
-    if user_prefs.get("call", True): # Default to true if not set
+    if user_prefs.get("call", True) and load_settings["read_names"]: # Default to true if not set
         author_name = user_prefs.get("nickname", message.author.display_name)
         
-        lang_for_name = await tts_processing.determine_language_for_tts(author_name, model_lang_pref)
-        playback_queues[message.guild.id].put_nowait({
-            "text": author_name, "language": lang_for_name,
-            "voice_client": vc, "model_instance": tts_model_instance
-        })
+        enqueue_text(message.guild.id, author_name, model_lang_pref, model_name, synthesis_params,
+                     tts_priority_queue.NAME, group)
 
     # Process message content: URL, length limits, splitting
     is_url = "http://" in text_content or "https://" in text_content
@@ -231,8 +370,8 @@ async def handle_tts_submission(message: discord.Message, text_content: str):
     else:
         remaining_text = text_content
         
-        # --- Truncation (Overall 140 chars limit) ---
-        if len(remaining_text) > 140:
+        # --- Truncation (Overall max_chars limit) ---
+        if len(remaining_text) > max_chars:
             # Find a good cut point around 100-140 for truncation
             # This truncation happens *before* further splitting.
             # If you want splitting first, then truncation of the total, the logic would differ.
@@ -240,20 +379,20 @@ async def handle_tts_submission(message: discord.Message, text_content: str):
             trunc_cut_point = -1
             # Prefer sentence/clause enders for truncation
             for sep in ['。', '。', '\n', '.', '!', '?', '、', ',', ' ','　']: # Added more separators
-                # Search in a reasonable range from the end of 140 chars, e.g., 100-140
-                idx = remaining_text.rfind(sep, 100, 140) 
+                # Search in a reasonable range from the end of max_chars, e.g., 100-140
+                idx = remaining_text.rfind(sep, max_chars - 40, max_chars) 
                 if idx != -1:
                     # Ensure we take the separator as well if it makes sense
                     trunc_cut_point = max(trunc_cut_point, idx + len(sep)) 
             
-            if trunc_cut_point == -1 and len(remaining_text) > 140: # Force cut if no good separator
-                trunc_cut_point = 140
+            if trunc_cut_point == -1 and len(remaining_text) > max_chars: # Force cut if no good separator
+                trunc_cut_point = max_chars
             
             if trunc_cut_point > 0 and trunc_cut_point < len(remaining_text):
                 remaining_text = remaining_text[:trunc_cut_point].strip()
                 is_omitted = True
-            elif len(remaining_text) > 140: # If rfind didn't find anything or cut point is too large
-                remaining_text = remaining_text[:140].strip()
+            elif len(remaining_text) > max_chars: # If rfind didn't find anything or cut point is too large
+                remaining_text = remaining_text[:max_chars].strip()
                 is_omitted = True
 
 
@@ -304,22 +443,25 @@ async def handle_tts_submission(message: discord.Message, text_content: str):
     # Add segments to queue
     for segment in segments_to_say:
         if not segment: continue # Should be caught by filter above, but good to double check
-        lang_for_segment = await tts_processing.determine_language_for_tts(segment, model_lang_pref)
-        playback_queues[message.guild.id].put_nowait({
-            "text": segment, "language": lang_for_segment,
-            "voice_client": vc, "model_instance": tts_model_instance
-        })
+        enqueue_text(message.guild.id, segment, model_lang_pref, model_name, synthesis_params, group=group)
 
     if is_omitted:
-        playback_queues[message.guild.id].put_nowait({
-            "text": "以下略", "language": Languages.JP,
-            "voice_client": vc, "model_instance": tts_model_instance
-        })
+        enqueue_tts(message.guild.id, "以下略", Languages.JP, model_name, synthesis_params, group=group)
 
 
 # --- Bot Run ---
 if __name__ == "__main__":
-    if not config.DISCORD_TOKEN:
+    parser = argparse.ArgumentParser(description='Style-Bert-VITS2 Discord TTS bot')
+    parser.add_argument(
+        '--profile-startup',
+        help='Report import and load time per module and startup step, then exit',
+        action='store_true'
+    )
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        startup_cache.profile_startup()
+    elif not config.DISCORD_TOKEN:
         print("Error: DISCORD_TOKEN environment variable not set or found in config.")
     else:
         try:
@@ -329,11 +471,14 @@ if __name__ == "__main__":
             # to appear online sooner.
             # tts_setup.initialize_tts_system() # Alternative: load models before connecting
             
+            inference_service.init_transport()
             print("Starting bot...")
-            bot.run(config.DISCORD_TOKEN)
+            bot.run(config.DISCORD_TOKEN) # Returns once the bot has closed (e.g. Ctrl+C)
         except discord.PrivilegedIntentsRequired:
             print("Error: Privileged intents (Message Content, Voice States) are not enabled for the bot in the Discord Developer Portal.")
         except Exception as e:
             print(f"An error occurred while running the bot: {e}")
             import traceback
-            traceback.print_exc()
\ No newline at end of file
+            traceback.print_exc()
+        finally:
+            tts_queue_store.close_job_store() # Flush persisted jobs before exiting
@@ -0,0 +1,157 @@
+# shared_weights.py
+import gc
+import json
+import struct
+from pathlib import Path
+
+import numpy as np
+
+# --- Memory-mapped model weights ---
+# With TTS_WEIGHTS_MMAP=true, CPU models point their parameters straight at the
+# .safetensors file (copy-on-write mmap) instead of private copies. Every process
+# on the host that maps the same file shares the page cache; only pages a process
+# writes to become private. Style vectors are memory-mapped by startup_cache.
+
+# safetensors dtype -> (numpy dtype with the same layout, torch dtype name to view as)
+_SAFETENSORS_DTYPES = {
+    "F64": (np.float64, None), "F32": (np.float32, None), "F16": (np.float16, None),
+    "BF16": (np.uint16, "bfloat16"), # numpy has no bfloat16; reinterpret the bits in torch
+    "I64": (np.int64, None), "I32": (np.int32, None), "I16": (np.int16, None),
+    "I8": (np.int8, None), "U8": (np.uint8, None), "BOOL": (np.bool_, None),
+}
+
+mapped_weight_bytes = {} # str(model_path) -> bytes of parameters backed by the mmap
+
+
+def load_mmap_state_dict(path: Path) -> dict:
+    """Returns {name: tensor} whose storage is a copy-on-write mmap of the safetensors file."""
+    import torch
+
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    data_start = 8 + header_len
+    file_map = np.memmap(path, dtype=np.uint8, mode="c")
+
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        np_dtype, torch_dtype_name = _SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        array = file_map[data_start + start:data_start + end].view(np_dtype).reshape(info["shape"])
+        tensor = torch.from_numpy(array)
+        if torch_dtype_name:
+            tensor = tensor.view(getattr(torch, torch_dtype_name))
+        tensors[name] = tensor
+    return tensors
+
+
+def share_model_weights(tts_model) -> int:
+    """Re-points a loaded CPU model's parameters at its mmap'd safetensors file.
+
+    Tensors whose dtype or shape differ from the model's (e.g. fp16 checkpoints loaded
+    into an fp32 model) keep their private copy. Returns the number of bytes shared.
+    """
+    if tts_model.device != "cpu":
+        print(f"Skipping mmap weights for {tts_model.model_path}: weights live on {tts_model.device}.")
+        return 0
+    if not str(tts_model.model_path).endswith(".safetensors"):
+        print(f"Skipping mmap weights for {tts_model.model_path}: not a .safetensors file.")
+        return 0
+
+    net_g = getattr(tts_model, "_TTSModel__net_g", None) # TTSModel keeps the network private
+    if net_g is None:
+        tts_model.load()
+        net_g = getattr(tts_model, "_TTSModel__net_g")
+
+    mapped = load_mmap_state_dict(Path(tts_model.model_path))
+    current = net_g.state_dict()
+    assignable = {
+        name: tensor for name, tensor in mapped.items()
+        if name in current and current[name].dtype == tensor.dtype and current[name].shape == tensor.shape
+    }
+    net_g.load_state_dict(assignable, strict=False, assign=True)
+    del current
+    gc.collect() # Release the private copies that were just replaced
+
+    shared_bytes = sum(t.numel() * t.element_size() for t in assignable.values())
+    mapped_weight_bytes[str(tts_model.model_path)] = shared_bytes
+    return shared_bytes
+
+
+# --- Memory diagnostics (!get memory) ---
+def _read_smaps(smaps_path: str = "/proc/self/smaps") -> dict:
+    """Returns {mapped file path: {"Rss", "Shared", "Private"} in kB} for the current process."""
+    usage = {}
+    current_path = None
+    with open(smaps_path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if not fields[0].endswith(":"): # Mapping header: address perms offset dev inode [path]
+                current_path = " ".join(fields[5:]) if len(fields) > 5 else None
+                continue
+            if current_path is None:
+                continue
+            key = fields[0][:-1]
+            if key == "Rss":
+                bucket = "Rss"
+            elif key in ("Shared_Clean", "Shared_Dirty"):
+                bucket = "Shared"
+            elif key in ("Private_Clean", "Private_Dirty"):
+                bucket = "Private"
+            else:
+                continue
+            entry = usage.setdefault(current_path, {"Rss": 0, "Shared": 0, "Private": 0})
+            entry[bucket] += int(fields[1])
+    return usage
+
+
+def _read_status(status_path: str = "/proc/self/status") -> dict:
+    """Returns VmRSS/RssAnon/RssFile (kB) for the current process."""
+    status = {}
+    with open(status_path, "r", encoding="utf-8") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "RssAnon", "RssFile", "RssShmem"):
+                status[key] = int(value.split()[0])
+    return status
+
+
+def memory_report(models: dict) -> list:
+    """Builds report lines of resident vs. shared memory per loaded model (Linux only)."""
+    try:
+        smaps = _read_smaps()
+        status = _read_status()
+    except OSError:
+        return ["Memory diagnostics need /proc (Linux)."]
+
+    lines = [
+        f"process: rss {status.get('VmRSS', 0) / 1024:.1f} MB "
+        f"(anon {status.get('RssAnon', 0) / 1024:.1f} MB, file-backed {status.get('RssFile', 0) / 1024:.1f} MB)"
+    ]
+    for model_name, model_data in models.items():
+        tts_model = model_data["model"]
+        net_g = getattr(tts_model, "_TTSModel__net_g", None)
+        param_bytes = sum(t.numel() * t.element_size() for t in net_g.state_dict().values()) if net_g is not None else 0
+        shared_bytes = mapped_weight_bytes.get(str(tts_model.model_path), 0)
+
+        rss_kb = shared_kb = private_kb = 0
+        for path in model_data.get("paths", {}).values():
+            entry = smaps.get(str(Path(path).resolve()))
+            if entry:
+                rss_kb += entry["Rss"]
+                shared_kb += entry["Shared"]
+                private_kb += entry["Private"]
+
+        if net_g is None:
+            weights = "weights not loaded yet"
+        else:
+            weights = f"weights {param_bytes / 2**20:.1f} MB on {tts_model.device}, {shared_bytes / 2**20:.1f} MB mmap-backed"
+        lines.append(
+            f"{model_name}: {weights}; mapped files rss {rss_kb / 1024:.1f} MB "
+            f"(shared {shared_kb / 1024:.1f} MB, private {private_kb / 1024:.1f} MB)"
+        )
+    return lines
@@ -0,0 +1,196 @@
+# startup_cache.py
+import os
+import pickle
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+import config # To access STARTUP_CACHE_DIR, ROOT_DIR
+
+# --- Prebuilt startup snapshot ---
+# Keeps what can be reused between restarts under STARTUP_CACHE_DIR:
+# - snapshot.pkl: parsed model configs (HyperParameters), keyed by file path and
+#   invalidated when the file's mtime or size changes
+# - tokenizers/<language>/: BERT tokenizers saved locally, so they load without
+#   resolving the Hugging Face hub
+# Style vectors are not copied; they are memory-mapped straight from model_assets.
+
+SNAPSHOT_VERSION = 1
+
+
+def _snapshot_path():
+    return Path(config.STARTUP_CACHE_DIR) / "snapshot.pkl" if config.STARTUP_CACHE_DIR else None
+
+
+def _fingerprint(path: Path) -> tuple:
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def load_snapshot() -> dict:
+    """Returns the cached snapshot, or an empty one if missing, stale or disabled."""
+    from style_bert_vits2.constants import VERSION as SBV2_VERSION
+
+    empty = {"version": SNAPSHOT_VERSION, "sbv2_version": SBV2_VERSION, "hyper_parameters": {}, "dirty": False}
+    path = _snapshot_path()
+    if path is None or not path.exists():
+        return empty
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except Exception as e:
+        print(f"Ignoring unreadable startup snapshot {path}: {e}")
+        return empty
+    if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("sbv2_version") != SBV2_VERSION:
+        return empty
+    snapshot["dirty"] = False
+    return snapshot
+
+
+def save_snapshot(snapshot: dict):
+    """Writes the snapshot if anything changed since it was loaded."""
+    path = _snapshot_path()
+    if path is None or not snapshot.get("dirty"):
+        return
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump({k: v for k, v in snapshot.items() if k != "dirty"}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path) # Atomic, so a crash never leaves a half-written snapshot
+        snapshot["dirty"] = False
+    except OSError as e:
+        print(f"Error saving startup snapshot to {path}: {e}")
+
+
+def get_hyper_parameters(snapshot: dict, config_path: Path):
+    """Returns the model's HyperParameters, parsing config.json only when it changed."""
+    key = str(config_path)
+    fingerprint = _fingerprint(config_path)
+    cached = snapshot["hyper_parameters"].get(key)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+
+    from style_bert_vits2.models.hyper_parameters import HyperParameters
+
+    hyper_parameters = HyperParameters.load_from_json(config_path)
+    snapshot["hyper_parameters"][key] = (fingerprint, hyper_parameters)
+    snapshot["dirty"] = True
+    return hyper_parameters
+
+
+def load_style_vectors(style_vec_path: Path) -> np.ndarray:
+    """Memory-maps style vectors read-only instead of copying them into process memory."""
+    return np.load(style_vec_path, mmap_mode="r")
+
+
+def tokenizer_dir(language) -> Path:
+    return Path(config.STARTUP_CACHE_DIR) / "tokenizers" / str(language) if config.STARTUP_CACHE_DIR else None
+
+
+def cached_tokenizer_path(language, default: str) -> str:
+    """Returns the locally saved tokenizer for `language` if there is one, else `default`."""
+    path = tokenizer_dir(language)
+    if path is not None and (path / "tokenizer_config.json").exists():
+        return str(path)
+    return default
+
+
+def save_tokenizer(language):
+    """Saves the loaded tokenizer for `language` so the next start can skip the hub lookup."""
+    from style_bert_vits2.nlp import bert_models
+
+    path = tokenizer_dir(language)
+    if path is None or (path / "tokenizer_config.json").exists():
+        return
+    try:
+        bert_models.load_tokenizer(language).save_pretrained(str(path))
+    except Exception as e:
+        print(f"Could not save {language} tokenizer to startup cache: {e}")
+
+
+# --- Startup profiling (main.py --profile-startup) ---
+# Modules that should only be imported on first use, not when main.py is imported
+LAZY_HEAVY_MODULES = [
+    "torch",
+    "transformers",
+    "nltk",
+    "style_bert_vits2.tts_model",
+    "style_bert_vits2.nlp.bert_models",
+    "style_bert_vits2.nlp.japanese.user_dict",
+]
+
+_IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def _profile_main_imports():
+    """Imports main.py in a fresh interpreter with -X importtime.
+
+    Returns ([(module, cumulative ms)] for modules imported directly by main, total ms).
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=str(config.ROOT_DIR), capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        print(f"Importing main.py failed:\n{result.stderr[-2000:]}")
+    # Children are printed before their parent, so collect one-level-nested lines
+    # until the next top-level line; if that line is `main`, they were main's imports.
+    children = []
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        indent, module_name, cumulative_ms = len(match.group(3)), match.group(4), int(match.group(2)) / 1000
+        if indent == 1:
+            if module_name == "main":
+                return children, cumulative_ms
+            children = []
+        elif indent == 3:
+            children.append((module_name, cumulative_ms))
+    return [], 0.0
+
+
+def _timed(label: str, func, results: list):
+    start = time.perf_counter()
+    value = func()
+    results.append((label, (time.perf_counter() - start) * 1000))
+    return value
+
+
+def profile_startup():
+    """Prints import time per module and load time per startup step."""
+    import importlib
+    import tts_setup
+    import device_manager
+
+    print("=== Imports triggered by `import main` (cumulative, fresh interpreter) ===")
+    main_imports, total_ms = _profile_main_imports()
+    for module_name, ms in sorted(main_imports, key=lambda item: item[1], reverse=True):
+        print(f"{module_name:<50} {ms:10.1f} ms")
+    print(f"{'total (import main)':<50} {total_ms:10.1f} ms")
+
+    print("\n=== Deferred imports (loaded on first use) ===")
+    import_results = []
+    for module_name in LAZY_HEAVY_MODULES:
+        if module_name in sys.modules:
+            import_results.append((f"{module_name} (already imported)", 0.0))
+            continue
+        _timed(module_name, lambda: importlib.import_module(module_name), import_results)
+    for label, ms in import_results:
+        print(f"{label:<50} {ms:10.1f} ms")
+
+    print("\n=== Load steps ===")
+    load_results = []
+    _timed("nltk tagger check", config.ensure_nltk_tagger, load_results)
+    _timed("device discovery", device_manager.init_devices, load_results)
+    _timed("BERT models + tokenizers", tts_setup.load_all_bert_models, load_results)
+    _timed("TTS models (total)", tts_setup.load_tts_models, load_results)
+    for model_name, ms in tts_setup.model_load_times.items():
+        load_results.append((f"  {model_name}", ms))
+    for label, ms in load_results:
+        print(f"{label:<50} {ms:10.1f} ms")
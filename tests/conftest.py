@@ -0,0 +1,44 @@
+# tests/conftest.py
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent)) # Modules live at the repository root
+
+
+class FakeChannel:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+
+class FakeAuthor:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.bot = False
+
+
+class FakeMessage:
+    def __init__(self, user_id: int = 1):
+        self.author = FakeAuthor(user_id)
+        self.channel = FakeChannel()
+
+
+@pytest.fixture
+def run():
+    """Runs a coroutine to completion on a fresh event loop."""
+    return asyncio.run
+
+
+@pytest.fixture
+def user_info(tmp_path, monkeypatch):
+    """Points USER_INFO_JSON at a temporary file; returns a loader for its contents."""
+    import config
+
+    path = tmp_path / "user_info.json"
+    monkeypatch.setattr(config, "USER_INFO_JSON_PATH", str(path))
+    return lambda: config.load_json_file(str(path), {})
@@ -0,0 +1,106 @@
+# tests/test_device_manager.py
+import pytest
+
+import config
+import device_manager
+
+MB = 2**20
+
+
+@pytest.fixture
+def gpus(monkeypatch):
+    """Two simulated GPUs (8 GB, 4 GB) and a CPU with a 16 GB budget."""
+    monkeypatch.setattr(config, "DEVICE_MEMORY_FRACTION", 1.0)
+    monkeypatch.setattr(config, "DEVICE_CACHE_PRESSURE", 0.85)
+    monkeypatch.setattr(device_manager, "devices", [])
+    monkeypatch.setattr(device_manager, "placements", {})
+    device_manager.init_devices("cuda:0=8192,cuda:1=4096")
+    device_manager.get_device("cpu").budget_bytes = 16384 * MB
+    return device_manager
+
+
+def test_parse_simulated_devices():
+    parsed = device_manager.parse_simulated_devices("cuda:0=8192, cuda:1=4096")
+    assert [(device.name, device.total_bytes) for device in parsed] == [("cuda:0", 8192 * MB), ("cuda:1", 4096 * MB)]
+    assert all(device.simulated and device.is_gpu and device.torch_device == "cpu" for device in parsed)
+
+
+def test_parse_simulated_devices_numbers_bare_cuda():
+    parsed = device_manager.parse_simulated_devices("cuda=1024,cuda=512,")
+    assert [device.name for device in parsed] == ["cuda:0", "cuda:1"]
+
+
+@pytest.mark.parametrize("spec", ["cuda:0", "gpu0=1024", "cuda:0=", "cuda:0=lots"])
+def test_parse_simulated_devices_rejects_malformed_entries(spec):
+    with pytest.raises(ValueError):
+        device_manager.parse_simulated_devices(spec)
+
+
+def test_auto_placement_uses_gpu_with_most_budget_left(gpus):
+    assert gpus.place("a", 3000 * MB).name == "cuda:0"
+    assert gpus.place("b", 3000 * MB).name == "cuda:0" # 5192 MB left beats 4096 MB
+    assert gpus.place("c", 3000 * MB).name == "cuda:1"
+    assert gpus.placements["c"] is gpus.get_device("cuda:1")
+
+
+def test_auto_placement_falls_back_to_cpu(gpus):
+    assert gpus.place("huge", 9000 * MB).name == "cpu"
+
+
+def test_pinned_placement(gpus):
+    assert gpus.place("a", 1000 * MB, "cuda:1").name == "cuda:1"
+    assert gpus.place("b", 1000 * MB, "cuda").name == "cuda:0"
+    assert gpus.place("c", 1000 * MB, "cpu").name == "cpu"
+
+
+def test_full_pinned_device_falls_back_to_auto(gpus):
+    gpus.place("a", 4000 * MB, "cuda:1")
+    assert gpus.place("b", 1000 * MB, "cuda:1").name == "cuda:0"
+
+
+def test_missing_pinned_device_falls_back_to_auto(gpus):
+    assert gpus.place("a", 1000 * MB, "cuda:7").name == "cuda:0"
+
+
+def test_cache_is_kept_below_pressure(gpus):
+    device = gpus.place("a", 6144 * MB, "cuda:0")
+    # Resident weights are not pressure: 6 GB of 8 GB allocated, nothing cached
+    assert device.allocated_bytes() == device.reserved_bytes() == 6144 * MB
+    assert not gpus.relieve_pressure(device)
+    gpus.after_inference(device)
+    assert device.reserved_bytes() - device.allocated_bytes() == device_manager.SIMULATED_CACHE_GROWTH
+    assert device.cache_empties == 0
+
+
+def test_cache_is_emptied_once_it_fills_the_headroom(gpus):
+    device = gpus.place("a", 6144 * MB, "cuda:0") # 2 GB headroom, 256 MB cached per inference
+    for _ in range(6):
+        gpus.after_inference(device)
+    assert device.cache_empties == 0 # 1536 MB cached
+    gpus.after_inference(device) # 1792 MB cached > 85% of 2048 MB
+    assert device.cache_empties == 1
+    assert device.reserved_bytes() == device.allocated_bytes()
+
+
+def test_forced_relief_and_cpu_placements(gpus):
+    device = gpus.place("a", 1000 * MB, "cuda:0")
+    assert gpus.relieve_pressure(device, force=True)
+    assert device.cache_empties == 1
+    cpu = gpus.place("b", 1000 * MB, "cpu")
+    gpus.after_inference(cpu)
+    assert not gpus.relieve_pressure(cpu, force=True)
+    gpus.after_inference(None)
+
+
+def test_oom_retry_empties_the_placed_device(gpus):
+    device = gpus.place("a", 1000 * MB, "cuda:0")
+    calls = []
+
+    def infer():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 20.00 MiB")
+        return "audio"
+
+    assert gpus.run_with_oom_retry(infer, device) == "audio"
+    assert device.cache_empties == 1
@@ -0,0 +1,70 @@
+# tests/test_g2p_cache.py
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import config
+import inference_service
+import tts_processing
+
+
+@pytest.fixture
+def jtalk(monkeypatch):
+    """A fake pyopenjtalk: clean_text reads `compiled`, which a dictionary reload copies from `csv`."""
+    state = {"csv": {"ＡＢＣ": "エービーシー"}, "compiled": {}, "calls": 0}
+
+    def clean_text(text, language, *args, **kwargs):
+        state["calls"] += 1
+        reading = state["compiled"].get(text, text)
+        return reading, list(reading), [0] * len(reading), [1] * len(reading)
+
+    def compile_user_dictionary():
+        state["compiled"] = dict(state["csv"])
+
+    monkeypatch.setattr(config, "G2P_CACHE_SIZE", 16)
+    monkeypatch.setattr(config, "INFERENCE_SERVER_TOKEN", "secret")
+    monkeypatch.setattr(tts_processing, "_original_clean_text", clean_text)
+    monkeypatch.setattr(tts_processing, "_compile_user_dictionary", compile_user_dictionary)
+    monkeypatch.setattr(inference_service, "transport", inference_service.LocalInferenceTransport())
+    compile_user_dictionary()
+    tts_processing.clear_text_caches()
+    yield state
+    tts_processing.clear_text_caches()
+
+
+def _reading(text: str) -> str:
+    return tts_processing._cached_clean_text(text, "JP")[0]
+
+
+async def _reload_on_server():
+    async with TestClient(TestServer(inference_service.create_app())) as client:
+        resp = await client.post("/dictionary/reload", headers={"Authorization": "Bearer secret"})
+        assert resp.status == 200
+
+
+def test_cached_reading_is_reused(jtalk):
+    assert _reading("ＡＢＣ") == "エービーシー"
+    assert _reading("ＡＢＣ") == "エービーシー"
+    assert jtalk["calls"] == 1
+
+
+def test_dictionary_edit_changes_the_cached_reading(run, jtalk):
+    assert _reading("ＡＢＣ") == "エービーシー"
+    jtalk["csv"]["ＡＢＣ"] = "アベック" # !set dict on a shard rewrites the CSV...
+    assert _reading("ＡＢＣ") == "エービーシー" # ...which the server does not see until it reloads
+    run(_reload_on_server())
+    assert _reading("ＡＢＣ") == "アベック"
+
+
+def test_result_computed_across_a_reload_is_not_cached(jtalk, monkeypatch):
+    original = tts_processing._original_clean_text
+
+    def clean_text_racing_a_reload(text, language, *args, **kwargs):
+        result = original(text, language, *args, **kwargs)
+        jtalk["compiled"]["ＡＢＣ"] = "アベック"
+        tts_processing.clear_text_caches() # The reload lands while g2p is running
+        return result
+
+    monkeypatch.setattr(tts_processing, "_original_clean_text", clean_text_racing_a_reload)
+    assert _reading("ＡＢＣ") == "エービーシー"
+    monkeypatch.setattr(tts_processing, "_original_clean_text", original)
+    assert _reading("ＡＢＣ") == "アベック"
@@ -0,0 +1,91 @@
+# tests/test_inference_service.py
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import config
+import inference_service
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    transport = inference_service.StubInferenceTransport(latency=0, model_names=["voice"])
+    monkeypatch.setattr(inference_service, "transport", transport)
+    monkeypatch.setattr(config, "INFERENCE_SERVER_TOKEN", "secret")
+    return transport
+
+
+async def _post(path: str, **kwargs):
+    async with TestClient(TestServer(inference_service.create_app())) as client:
+        resp = await client.post(path, **kwargs)
+        return resp.status
+
+
+@pytest.mark.parametrize("headers, status", [
+    ({}, 401),
+    ({"Authorization": "Bearer wrong"}, 401),
+    ({"Authorization": "Bearer secret"}, 200),
+])
+def test_dictionary_reload_requires_the_token(run, stub, headers, status):
+    assert run(_post("/dictionary/reload", headers=headers)) == status
+    assert stub.dictionary_reloads == (1 if status == 200 else 0)
+
+
+def test_dictionary_reload_is_refused_without_a_configured_token(run, stub, monkeypatch):
+    monkeypatch.setattr(config, "INFERENCE_SERVER_TOKEN", "")
+    assert run(_post("/dictionary/reload", headers={"Authorization": "Bearer "})) == 403
+    assert stub.dictionary_reloads == 0
+
+
+def test_http_transport_reloads_every_server(run, stub):
+    async def scenario():
+        servers = [TestServer(inference_service.create_app()) for _ in range(2)]
+        for server in servers:
+            await server.start_server()
+        client = inference_service.HttpInferenceTransport([str(server.make_url("")) for server in servers])
+        try:
+            await client.reload_dictionary()
+        finally:
+            await client.close()
+            for server in servers:
+                await server.close()
+
+    run(scenario())
+    assert stub.dictionary_reloads == 2 # Both servers share the stub in this process
+
+
+def test_transport_missing_a_method_fails_on_construction():
+    class Incomplete(inference_service.HttpTransportBase):
+        async def _fetch_models(self, session, base_url):
+            return {}
+
+        async def reload_dictionary(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete(["http://127.0.0.1:1"])
+
+
+def test_invalid_parameters_fail_once_without_failover(run, stub, monkeypatch):
+    attempts = []
+
+    async def synthesize(text, language, model_name, params=None, timings=None):
+        attempts.append(model_name)
+        raise ValueError("style_weight must be a number")
+
+    monkeypatch.setattr(stub, "synthesize", synthesize)
+
+    async def scenario():
+        servers = [TestServer(inference_service.create_app()) for _ in range(2)]
+        for server in servers:
+            await server.start_server()
+        client = inference_service.HttpInferenceTransport([str(server.make_url("")) for server in servers])
+        try:
+            with pytest.raises(RuntimeError, match="422"):
+                await client.synthesize("テスト", inference_service.Languages.JP, "voice", {"style_weight": "x"})
+        finally:
+            await client.close()
+            for server in servers:
+                await server.close()
+
+    run(scenario())
+    assert attempts == ["voice"] # Not retried on the second server
@@ -0,0 +1,46 @@
+# tests/test_load_controller.py
+import pytest
+
+import load_controller
+
+
+@pytest.fixture
+def controller():
+    controller = load_controller.LoadController()
+    controller.enabled = True
+    controller.rtf_thresholds = (0.5, 1.0)
+    controller.queue_thresholds = (20, 60)
+    controller.recovery_ratio = 0.6
+    controller.recovery_seconds = 15
+    controller.half_life = 20
+    return controller
+
+
+def test_long_message_is_not_mistaken_for_load(controller):
+    # 6 s of inference for 20 s of audio is comfortably faster than real time
+    controller.record_inference(6.0, 20.0, now=0)
+    assert controller.mode == "normal"
+
+
+def test_slower_than_real_time_goes_critical(controller):
+    controller.record_inference(3.0, 2.0, now=0)
+    assert controller.mode == "critical"
+
+
+def test_mode_recovers_after_burst_without_new_inference(controller):
+    for second in range(5):
+        controller.record_inference(3.0, 2.0, now=second)
+    assert controller.mode == "critical"
+    modes = [controller.evaluate(now) for now in range(5, 400, 5)]
+    assert modes[-1] == "normal"
+
+
+def test_queue_depth_raises_mode(controller):
+    controller.set_queue_depth_source(lambda: 25)
+    assert controller.evaluate(now=0) == "degraded"
+
+
+def test_apply_speed_shortens_length():
+    assert load_controller.apply_speed({"length": 1.0}, 1.25) == {"length": 0.8}
+    params = {"length": 1.0}
+    assert load_controller.apply_speed(params, 1.0) is params
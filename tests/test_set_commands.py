@@ -0,0 +1,122 @@
+# tests/test_set_commands.py
+import pytest
+
+import bot_commands
+import config
+import inference_service
+import tts_processing
+from conftest import FakeMessage
+
+MODEL_INFO = {"language": None, "styles": ["Neutral", "Happy"], "speakers": {"alice": 0, "bob": 1}}
+
+
+@pytest.fixture
+def local_transport(monkeypatch):
+    transport = inference_service.StubInferenceTransport(model_names=["voice"])
+    transport.models["voice"] = dict(MODEL_INFO)
+    monkeypatch.setattr(inference_service, "transport", transport)
+    return transport
+
+
+@pytest.fixture
+def sbv2_transport(monkeypatch):
+    transport = inference_service.SBV2ApiTransport(["http://127.0.0.1:5000"])
+    transport.models = {"voice": dict(MODEL_INFO)}
+    monkeypatch.setattr(inference_service, "transport", transport)
+    return transport
+
+
+def test_set_speed_saves_value_in_range(run, user_info, local_transport):
+    message = FakeMessage()
+    run(bot_commands.handle_set_speed_command(message, "1.5"))
+    assert user_info()["1"]["speed"] == 1.5
+
+
+@pytest.mark.parametrize("value", ["0.1", "3", "fast", None])
+def test_set_speed_rejects_invalid_value(run, user_info, local_transport, value):
+    message = FakeMessage()
+    run(bot_commands.handle_set_speed_command(message, value))
+    assert "1" not in user_info()
+    assert "指定してください" in message.channel.sent[-1]
+
+
+def test_set_pitch_saves_value_when_supported(run, user_info, local_transport):
+    run(bot_commands.handle_set_pitch_command(FakeMessage(), "1.1"))
+    assert user_info()["1"]["pitch"] == 1.1
+
+
+def test_set_pitch_is_refused_on_sbv2_api_server(run, user_info, sbv2_transport):
+    message = FakeMessage()
+    run(bot_commands.handle_set_pitch_command(message, "1.1"))
+    assert "1" not in user_info()
+    assert "対応していません" in message.channel.sent[-1]
+
+
+def test_set_style_checks_model_styles(run, user_info, local_transport):
+    message = FakeMessage()
+    run(bot_commands.handle_set_style_command(message, "Angry", None))
+    assert "1" not in user_info()
+    assert "Happy" in "".join(message.channel.sent)
+
+    run(bot_commands.handle_set_style_command(message, "Happy", "5"))
+    assert user_info()["1"]["style"] == "Happy"
+    assert user_info()["1"]["style_weight"] == 5.0
+
+
+def test_set_style_rejects_weight_out_of_range(run, user_info, local_transport):
+    run(bot_commands.handle_set_style_command(FakeMessage(), "Happy", "50"))
+    assert "1" not in user_info()
+
+
+def test_set_speaker_validates_against_model_speakers(run, user_info, local_transport):
+    message = FakeMessage()
+    run(bot_commands.handle_set_speaker_command(message, "7"))
+    assert "1" not in user_info()
+    assert "bob" in message.channel.sent[-1]
+
+    run(bot_commands.handle_set_speaker_command(message, "1"))
+    assert user_info()["1"]["speaker_id"] == 1
+
+
+@pytest.mark.parametrize("value", ["-1", "one", None])
+def test_set_speaker_rejects_non_integer(run, user_info, local_transport, value):
+    run(bot_commands.handle_set_speaker_command(FakeMessage(), value))
+    assert "1" not in user_info()
+
+
+def test_build_synthesis_params_maps_preferences(local_transport):
+    prefs = {"speed": 2.0, "pitch": 1.1, "style": "Happy", "style_weight": 3.0, "speaker_id": 1}
+    assert tts_processing.build_synthesis_params(prefs, "voice") == {
+        "length": 0.5, "pitch_scale": 1.1, "style": "Happy", "style_weight": 3.0, "speaker_id": 1
+    }
+
+
+def test_build_synthesis_params_skips_unsupported_and_unknown(sbv2_transport):
+    prefs = {"pitch": 1.1, "style": "Angry", "speaker_id": 9}
+    assert tts_processing.build_synthesis_params(prefs, "voice") == {}
+
+
+@pytest.fixture
+def dictionary(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DICT_CSV_PATH", tmp_path / "user_dict.csv")
+    bot_commands.user_dictionary.invalidate()
+    yield bot_commands.user_dictionary
+    bot_commands.user_dictionary.invalidate()
+
+
+def test_set_dict_saves_and_reloads(run, local_transport, dictionary):
+    message = FakeMessage()
+    run(bot_commands.handle_set_dict_command(message, "abc", "エービーシー"))
+    assert dictionary.get_entries() == {"ａｂｃ": "エービーシー"}
+    assert local_transport.dictionary_reloads == 1
+
+
+@pytest.mark.parametrize("key, value", [
+    ("a,b", "エービー"), ('say"hi"', "セイハイ"), ("line\nbreak", "ライン"), ("x" * 51, "エックス"), ("abc", "えーびーしー"),
+])
+def test_set_dict_applies_import_rules(run, local_transport, dictionary, key, value):
+    message = FakeMessage()
+    run(bot_commands.handle_set_dict_command(message, key, value))
+    assert dictionary.get_entries() == {}
+    assert local_transport.dictionary_reloads == 0
+    assert message.channel.sent[-1] == f";{dictionary.validate_entry(dictionary.to_fullwidth(key), value)}。"
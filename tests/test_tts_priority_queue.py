@@ -0,0 +1,130 @@
+# tests/test_tts_priority_queue.py
+import asyncio
+
+import pytest
+
+import tts_priority_queue
+from tts_priority_queue import CHAT, NAME, SYSTEM, PriorityTTSQueue
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(tts_priority_queue.time, "monotonic", clock)
+    return clock
+
+
+def put(queue, text, priority=CHAT, group=None):
+    queue.put_nowait({"text": text, "priority": priority, "group": group})
+
+
+def drain(queue):
+    texts = []
+    while not queue.empty():
+        texts.append(queue.get_nowait()["text"])
+        queue.task_done()
+    return texts
+
+
+def test_system_goes_before_waiting_chat(clock):
+    queue = PriorityTTSQueue()
+    put(queue, "chat1")
+    put(queue, "chat2")
+    put(queue, "join", SYSTEM)
+    assert drain(queue) == ["join", "chat1", "chat2"]
+
+
+def test_name_is_followed_by_its_message(clock):
+    queue = PriorityTTSQueue()
+    group = queue.new_group()
+    put(queue, "alice", NAME, group)
+    put(queue, "hello", CHAT, group)
+    assert queue.get_nowait()["text"] == "alice"
+    put(queue, "join", SYSTEM)
+    assert drain(queue) == ["hello", "join"]
+
+
+def test_started_group_continues_within_its_tier(clock):
+    queue = PriorityTTSQueue()
+    first = queue.new_group()
+    put(queue, "a1", CHAT, first)
+    put(queue, "a2", CHAT, first)
+    put(queue, "b1")
+    assert drain(queue) == ["a1", "a2", "b1"]
+
+
+def test_aged_chat_competes_with_system_by_arrival(clock):
+    queue = PriorityTTSQueue(aging_seconds=20)
+    put(queue, "old chat")
+    clock.now += 30
+    put(queue, "join", SYSTEM)
+    assert drain(queue) == ["old chat", "join"]
+
+
+def test_group_joining_system_tier(clock):
+    queue = PriorityTTSQueue()
+    put(queue, "chat")
+    group = queue.new_group()
+    put(queue, "member", NAME, group)
+    put(queue, "joined", SYSTEM, group)
+    assert drain(queue) == ["member", "joined", "chat"]
+
+
+def test_stale_chat_is_dropped(clock):
+    dropped = []
+    queue = PriorityTTSQueue(stale_seconds=60, on_drop=dropped.append)
+    group = queue.new_group()
+    put(queue, "old name", NAME, group)
+    put(queue, "old text", CHAT, group)
+    put(queue, "announcement", SYSTEM)
+    clock.now += 90
+    put(queue, "new")
+    assert drain(queue) == ["announcement", "new"]
+    assert [item["text"] for item in dropped] == ["old name", "old text"]
+    assert queue.dropped == 2
+    with pytest.raises(ValueError):
+        queue.task_done() # Dropped items are not counted as unfinished
+
+
+def test_get_waits_for_items(clock):
+    async def scenario():
+        queue = PriorityTTSQueue()
+        getter = asyncio.create_task(queue.get())
+        await asyncio.sleep(0)
+        put(queue, "late")
+        return (await getter)["text"]
+    assert asyncio.run(scenario()) == "late"
+
+
+def test_many_groups_keep_arrival_order(clock):
+    queue = PriorityTTSQueue()
+    for index in range(1000):
+        put(queue, f"chat{index}")
+    assert queue.qsize() == 1000
+    assert drain(queue) == [f"chat{index}" for index in range(1000)]
+
+
+def test_started_group_is_not_cut_off_when_stale(clock):
+    dropped = []
+    queue = PriorityTTSQueue(stale_seconds=60, on_drop=dropped.append)
+    playing = queue.new_group()
+    put(queue, "name", NAME, playing)
+    put(queue, "text 1", CHAT, playing)
+    put(queue, "text 2", CHAT, playing)
+    waiting = queue.new_group()
+    put(queue, "other name", NAME, waiting)
+    put(queue, "other text", CHAT, waiting)
+    assert queue.get_nowait()["text"] == "name" # Announced, then synthesis stalls
+    queue.task_done()
+    clock.now += 90
+    put(queue, "new")
+    assert drain(queue) == ["text 1", "text 2", "new"]
+    assert [item["text"] for item in dropped] == ["other name", "other text"]
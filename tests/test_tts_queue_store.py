@@ -0,0 +1,37 @@
+# tests/test_tts_queue_store.py
+import pytest
+
+import config
+import tts_queue_store
+
+
+@pytest.fixture
+def store_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(tts_queue_store, "job_store", None)
+    monkeypatch.setattr(config, "TTS_QUEUE_JOB_TTL", 3600)
+    return lambda path: monkeypatch.setattr(config, "TTS_QUEUE_DB_PATH", str(path))
+
+
+def test_unopenable_database_disables_persistence(run, tmp_path, store_config):
+    store_config(tmp_path / "missing" / "queue.db")
+    assert run(tts_queue_store.init_job_store()) is None
+    assert tts_queue_store.job_store is None
+    item = {"model_name": "voice", "text": "こんにちは", "language": "JP"}
+    tts_queue_store.persist_job(1, item) # Plays without persistence
+    assert "job_id" not in item
+
+
+def test_jobs_survive_close_and_reopen(run, tmp_path, store_config):
+    store_config(tmp_path / "queue.db")
+    assert run(tts_queue_store.init_job_store()) is not None
+    item = {"model_name": "voice", "text": "こんにちは", "language": "JP", "params": {"length": 0.8}}
+    tts_queue_store.persist_job(1, item)
+    tts_queue_store.close_job_store() # Shutdown flushes the pending insert
+    assert tts_queue_store.job_store is None
+
+    store = run(tts_queue_store.init_job_store())
+    jobs = run(store.load_pending(1))
+    tts_queue_store.close_job_store()
+    assert [(job["job_id"], job["text"], job["payload"]) for job in jobs] == [
+        (item["job_id"], "こんにちは", {"params": {"length": 0.8}})
+    ]
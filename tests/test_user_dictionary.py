@@ -0,0 +1,43 @@
+# tests/test_user_dictionary.py
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import config
+import user_dictionary
+
+
+@pytest.fixture
+def dictionary(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DICT_CSV_PATH", tmp_path / "dict_data" / "user_dict.csv")
+    user_dictionary.invalidate()
+    yield user_dictionary
+    user_dictionary.invalidate()
+
+
+def test_concurrent_rewrites_keep_every_entry(dictionary):
+    surfaces = [user_dictionary.to_fullwidth(f"word{i}") for i in range(40)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda surface: dictionary.add_entries([(surface, "ワード")]), surfaces))
+    assert sorted(dictionary.get_entries()) == sorted(surfaces)
+    assert (config.DICT_CSV_PATH.parent / "user_dict.csv.lock").exists()
+
+
+def test_external_removal_publishes_a_consistent_snapshot(dictionary):
+    dictionary.add_entries([("ＡＢＣ", "エービーシー"), ("ＡＢＤ", "エービーディー")])
+    before = dictionary._current()
+    # Someone edits the CSV by hand and removes a surface
+    config.DICT_CSV_PATH.write_text(",".join(dictionary.make_row("ＡＢＣ", "エービーシー")) + "\n", encoding="utf-8")
+    dictionary.invalidate()
+    assert dictionary.search("abd") == ([], 0, 1)
+    assert dictionary.search("ab") == ([("ＡＢＣ", "エービーシー")], 1, 1)
+    # A reader still holding the old snapshot sees the old CSV as a whole
+    assert before.sorted_surfaces == ("ＡＢＣ", "ＡＢＤ") and set(before.entries) == {"ＡＢＣ", "ＡＢＤ"}
+
+
+def test_deleted_csv_empties_the_dictionary(dictionary):
+    dictionary.add_entries([("ＡＢＣ", "エービーシー")])
+    config.DICT_CSV_PATH.unlink()
+    dictionary.invalidate()
+    assert dict(dictionary.get_entries()) == {}
+    assert dictionary.search() == ([], 0, 1)
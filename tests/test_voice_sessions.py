@@ -0,0 +1,134 @@
+# tests/test_voice_sessions.py
+import asyncio
+
+import pytest
+
+import config
+import voice_sessions
+
+
+class Member:
+    def __init__(self, bot=False):
+        self.bot = bot
+
+
+class VoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class VoiceClient:
+    def __init__(self, guild, channel, connected=True):
+        self.guild = guild
+        self.channel = channel
+        self.connected = connected
+        self.disconnects = 0
+
+    def is_connected(self):
+        return self.connected
+
+    async def disconnect(self, force=False):
+        self.disconnects += 1
+        self.connected = False
+        self.guild.voice_client = None
+
+
+class VoiceChannel:
+    def __init__(self, guild, failures=0):
+        self.guild = guild
+        self.name = "general"
+        self.members = [Member(), Member(bot=True)]
+        self.failures = failures # connect() raises a handshake timeout this many times
+        self.connects = 0
+
+    async def connect(self):
+        self.connects += 1
+        if self.connects <= self.failures:
+            raise asyncio.TimeoutError
+        self.guild.voice_client = VoiceClient(self.guild, self)
+        return self.guild.voice_client
+
+
+class Guild:
+    def __init__(self):
+        self.id = 42
+        self.name = "guild"
+        self.voice_client = None
+
+
+@pytest.fixture
+def guild(monkeypatch):
+    guild = Guild()
+    voice_sessions.init_voice_sessions({guild.id: guild}.get)
+    monkeypatch.setattr(config, "VOICE_RECONNECT_ATTEMPTS", 3)
+    monkeypatch.setattr(voice_sessions.asyncio, "sleep", _fast_sleep)
+    yield guild
+    voice_sessions.reconnect_tasks.clear()
+    voice_sessions.pending_disconnects.clear()
+    voice_sessions._intentional_disconnects.clear()
+
+
+_real_sleep = asyncio.sleep
+
+
+async def _fast_sleep(delay, *args):
+    await _real_sleep(0)
+
+
+def test_forced_disconnect_is_not_undone(guild):
+    async def scenario():
+        channel = VoiceChannel(guild)
+        await voice_sessions.connect(channel)
+        voice_sessions.handle_bot_voice_state(guild, VoiceState(None), VoiceState(channel))
+        # A moderator disconnects the bot: discord.py drops the voice client and reports channel=None
+        guild.voice_client = None
+        voice_sessions.handle_bot_voice_state(guild, VoiceState(channel), VoiceState(None))
+        for _ in range(10):
+            await _real_sleep(0)
+        assert await voice_sessions.wait_for_voice_client(guild.id, timeout=1) is None
+        return channel
+    channel = asyncio.run(scenario())
+    assert channel.connects == 1
+    assert guild.voice_client is None
+    assert not voice_sessions.reconnect_tasks
+
+
+def test_intentional_disconnect_is_not_reported_as_external(guild, capsys):
+    async def scenario():
+        channel = VoiceChannel(guild)
+        await voice_sessions.connect(channel)
+        await voice_sessions.disconnect(guild)
+        voice_sessions.handle_bot_voice_state(guild, VoiceState(channel), VoiceState(None))
+    asyncio.run(scenario())
+    assert "by someone else" not in capsys.readouterr().out
+    assert not voice_sessions._intentional_disconnects
+
+
+def test_connect_retries_handshake_failures(guild):
+    channel = VoiceChannel(guild, failures=2)
+    voice_client = asyncio.run(voice_sessions.connect(channel))
+    assert voice_client.is_connected()
+    assert channel.connects == 3
+
+
+def test_connect_gives_up_after_configured_attempts(guild):
+    channel = VoiceChannel(guild, failures=10)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(voice_sessions.connect(channel))
+    assert channel.connects == config.VOICE_RECONNECT_ATTEMPTS + 1
+
+
+def test_session_that_did_not_recover_is_rebuilt(guild):
+    async def scenario():
+        channel = VoiceChannel(guild)
+        await voice_sessions.connect(channel)
+        stale = guild.voice_client
+        stale.connected = False # Voice websocket dropped and discord.py could not resume it
+        assert await voice_sessions.wait_for_voice_client(guild.id, timeout=0) is None
+        await voice_sessions.reconnect_tasks[guild.id]
+        return channel, stale, await voice_sessions.wait_for_voice_client(guild.id, timeout=0)
+    channel, stale, voice_client = asyncio.run(scenario())
+    assert stale.disconnects == 1
+    assert channel.connects == 2
+    assert voice_client is not None and voice_client.is_connected()
+    assert not voice_sessions.reconnect_tasks
@@ -0,0 +1,184 @@
+# tts_priority_queue.py
+import asyncio
+import collections
+import heapq
+import itertools
+import time
+
+# --- Priority classes ---
+SYSTEM = 0 # Join/leave announcements and other bot-originated speech
+NAME = 1   # Speaker name read before a message; always followed by the rest of its group
+CHAT = 2   # Message content
+
+
+class PriorityTTSQueue:
+    """Per-guild TTS generation queue with priority classes (drop-in for asyncio.Queue).
+
+    Items belong to a group (one chat message or one announcement) and a group is
+    always spoken in order. Ordering between groups:
+    - Groups containing a SYSTEM item go first; a group that has waited
+      `aging_seconds` is promoted to the same tier, so chat never starves.
+    - A group that has started speaking continues before other groups of its tier,
+      and nothing can come between a NAME item and the item after it.
+    - Chat groups older than `stale_seconds` are skipped; `on_drop` is called per item.
+      Only groups that have not started are skipped: a name is never left without its message.
+
+    Groups keep their items in a deque. SYSTEM groups sit in a heap by arrival; chat
+    groups arrive in order, so a deque suffices and only its head is checked for aging
+    and staleness (past the few started groups at the front). get() is O(log n) in the
+    number of groups.
+    Items already taken by a consumer (e.g. prefetched by a pipelining processor)
+    can't be preempted by higher-priority items that arrive later.
+    """
+
+    def __init__(self, aging_seconds: float = 20.0, stale_seconds: float = 0.0, on_drop=None):
+        self.aging_seconds = aging_seconds
+        self.stale_seconds = stale_seconds # 0 disables skipping
+        self.on_drop = on_drop
+        self._groups = {} # group -> {"seq", "enqueued_at", "system", "started", "items": deque}
+        self._system_heap = [] # (group seq, group) of groups with a SYSTEM item
+        self._chat_groups = collections.deque() # (group seq, group) of other groups, oldest first
+        self._size = 0
+        self._seq = itertools.count()
+        self._group_ids = itertools.count()
+        self._pinned_group = None
+        self._pinned_after_name = False
+        self._not_empty = asyncio.Event()
+        self._unfinished = 0
+        self.dropped = 0
+
+    def new_group(self) -> tuple:
+        """Returns an id to put several items (e.g. name + message segments) in one group."""
+        return ("group", next(self._group_ids))
+
+    # --- asyncio.Queue interface ---
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def put_nowait(self, item: dict):
+        """Adds an item; uses item["priority"] (default CHAT) and item["group"] (default: its own)."""
+        seq = next(self._seq)
+        group = item.get("group")
+        if group is None:
+            group = ("item", seq)
+        system = item.get("priority", CHAT) == SYSTEM
+        info = self._groups.get(group)
+        if info is None:
+            info = self._groups[group] = {"seq": seq, "enqueued_at": time.monotonic(), "system": system,
+                                          "started": False, "items": collections.deque()}
+            if system:
+                heapq.heappush(self._system_heap, (seq, group))
+            else:
+                self._chat_groups.append((seq, group))
+        elif system and not info["system"]:
+            # Moves to the SYSTEM tier; its chat-deque entry is skipped lazily
+            info["system"] = True
+            heapq.heappush(self._system_heap, (info["seq"], group))
+        info["items"].append(item)
+        self._size += 1
+        self._unfinished += 1
+        self._not_empty.set()
+
+    async def put(self, item: dict):
+        self.put_nowait(item)
+
+    def get_nowait(self) -> dict:
+        now = time.monotonic()
+        self._drop_stale(now)
+        if not self._size:
+            raise asyncio.QueueEmpty
+        group = self._select(now)
+        info = self._groups[group]
+        item = info["items"].popleft()
+        info["started"] = True
+        self._size -= 1
+        if info["items"]:
+            self._pinned_group = group
+        else:
+            del self._groups[group] # Its heap/deque entry is skipped lazily
+            self._pinned_group = None
+        self._pinned_after_name = item.get("priority", CHAT) == NAME and self._pinned_group is not None
+        if not self._size:
+            self._not_empty.clear()
+        return item
+
+    async def get(self) -> dict:
+        while True:
+            await self._not_empty.wait()
+            try:
+                return self.get_nowait()
+            except asyncio.QueueEmpty:
+                self._not_empty.clear() # Everything left was stale
+
+    def task_done(self):
+        if self._unfinished <= 0:
+            raise ValueError("task_done() called too many times")
+        self._unfinished -= 1
+
+    # --- Scheduling ---
+    def _system_head(self):
+        while self._system_heap and self._system_heap[0][1] not in self._groups:
+            heapq.heappop(self._system_heap)
+        return self._system_heap[0] if self._system_heap else None
+
+    def _chat_head(self):
+        while self._chat_groups:
+            group = self._chat_groups[0][1]
+            info = self._groups.get(group)
+            if info is not None and not info["system"]:
+                return self._chat_groups[0]
+            self._chat_groups.popleft() # Finished or moved to the SYSTEM tier
+        return None
+
+    def _is_promoted(self, info: dict, now: float) -> bool:
+        return info["system"] or now - info["enqueued_at"] >= self.aging_seconds
+
+    def _select(self, now: float):
+        pinned = self._groups.get(self._pinned_group)
+        if pinned is not None and (self._pinned_after_name or self._is_promoted(pinned, now)):
+            # A name must be followed by its own message, even if an announcement arrived
+            return self._pinned_group
+        system_head = self._system_head()
+        chat_head = self._chat_head()
+        if chat_head is not None and self._is_promoted(self._groups[chat_head[1]], now):
+            # Aged chat competes with SYSTEM groups by arrival
+            if system_head is None or chat_head[0] < system_head[0]:
+                return chat_head[1]
+        if system_head is not None:
+            return system_head[1]
+        if pinned is not None:
+            return self._pinned_group
+        return chat_head[1]
+
+    def _drop_stale(self, now: float):
+        if self.stale_seconds <= 0:
+            return
+        dropped_items = dropped_groups = 0
+        self._chat_head() # Discards finished groups at the front
+        index = 0
+        while index < len(self._chat_groups):
+            group = self._chat_groups[index][1]
+            info = self._groups.get(group)
+            if info is None or info["system"]:
+                index += 1 # Finished or moved to the SYSTEM tier; skipped lazily by _chat_head
+                continue
+            if now - info["enqueued_at"] <= self.stale_seconds:
+                break # Later groups are newer
+            if info["started"]:
+                index += 1 # Already speaking: finish it rather than cut it off after the name
+                continue
+            del self._chat_groups[index]
+            items = self._groups.pop(group)["items"]
+            self._size -= len(items)
+            self._unfinished -= len(items) # Never handed to a consumer, so no task_done() will come
+            self.dropped += len(items)
+            dropped_items += len(items)
+            dropped_groups += 1
+            if self.on_drop:
+                for item in items:
+                    self.on_drop(item) # The pinned group has started, so it is never dropped
+        if dropped_items:
+            print(f"Skipped {dropped_items} stale TTS item(s) from {dropped_groups} message(s).")
@@ -1,76 +1,220 @@
 # tts_processing.py
 import io
+import re
 import asyncio
+import collections
+import datetime
+import threading
+import time
 import numpy as np
 import soundfile as sf
-import torch
 import discord
-import csv
+from typing import TYPE_CHECKING
 
 from style_bert_vits2.constants import Languages
-from style_bert_vits2.tts_model import TTSModel # For type hinting
 
-import tts_setup # To access generation_semaphore, is_cuda_available, models
-import config # To access DICT_CSV_PATH
+if TYPE_CHECKING: # TTSModel pulls in torch; only import it for type checkers
+    from style_bert_vits2.tts_model import TTSModel
+
+import tts_setup # To access generation_semaphore, models
+import tts_queue_store # To mark persisted jobs as done
+import inference_service # To access the synthesis transport
+import config # To access audio cache settings
+import user_dictionary # For fullwidth dictionary matching
+import load_controller # Inference latency feeds the load mode
+import voice_sessions # Resolves the guild's voice client at play time
+import audio_postprocess # Trimming, normalization, resampling
+import device_manager # Cache-emptying policy and OOM retry
 
 # --- Queues (managed per guild in main.py) ---
 # These will be populated by main.py: playback_queues[guild_id], play_queues[guild_id]
 
-# --- Text Analysis & Language Determination ---
+# --- Text Analysis ---
 def to_fullwidth(s: str) -> str:
     """Converts ASCII alphabet to fullwidth for dictionary matching."""
-    result = ""
-    for char_val in s:
-        if 'A' <= char_val <= 'Z':
-            result += chr(ord(char_val) - ord('A') + ord('Ａ'))
-        elif 'a' <= char_val <= 'z':
-            result += chr(ord(char_val) - ord('a') + ord('ａ'))
-        else:
-            result += char_val
-    return result
-
-async def _is_text_in_custom_dict(text: str) -> bool:
-    """Checks if any part of the text (converted to fullwidth) is in the custom dictionary."""
+    return user_dictionary.to_fullwidth(s)
+
+# --- Discord text preprocessing ---
+# Discord markup is turned into readable text before segmentation, so raw ids,
+# code and spoilers are never read out and repeated lines normalize to the same text.
+CODE_BLOCK_READING = "コード省略"
+SPOILER_READING = "ネタバレ"
+
+_CODE_BLOCK_RE = re.compile(r"```.*?(?:```|$)", re.DOTALL) # Unclosed blocks run to the end
+_INLINE_CODE_RE = re.compile(r"`([^`\n]+)`")
+_SPOILER_RE = re.compile(r"\|\|.+?\|\|", re.DOTALL)
+_CUSTOM_EMOJI_RE = re.compile(r"<a?:(\w+):\d+>")
+_MENTION_RE = re.compile(r"<(@!?|@&|#)(\d+)>")
+_TIMESTAMP_RE = re.compile(r"<t:(-?\d+)(?::[tTdDfFR])?>")
+_SPACES_RE = re.compile(r"[ \t\u3000]+")
+
+def _mention_name(message, kind: str, target_id: int) -> str:
+    guild = getattr(message, "guild", None)
+    if kind == "@&":
+        role = guild.get_role(target_id) if guild else None
+        return role.name if role else ""
+    if kind == "#":
+        channel = guild.get_channel(target_id) if guild else None
+        return channel.name if channel else ""
+    member = next((m for m in getattr(message, "mentions", []) if m.id == target_id), None)
+    if member is None and guild:
+        member = guild.get_member(target_id)
+    return member.display_name if member else ""
+
+def _timestamp_reading(match: re.Match) -> str:
     try:
-        # This is a synchronous file read. For very large dictionaries or high frequency,
-        # consider async file reading or caching the dictionary in memory.
-        with open(config.DICT_CSV_PATH, 'r', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            text_fw = to_fullwidth(text)
-            for row in reader:
-                if row and row[0] in text_fw: # row[0] is the surface form
-                    return True
-    except FileNotFoundError:
-        # print(f"Warning: Dictionary file not found at {config.DICT_CSV_PATH} for language check.")
-        pass # Fall through if dict not found
-    except Exception as e:
-        print(f"Error reading dictionary for language check: {e}")
-    return False
-
-async def determine_language_for_tts(text: str, model_lang_preference: str = None) -> Languages:
-    """
-    Determines the language for TTS.
-    Priority:
-    1. Model's explicit JP preference.
-    2. Text found in custom (JP) dictionary.
-    3. Heuristic for English vs. Japanese.
+        dt = datetime.datetime.fromtimestamp(int(match.group(1)))
+    except (OverflowError, OSError, ValueError):
+        return ""
+    return f"{dt.month}月{dt.day}日{dt.hour}時{dt.minute}分"
+
+def normalize_discord_text(text: str, message: discord.Message = None) -> str:
+    """Replaces mentions, custom emoji, timestamps, code blocks and spoilers with readable text."""
+    text = _CODE_BLOCK_RE.sub(CODE_BLOCK_READING, text)
+    text = _INLINE_CODE_RE.sub(r"\1", text)
+    text = _SPOILER_RE.sub(SPOILER_READING, text)
+    text = _CUSTOM_EMOJI_RE.sub(r"\1", text)
+    text = _MENTION_RE.sub(lambda m: _mention_name(message, m.group(1), int(m.group(2))), text)
+    text = _TIMESTAMP_RE.sub(_timestamp_reading, text)
+    if message is not None and not text.strip() and getattr(message, "stickers", None):
+        text = " ".join(sticker.name for sticker in message.stickers) # Sticker-only message
+    return "\n".join(_SPACES_RE.sub(" ", line).strip() for line in text.splitlines()).strip()
+
+# --- g2p cache ---
+# TTSModel.infer runs text normalization + pyopenjtalk g2p (clean_text) on every call.
+# install_g2p_cache() wraps the clean_text used by Style-Bert-VITS2's inference with
+# an LRU, so recurring lines ("www", stamps, names) skip g2p. Readings depend on the user
+# dictionary, so reload_user_dictionary() clears it in the process that runs inference
+# (the bot, or each inference server through POST /dictionary/reload).
+_g2p_cache = collections.OrderedDict() # (text, language, args) -> clean_text result
+_g2p_lock = threading.Lock() # clean_text runs in executor threads
+_g2p_generation = 0 # Bumped on every clear; results computed before it are not stored
+_original_clean_text = None
+
+def _copy_g2p_result(result: tuple) -> tuple:
+    # Callers modify the phone/tone/word2ph lists in place; never hand out the cached ones
+    return tuple(list(value) if isinstance(value, list) else value for value in result)
+
+def _cached_clean_text(text, language, *args, **kwargs):
+    key = (text, str(language), args, tuple(sorted(kwargs.items())))
+    with _g2p_lock:
+        generation = _g2p_generation
+        result = _g2p_cache.get(key)
+        if result is not None:
+            _g2p_cache.move_to_end(key)
+    if result is None:
+        result = _original_clean_text(text, language, *args, **kwargs)
+        with _g2p_lock:
+            if generation != _g2p_generation: # The dictionary changed while this ran
+                return _copy_g2p_result(result)
+            _g2p_cache[key] = result
+            while len(_g2p_cache) > config.G2P_CACHE_SIZE:
+                _g2p_cache.popitem(last=False)
+    return _copy_g2p_result(result)
+
+def install_g2p_cache():
+    """Memoizes Style-Bert-VITS2's clean_text (text -> phones/tones) for in-process inference."""
+    global _original_clean_text
+    if config.G2P_CACHE_SIZE <= 0 or _original_clean_text is not None:
+        return
+    from style_bert_vits2.models import infer as sbv2_infer # Already imported with the models
+
+    _original_clean_text = sbv2_infer.clean_text
+    sbv2_infer.clean_text = _cached_clean_text
+
+def clear_text_caches():
+    """Drops memoized g2p results and synthesized audio (their readings may have changed)."""
+    global _g2p_generation
+    with _g2p_lock:
+        _g2p_cache.clear()
+        _g2p_generation += 1
+    audio_cache.clear()
+
+def _compile_user_dictionary():
+    # Imported on first use: pulls in pyopenjtalk and fastapi
+    from style_bert_vits2.nlp.japanese.user_dict import update_dict
+
+    update_dict(default_dict_path=config.DICT_CSV_PATH, compiled_dict_path=config.COMPILED_DICT_PATH)
+
+async def reload_user_dictionary():
+    """Recompiles the user dictionary CSV into this process's pyopenjtalk and drops cached readings.
+
+    Used by the local transport, i.e. by whichever process runs inference (the bot or an inference server).
     """
-    if model_lang_preference == "JP":
-        return Languages.JP
+    # Off the event loop, and not while a synthesis is using pyopenjtalk
+    async with tts_setup.generation_semaphore:
+        await asyncio.get_running_loop().run_in_executor(None, _compile_user_dictionary)
+        clear_text_caches() # Cached readings predate the change
 
-    if await _is_text_in_custom_dict(text):
-        return Languages.JP
-    
-    # Basic heuristic: if it contains non-ASCII (excluding common symbols), assume JP.
-    # Otherwise, assume EN. This is a simplification.
-    is_likely_english = all(ord(c) < 128 for c in text) and \
-                        all(c.isalnum() or c in "!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~ " for c in text)
+# --- Per-user synthesis parameters ---
+# User prefs (set via !set speed/pitch/style/speaker) -> TTSModel.infer keyword arguments
+SPEED_RANGE = (0.5, 2.0)
+PITCH_RANGE = (0.8, 1.2)
+STYLE_WEIGHT_RANGE = (0.0, 20.0)
+
+def build_synthesis_params(user_prefs: dict, model_name: str = None) -> dict:
+    """Builds infer() parameters from a user's preferences. Unset preferences are left out."""
+    params = {}
+    speed = user_prefs.get("speed")
+    if speed:
+        params["length"] = round(1.0 / speed, 3) # Larger length = slower speech
+    pitch = user_prefs.get("pitch")
+    if pitch and pitch != 1.0 and inference_service.supports_param("pitch_scale"):
+        params["pitch_scale"] = pitch
+    model_info = inference_service.transport.models.get(model_name, {})
+    style = user_prefs.get("style")
+    if style:
+        model_styles = model_info.get("styles")
+        if not model_styles or style in model_styles: # Skip styles the user's current model lacks
+            params["style"] = style
+            if user_prefs.get("style_weight") is not None:
+                params["style_weight"] = user_prefs["style_weight"]
+    speaker_id = user_prefs.get("speaker_id")
+    if speaker_id is not None:
+        speakers = model_info.get("speakers")
+        if not speakers or speaker_id in speakers.values(): # Skip ids the user's current model lacks
+            params["speaker_id"] = speaker_id
+    return params
 
-    return Languages.EN if is_likely_english else Languages.JP
+def params_key(params: dict) -> tuple:
+    """Hashable, order-independent form of synthesis parameters (for cache keys and grouping)."""
+    return tuple(sorted((params or {}).items()))
+
+# --- Synthesized audio cache ---
+# Short phrases repeat a lot (names, join/leave announcements, stamps). Keys include the
+# synthesis parameters, so users with different speed/style/pitch get their own entries.
+audio_cache = collections.OrderedDict() # (model, text, language, params_key) -> (sr, int16 array)
+
+def _audio_cache_key(item: dict):
+    if config.TTS_AUDIO_CACHE_SIZE <= 0 or len(item["text"]) > config.TTS_AUDIO_CACHE_MAX_TEXT:
+        return None
+    return (item["model_name"], item["text"], str(item["language"]), params_key(item.get("params")))
+
+def get_cached_audio(item: dict):
+    key = _audio_cache_key(item)
+    if key is None or key not in audio_cache:
+        return None
+    audio_cache.move_to_end(key)
+    return audio_cache[key]
+
+def store_cached_audio(item: dict, sr: int, audio_data: np.ndarray):
+    key = _audio_cache_key(item)
+    if key is None:
+        return
+    audio_cache[key] = (sr, audio_data)
+    audio_cache.move_to_end(key)
+    while len(audio_cache) > config.TTS_AUDIO_CACHE_SIZE:
+        audio_cache.popitem(last=False)
 
 # --- Audio Generation and Playback ---
-async def generate_audio_buffer(text: str, language: Languages, tts_model_instance: TTSModel):
-    """Generates audio and returns it as a BytesIO buffer. Runs inference in an executor."""
+async def synthesize_audio(text: str, language: Languages, tts_model_instance: "TTSModel", params: dict = None,
+                           timings: dict = None, device: "device_manager.Device" = None):
+    """Runs inference in an executor and returns (sample_rate, int16 audio array).
+
+    `params` are extra TTSModel.infer keyword arguments (style, speaker_id, length, ...).
+    If `timings` is given, timings["inference_s"] is set to the time spent in infer() alone.
+    `device` is the model's placement (tts_setup.models[name]["device"]), for the cache policy.
+    """
     loop = asyncio.get_event_loop()
     # text_speed_val = 1.5 # Consider making this configurable per user or model
     
@@ -80,47 +224,61 @@ async def generate_audio_buffer(text: str, language: Languages, tts_model_instan
 
     def _blocking_generate_and_process():
         # This function contains CPU/GPU-bound operations
-        sr, audio_data = tts_model_instance.infer(
-            text=text, language=language, length=text_speed_val
+        infer_kwargs = {"length": text_speed_val}
+        infer_kwargs.update(params or {})
+        start = time.perf_counter()
+        sr, audio_data = device_manager.run_with_oom_retry(
+            lambda: tts_model_instance.infer(text=text, language=language, **infer_kwargs),
+            device
         )
+        if timings is not None:
+            timings["inference_s"] = time.perf_counter() - start # Excludes the wait for generation_semaphore
         
-        # Ensure audio is int16
-        if audio_data.dtype != np.int16:
-            audio_data_int16 = (audio_data * 32767).astype(np.int16)
-        else:
-            audio_data_int16 = audio_data
-        
-        _buffer = io.BytesIO()
-        sf.write(_buffer, audio_data_int16, samplerate=sr, format='WAV', subtype='PCM_16')
-        _buffer.seek(0)
+        # Ensure audio is int16 (clipped, so loud float output doesn't wrap around)
+        audio_data_int16 = audio_postprocess.to_int16(audio_data)
         
-        if tts_setup.is_cuda_available == "cuda":
-            torch.cuda.empty_cache() # Clear cache after inference
-        return _buffer, sr
+        device_manager.after_inference(device) # Empties the CUDA cache only under pressure
+        return sr, audio_data_int16
 
     # Use the global generation_semaphore from tts_setup
     async with tts_setup.generation_semaphore:
-        buffer, sr = await loop.run_in_executor(
+        sr, audio_data_int16 = await loop.run_in_executor(
             None, _blocking_generate_and_process # None uses default ThreadPoolExecutor
         )
-    return buffer, sr
+    return sr, audio_data_int16
+
+def encode_wav_buffer(sr: int, audio_data_int16: np.ndarray) -> io.BytesIO:
+    """Wraps int16 audio in a WAV BytesIO buffer ready for playback."""
+    _buffer = io.BytesIO()
+    sf.write(_buffer, audio_data_int16, samplerate=sr, format='WAV', subtype='PCM_16')
+    _buffer.seek(0)
+    return _buffer
+
+def create_audio_source(buffer: io.BytesIO, sr: int) -> discord.AudioSource:
+    """Wraps a WAV buffer in an FFmpeg audio source for discord.py."""
+    return discord.FFmpegPCMAudio(
+        buffer, 
+        pipe=True, 
+        options=f'-hide_banner -loglevel error -f s16le -ar {sr} -ac 2' # Forcing mono, common for TTS
+    )
+
+audio_source_factory = create_audio_source # Replaced by load_test.py to play without FFmpeg
+
+# Recent enqueue -> playback start delays in ms (reported by load_test.py)
+playback_delays = collections.deque(maxlen=1000)
 
 async def play_audio_from_buffer(buffer: io.BytesIO, sr: int, voice_client: discord.VoiceClient):
     """Plays audio from a BytesIO buffer in a voice channel."""
     if not voice_client or not voice_client.is_connected():
         print("Error: Voice client not connected, cannot play audio.")
         buffer.close() # Ensure buffer is closed if not used
-        return
+        return False
 
     # Wait if bot is already playing something
     while voice_client.is_playing():
         await asyncio.sleep(0.1)
 
-    audio_source = discord.FFmpegPCMAudio(
-        buffer, 
-        pipe=True, 
-        options=f'-hide_banner -loglevel error -f s16le -ar {sr} -ac 2' # Forcing mono, common for TTS
-    )
+    audio_source = audio_source_factory(buffer, sr)
     
     def after_playing_handler(error):
         if error:
@@ -133,10 +291,56 @@ async def play_audio_from_buffer(buffer: io.BytesIO, sr: int, voice_client: disc
     # ensuring sequential playback from the play_queue.
     while voice_client.is_playing():
          await asyncio.sleep(0.1)
+    return True
+
+
+async def synthesize_item(item: dict):
+    """Synthesizes a queue item, serving repeated (text, model, params) from the audio cache."""
+    if item.get("runs"):
+        return await _synthesize_runs(item)
+    cached = get_cached_audio(item)
+    if cached is not None:
+        return cached
+    # The configured transport runs inference in-process or on an inference server
+    timings = {}
+    sr, audio_data = await inference_service.transport.synthesize(
+        item["text"], item["language"], item["model_name"], item.get("params"), timings=timings
+    )
+    if "inference_s" in timings and len(audio_data):
+        load_controller.controller.record_inference(timings["inference_s"], len(audio_data) / sr)
+    # Post-processed before caching, so cache hits are ready to play
+    sr, audio_data = await asyncio.get_running_loop().run_in_executor(
+        None, audio_postprocess.process, sr, audio_data, item["model_name"]
+    )
+    store_cached_audio(item, sr, audio_data)
+    return sr, audio_data
+
+async def _synthesize_runs(item: dict):
+    """Synthesizes each language run of a mixed-language item and joins the audio.
+
+    Runs are cached individually, so a phrase repeated inside different messages
+    is only synthesized once.
+    """
+    parts = []
+    for run_text, run_language in item["runs"]:
+        run_item = dict(item, text=run_text, language=Languages(run_language), runs=None)
+        parts.append(await synthesize_item(run_item))
+    sr = parts[0][0]
+    return sr, audio_postprocess.crossfade_concat([audio_data for _, audio_data in parts], sr)
+
+def _start_synthesis(item: dict) -> asyncio.Task:
+    """Starts synthesis of a queue item in the background."""
+    return asyncio.ensure_future(synthesize_item(item))
 
 
 async def tts_queue_processor(guild_id: int, bot_playback_queues: dict, bot_play_queues: dict):
-    """Processes TTS requests from the playback_queue for a guild."""
+    """Processes TTS requests from the playback_queue for a guild.
+
+    When the transport can run several jobs at once (pipeline_depth > 1), upcoming
+    items are started early; results are still handed to the play queue in order.
+    Prefetched items have already left the priority queue, so an announcement that
+    arrives afterwards waits for at most pipeline_depth - 1 of them.
+    """
     gen_queue = bot_playback_queues.get(guild_id)
     play_q = bot_play_queues.get(guild_id)
 
@@ -144,29 +348,41 @@ async def tts_queue_processor(guild_id: int, bot_playback_queues: dict, bot_play
         print(f"Error: Queues not found for guild {guild_id} in tts_queue_processor.")
         return
 
+    in_flight = collections.deque() # (item, synthesis task), oldest first
     while True:
+        item = None
         try:
-            item = await gen_queue.get()
+            if not in_flight:
+                queued_item = await gen_queue.get()
+                in_flight.append((queued_item, _start_synthesis(queued_item)))
+            pipeline_depth = max(1, getattr(inference_service.transport, "pipeline_depth", 1))
+            while len(in_flight) < pipeline_depth and not gen_queue.empty():
+                queued_item = gen_queue.get_nowait()
+                in_flight.append((queued_item, _start_synthesis(queued_item)))
+
+            item, synthesis_task = in_flight.popleft()
             # print(f"TTS Gen Q (Guild {guild_id}): Processing '{item['text']}'")
-            
-            buffer, sr = await generate_audio_buffer(
-                item["text"], item["language"], item["model_instance"]
-            )
+            sr, audio_data = await synthesis_task
+            buffer = encode_wav_buffer(sr, audio_data)
             
             await play_q.put({
                 "buffer": buffer,
                 "sr": sr,
-                "voice_client": item["voice_client"]
+                "job_id": item.get("job_id"),
+                "enqueued_at": item.get("enqueued_at")
             })
             # print(f"TTS Gen Q (Guild {guild_id}): Added '{item['text']}' to play queue.")
         except asyncio.CancelledError:
             print(f"TTS generation task for guild {guild_id} cancelled.")
+            for _, pending_task in in_flight:
+                pending_task.cancel()
             break # Exit loop if task is cancelled
         except Exception as e:
-            print(f"TTS generation error in queue for guild {guild_id}, item '{item.get('text', 'N/A')}': {e}")
+            print(f"TTS generation error in queue for guild {guild_id}, item '{item.get('text', 'N/A') if item else 'N/A'}': {e}")
+            tts_queue_store.complete_job(item) # Don't re-hydrate a job that fails to generate
         finally:
-            if 'gen_queue' in locals() and gen_queue: # Check if gen_queue is defined
-                 gen_queue.task_done() # Mark task as done even on error
+            if item is not None:
+                gen_queue.task_done() # Mark task as done even on error
 
 
 async def play_queue_processor(guild_id: int, bot_play_queues: dict):
@@ -178,10 +394,18 @@ async def play_queue_processor(guild_id: int, bot_play_queues: dict):
         return
 
     while True:
+        item = None
         try:
             item = await play_q.get()
+            if item.get("enqueued_at") is not None:
+                playback_delays.append((time.monotonic() - item["enqueued_at"]) * 1000)
             # print(f"Play Q (Guild {guild_id}): Playing audio.")
-            await play_audio_from_buffer(item["buffer"], item["sr"], item["voice_client"])
+            # Resolved now, not at enqueue time: the bot may have reconnected since
+            voice_client = await voice_sessions.wait_for_voice_client(guild_id, config.VOICE_RECONNECT_WAIT_SECONDS)
+            if await play_audio_from_buffer(item["buffer"], item["sr"], voice_client):
+                tts_queue_store.complete_job(item)
+            else:
+                tts_queue_store.release_job(item) # Keep it persisted for the next voice connection
         except asyncio.CancelledError:
             print(f"Audio playback task for guild {guild_id} cancelled.")
             break # Exit loop if task is cancelled
@@ -190,10 +414,12 @@ async def play_queue_processor(guild_id: int, bot_play_queues: dict):
             # If buffer is part of item and needs closing on error:
             if 'buffer' in item and hasattr(item['buffer'], 'close'):
                 item['buffer'].close()
+            tts_queue_store.complete_job(item)
         except Exception as e:
             print(f"TTS playback error in queue for guild {guild_id}: {e}")
             if 'buffer' in item and hasattr(item['buffer'], 'close'):
                 item['buffer'].close()
+            tts_queue_store.complete_job(item)
         finally:
-            if 'play_q' in locals() and play_q: # Check if play_q is defined
+            if item is not None: # Cancelled while waiting: nothing was taken from the queue
                 play_q.task_done()
\ No newline at end of file
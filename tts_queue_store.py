@@ -0,0 +1,178 @@
+# tts_queue_store.py
+import asyncio
+import json
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import config # To access TTS_QUEUE_DB_PATH, TTS_QUEUE_JOB_TTL
+
+# --- Persistent TTS job store (optional) ---
+# Items in playback_queues hold live voice clients and model instances, which cannot
+# survive a restart. This store keeps a serializable descriptor of every pending job
+# (guild, model name, text, language) so it can be re-hydrated after a reconnect.
+
+
+class PersistentJobStore:
+    """SQLite (WAL mode) backed store of pending TTS job descriptors.
+
+    All database access runs on one dedicated worker thread: calls made from the event
+    loop only submit work and return immediately, and writes are applied in order.
+    Every write touches a single row by primary key. Await open() before using it.
+    """
+
+    def __init__(self, db_path: str, ttl_seconds: float):
+        self.db_path = str(db_path)
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tts-queue-store")
+        self._conn = None
+        self._active_job_ids = set() # Jobs currently held by an in-memory queue
+
+    # --- Worker thread side ---
+    def _open(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # Durable across crashes in WAL mode, without fsync per write
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tts_jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " guild_id INTEGER NOT NULL,"
+            " model_name TEXT NOT NULL,"
+            " text TEXT NOT NULL,"
+            " language TEXT,"
+            " payload TEXT,"
+            " created_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tts_jobs_guild ON tts_jobs (guild_id)")
+        self._conn = conn
+
+    def _insert(self, row: tuple):
+        try:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tts_jobs (job_id, guild_id, model_name, text, language, payload, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+        except sqlite3.Error as e:
+            print(f"Error persisting TTS job {row[0]}: {e}")
+
+    def _delete(self, job_id: str):
+        try:
+            self._conn.execute("DELETE FROM tts_jobs WHERE job_id = ?", (job_id,))
+        except sqlite3.Error as e:
+            print(f"Error removing TTS job {job_id}: {e}")
+
+    def _load_guild(self, guild_id: int, now: float) -> list:
+        expired_before = now - self.ttl_seconds
+        try:
+            self._conn.execute(
+                "DELETE FROM tts_jobs WHERE guild_id = ? AND created_at < ?", (guild_id, expired_before))
+            rows = self._conn.execute(
+                "SELECT job_id, guild_id, model_name, text, language, payload, created_at"
+                " FROM tts_jobs WHERE guild_id = ? ORDER BY rowid", (guild_id,)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error loading persisted TTS jobs for guild {guild_id}: {e}")
+            return []
+        return [
+            {
+                "job_id": job_id, "guild_id": g_id, "model_name": model_name, "text": text,
+                "language": language, "payload": json.loads(payload) if payload else {},
+                "created_at": created_at,
+            }
+            for job_id, g_id, model_name, text, language, payload, created_at in rows
+        ]
+
+    # --- Event loop side ---
+    async def open(self):
+        """Opens (and creates) the database; raises sqlite3.Error / OSError if it can't."""
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._open)
+
+    def add(self, guild_id: int, model_name: str, text: str, language, payload: dict = None) -> str:
+        """Schedules a job descriptor to be persisted and returns its job id. Never blocks."""
+        job_id = uuid.uuid4().hex
+        self._active_job_ids.add(job_id)
+        row = (job_id, guild_id, model_name, text,
+               str(language) if language is not None else None,
+               json.dumps(payload, ensure_ascii=False) if payload else None,
+               time.time())
+        self._executor.submit(self._insert, row)
+        return job_id
+
+    def complete(self, job_id: str):
+        """Schedules removal of a finished (played, failed or dropped) job. Never blocks."""
+        self._active_job_ids.discard(job_id)
+        self._executor.submit(self._delete, job_id)
+
+    def release(self, job_id: str):
+        """Keeps a job persisted but lets load_pending() hand it out again."""
+        self._active_job_ids.discard(job_id)
+
+    async def load_pending(self, guild_id: int) -> list:
+        """Returns the guild's unexpired jobs that are not already queued in memory, oldest first."""
+        loop = asyncio.get_running_loop()
+        jobs = await loop.run_in_executor(self._executor, self._load_guild, guild_id, time.time())
+        pending = [job for job in jobs if job["job_id"] not in self._active_job_ids]
+        for job in pending:
+            self._active_job_ids.add(job["job_id"])
+        return pending
+
+    def close(self):
+        """Flushes pending writes and closes the database."""
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self._executor.submit(_close)
+        self._executor.shutdown(wait=True)
+
+
+# --- Module-level store (initialized by init_job_store) ---
+job_store = None
+
+# Optional queue item fields kept in the job payload
+PERSISTED_ITEM_KEYS = ("params", "runs")
+
+
+async def init_job_store():
+    """Opens the persistent job store if TTS_QUEUE_DB is configured; persistence stays off if it can't."""
+    global job_store
+    if job_store is None and config.TTS_QUEUE_DB_PATH:
+        store = PersistentJobStore(config.TTS_QUEUE_DB_PATH, config.TTS_QUEUE_JOB_TTL)
+        try:
+            await store.open()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Error opening TTS queue database {config.TTS_QUEUE_DB_PATH}: {e}; persistent TTS queue disabled.")
+            store.close()
+            return None
+        job_store = store
+        print(f"Persistent TTS queue enabled: {config.TTS_QUEUE_DB_PATH} (job TTL {config.TTS_QUEUE_JOB_TTL}s)")
+    return job_store
+
+
+def close_job_store():
+    """Flushes pending writes and closes the store (on shutdown)."""
+    global job_store
+    store, job_store = job_store, None
+    if store is not None:
+        store.close()
+
+
+def persist_job(guild_id: int, item: dict):
+    """Records a queue item in the store (if enabled) and tags it with its job id."""
+    if job_store is None or item.get("job_id"):
+        return
+    payload = {key: item[key] for key in PERSISTED_ITEM_KEYS if item.get(key)}
+    item["job_id"] = job_store.add(guild_id, item["model_name"], item["text"], item["language"], payload)
+
+
+def release_job(item: dict):
+    """Returns a queue item that could not be played to the store for a later resume."""
+    job_id = item.get("job_id") if item else None
+    if job_store is not None and job_id:
+        job_store.release(job_id)
+
+
+def complete_job(item: dict):
+    """Removes a queue item's descriptor from the store (if enabled)."""
+    job_id = item.get("job_id") if item else None
+    if job_store is not None and job_id:
+        job_store.complete(job_id)
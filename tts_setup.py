@@ -1,52 +1,62 @@
 # tts_setup.py
 import os
 import json
-import torch
+import time
 from pathlib import Path
 import asyncio  # For semaphore
 
-from style_bert_vits2.nlp import bert_models
 from style_bert_vits2.constants import Languages
-from style_bert_vits2.tts_model import TTSModel
 
 import config  # Import our config module
+import startup_cache  # Startup snapshot (model configs, tokenizers)
+import shared_weights  # Memory-mapped weights (TTS_WEIGHTS_MMAP)
+import device_manager  # Places BERT/VITS models across devices
+
+# torch, transformers and the TTS model classes are imported inside the functions
+# below, so importing this module (e.g. from a shard process) stays cheap.
 
 # --- Global TTS Variables (initialized by functions) ---
 models = {}
+model_load_times = {} # model_name -> ms, reported by main.py --profile-startup
 generation_semaphore = asyncio.Semaphore(1)
-is_cuda_available = "cuda" if torch.cuda.is_available() else "cpu"
-# is_cuda_available = "cpu" # For testing
 
 
 def load_all_bert_models():
     """Loads all necessary BERT models and tokenizers."""
-    print(f"Using device for TTS: {is_cuda_available}")
+    from style_bert_vits2.nlp import bert_models
+
+    device_manager.init_devices()
     os.makedirs(config.BERT_CACHE_PATH, exist_ok=True)
-    bert_models.load_model(
+    jp_bert = bert_models.load_model(
         Languages.JP,
         "ku-nlp/deberta-v2-large-japanese-char-wwm",
         str(config.BERT_CACHE_PATH)  # Ensure it's a string
     )
     bert_models.load_tokenizer(
         Languages.JP,
-        "ku-nlp/deberta-v2-large-japanese-char-wwm",
+        startup_cache.cached_tokenizer_path(Languages.JP, "ku-nlp/deberta-v2-large-japanese-char-wwm"),
         str(config.BERT_CACHE_PATH)
     )
-    bert_models.load_model(
+    en_bert = bert_models.load_model(
         Languages.EN,
         "microsoft/deberta-v3-large",
         str(config.BERT_CACHE_PATH)
     )
     bert_models.load_tokenizer(
         Languages.EN,
-        "microsoft/deberta-v3-large",
+        startup_cache.cached_tokenizer_path(Languages.EN, "microsoft/deberta-v3-large"),
         str(config.BERT_CACHE_PATH)
     )
+    startup_cache.save_tokenizer(Languages.JP)
+    startup_cache.save_tokenizer(Languages.EN)
+    # Loaded on the CPU; move them to their planned device once, not on the first inference
+    device_manager.place_bert_models({Languages.JP: jp_bert, Languages.EN: en_bert})
 
 
 def load_tts_models():
     """Loads Style-Bert-VITS2 models based on model_info.json."""
     global models  # Modifying the global models dictionary
+    from style_bert_vits2.tts_model import TTSModel
 
     os.makedirs(config.ASSETS_ROOT, exist_ok=True)
 
@@ -62,7 +72,9 @@ def load_tts_models():
             f"Error: Could not decode JSON from {config.MODEL_INFO_JSON_PATH}")
         return
 
+    snapshot = startup_cache.load_snapshot()
     for model_name, model_data in model_infos_json.items():
+        load_start = time.perf_counter()
         try:
             model_path = config.ASSETS_ROOT / model_name / model_data["model"]
             config_path = config.ASSETS_ROOT / \
@@ -83,17 +95,26 @@ def load_tts_models():
                     f"Warning: Style vector file for {model_name} not found at {style_vec_path}")
                 continue
 
+            device = device_manager.place(
+                model_name, device_manager.estimate_checkpoint_bytes(model_path), config.TTS_VITS_DEVICE)
             model_instance = TTSModel(
                 model_path=model_path,
-                config_path=config_path,
-                style_vec_path=style_vec_path,
-                device=is_cuda_available,
+                # Parsed config from the startup snapshot, mmap'd style vectors
+                config_path=startup_cache.get_hyper_parameters(snapshot, config_path),
+                style_vec_path=startup_cache.load_style_vectors(style_vec_path),
+                device=device.torch_device,
             )
+            if config.TTS_WEIGHTS_MMAP:
+                shared_bytes = shared_weights.share_model_weights(model_instance)
+                print(f"Memory-mapped {shared_bytes / 2**20:.1f} MB of weights for {model_name}")
             models[model_name] = {
                 "model": model_instance,
                 # Use .get for safety
-                "language": model_data.get("language", None)
+                "language": model_data.get("language", None),
+                "paths": {"model": model_path, "style": style_vec_path}, # For memory diagnostics
+                "device": device # Placement, for the cache policy in synthesize_audio
             }
+            model_load_times[model_name] = (time.perf_counter() - load_start) * 1000
             print(f"Loaded TTS model: {model_name}")
         except KeyError as e:
             print(
@@ -102,6 +123,7 @@ def load_tts_models():
             print(
                 f"An unexpected error occurred while loading model {model_name}: {e}")
 
+    startup_cache.save_snapshot(snapshot)
     if not models:
         print("Warning: No TTS models were loaded. TTS functionality will be unavailable.")
 
@@ -114,5 +136,10 @@ def get_available_model_names():
 
 
 def initialize_tts_system():
+    import tts_processing  # Imported here: tts_processing imports this module
+
+    config.ensure_nltk_tagger()
     load_all_bert_models()
     load_tts_models()
+    tts_processing.install_g2p_cache()
+    device_manager.install_bert_device()
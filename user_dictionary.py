@@ -0,0 +1,229 @@
+# user_dictionary.py
+import bisect
+import csv
+import io
+import json
+import os
+import types
+
+import filelock
+
+import config # To access DICT_CSV_PATH
+
+# --- In-memory view of the user dictionary CSV ---
+# The CSV is re-read only when its mtime/size changes, instead of on every lookup.
+# Surfaces are also kept sorted, so prefix search and paging are bisects, not scans.
+# Each read builds a new _Snapshot that is published with one assignment: executor
+# threads (add_entries, export_bytes) refresh it while the event loop searches it,
+# so readers take the snapshot once and never mix two versions of the CSV.
+
+# ASCII letters -> fullwidth, the form surfaces are stored in (see !set dict)
+_FULLWIDTH_TABLE = {
+    **{code: code - ord('A') + ord('Ａ') for code in range(ord('A'), ord('Z') + 1)},
+    **{code: code - ord('a') + ord('ａ') for code in range(ord('a'), ord('z') + 1)},
+}
+
+MAX_SURFACE_LENGTH = 50
+
+
+def to_fullwidth(s: str) -> str:
+    """Converts ASCII alphabet to fullwidth for dictionary matching."""
+    return s.translate(_FULLWIDTH_TABLE)
+
+
+def _is_latin_surface(surface: str) -> bool:
+    # Fullwidth letters/digits only: the surfaces that can match inside a Latin-script run
+    return all('Ａ' <= c <= 'Ｚ' or 'ａ' <= c <= 'ｚ' or '０' <= c <= '９' or c in " '-." for c in surface)
+
+
+def _fingerprint():
+    try:
+        stat = os.stat(config.DICT_CSV_PATH)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class _Snapshot:
+    """One read of the CSV. Never modified after it is built."""
+
+    def __init__(self, fingerprint=None, entries: dict = None, rows: dict = None):
+        self.fingerprint = fingerprint
+        self.entries = types.MappingProxyType(entries or {}) # surface -> yomi
+        self.rows = types.MappingProxyType(rows or {}) # surface -> CSV row
+        ordered = sorted((surface.casefold(), surface) for surface in self.entries)
+        self.sorted_keys = tuple(key for key, _ in ordered) # Casefolded surfaces in order...
+        self.sorted_surfaces = tuple(surface for _, surface in ordered) # ...and the surfaces they belong to
+        self.latin_surfaces = frozenset(surface for surface in self.entries if _is_latin_surface(surface))
+
+
+_snapshot = _Snapshot()
+
+
+def _read_snapshot(fingerprint) -> _Snapshot:
+    entries = {}
+    rows = {}
+    if fingerprint is not None:
+        try:
+            with open(config.DICT_CSV_PATH, 'r', encoding='utf-8') as f:
+                for row in csv.reader(f):
+                    if len(row) >= 12: # surface (idx 0) and yomi (idx 11)
+                        entries[row[0]] = row[11]
+                        rows[row[0]] = tuple(row)
+                    elif row and row[0]:
+                        entries[row[0]] = ""
+                        rows[row[0]] = tuple(row)
+        except Exception as e:
+            print(f"Error reading dictionary {config.DICT_CSV_PATH}: {e}")
+    return _Snapshot(fingerprint, entries, rows)
+
+
+def _current(force: bool = False) -> _Snapshot:
+    """Returns the snapshot of the CSV as it is now, re-reading it if it changed (or `force`)."""
+    global _snapshot
+    snapshot = _snapshot
+    fingerprint = _fingerprint()
+    if force or fingerprint != snapshot.fingerprint:
+        snapshot = _read_snapshot(fingerprint)
+        _snapshot = snapshot # Readers see the old or the new snapshot, never a mix
+    return snapshot
+
+
+def version():
+    """Changes whenever the dictionary file changes; use it in cache keys."""
+    return _current().fingerprint
+
+
+def get_entries():
+    """Returns a read-only {surface: yomi} view of the current dictionary."""
+    return _current().entries
+
+
+def get_latin_surfaces() -> frozenset:
+    """Returns the surfaces written only in fullwidth Latin letters/digits."""
+    return _current().latin_surfaces
+
+
+def invalidate():
+    """Re-reads the CSV now (after writing it)."""
+    _current(force=True)
+
+
+# --- Search / paging (!get dict) ---
+def search(prefix: str = "", page: int = 1, per_page: int = 20):
+    """Returns ([(surface, yomi)] for the page, total matches, page count) for surfaces starting with `prefix`.
+
+    Matching ignores case; ASCII letters in the prefix match their fullwidth form.
+    """
+    snapshot = _current()
+    keys = snapshot.sorted_keys
+    prefix = to_fullwidth(prefix).casefold()
+    start = bisect.bisect_left(keys, prefix)
+    end = bisect.bisect_left(keys, prefix + "\U0010ffff") if prefix else len(keys)
+    total = end - start
+    page_count = max(1, -(-total // per_page))
+    page = min(max(1, page), page_count)
+    first = start + (page - 1) * per_page
+    page_surfaces = snapshot.sorted_surfaces[first:min(end, first + per_page)]
+    return [(surface, snapshot.entries[surface]) for surface in page_surfaces], total, page_count
+
+
+# --- Bulk import / export ---
+def make_row(surface: str, yomi: str) -> list:
+    """Builds a dictionary CSV row (the format !set dict writes)."""
+    # surface,left_id,right_id,cost,pos1,pos2,pos3,pos4,pos5,pos6,surface_form,yomi,pron,accent_type,mora_len
+    return [surface, '', '', '8609', '名詞', '固有名詞', '一般', '*', '*', '*', surface, yomi, yomi, '0/0', '*']
+
+
+def validate_entry(surface: str, yomi: str):
+    """Returns an error message for an invalid (surface, yomi) pair, or None."""
+    if not surface or not yomi:
+        return "単語とヨミの両方が必要です"
+    if len(surface) > MAX_SURFACE_LENGTH or any(c in surface for c in ',\n\r"'):
+        return "単語が長すぎるか、使えない文字を含んでいます"
+    if not all('\u30A0' <= char <= '\u30FF' for char in yomi): # Yomi must be Katakana
+        return "ヨミは全角カタカナで入力してください"
+    return None
+
+
+def parse_import(data: bytes, filename: str):
+    """Parses an uploaded CSV or JSON dictionary.
+
+    Accepted: JSON {"単語": "ヨミ"} or [{"surface", "yomi"}] / [["単語", "ヨミ"]];
+    CSV "単語,ヨミ" rows or full dictionary rows (ヨミ in column 12).
+    Returns ([(surface, yomi)], [error lines]).
+    """
+    text = data.decode('utf-8-sig')
+    if filename.lower().endswith('.json'):
+        loaded = json.loads(text)
+        if isinstance(loaded, dict):
+            pairs = list(loaded.items())
+        else:
+            pairs = [(p.get("surface"), p.get("yomi")) if isinstance(p, dict) else tuple(p)[:2] for p in loaded]
+    else:
+        pairs = []
+        for row in csv.reader(io.StringIO(text)):
+            if not row or not row[0].strip() or row[0].startswith('#'):
+                continue
+            pairs.append((row[0], row[11]) if len(row) >= 12 else (row[0], row[1] if len(row) > 1 else ""))
+
+    entries, errors = {}, []
+    for index, (surface, yomi) in enumerate(pairs, start=1):
+        surface, yomi = to_fullwidth(str(surface or "").strip()), str(yomi or "").strip()
+        error = validate_entry(surface, yomi)
+        if error:
+            errors.append(f"{index}: `{surface}` {error}")
+        else:
+            entries[surface] = yomi # Later duplicates win
+    return list(entries.items()), errors
+
+
+WRITE_LOCK_TIMEOUT = 30 # Seconds to wait for another rewrite of the CSV
+
+
+def _write_lock() -> filelock.FileLock:
+    # A lock file next to the CSV: shard processes (and executor threads) share one dictionary
+    config.DICT_CSV_PATH.parent.mkdir(parents=True, exist_ok=True)
+    return filelock.FileLock(f"{config.DICT_CSV_PATH}.lock", timeout=WRITE_LOCK_TIMEOUT)
+
+
+def add_entries(entries: list):
+    """Adds or updates (surface, yomi) pairs in one rewrite of the CSV. Returns (added, updated).
+
+    Blocking (reads and rewrites the whole file): call it from an executor.
+    """
+    with _write_lock():
+        return _add_entries_locked(entries)
+
+
+def _add_entries_locked(entries: list):
+    rows = dict(_current(force=True).rows) # Another process may have rewritten the CSV since our last read
+    added = updated = 0
+    for surface, yomi in entries:
+        row = rows.get(surface)
+        if row is None:
+            rows[surface] = make_row(surface, yomi)
+            added += 1
+        elif len(row) < 13 or row[11] != yomi:
+            rows[surface] = make_row(surface, yomi) if len(row) < 13 else list(row[:11]) + [yomi, yomi] + list(row[13:])
+            updated += 1
+
+    if added or updated:
+        dict_path = config.DICT_CSV_PATH
+        tmp_path = dict_path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerows(rows.values())
+        os.replace(tmp_path, dict_path) # Never leave a half-written dictionary behind
+        invalidate()
+    return added, updated
+
+
+def export_bytes(fmt: str = "csv") -> bytes:
+    """Returns the dictionary as importable "単語,ヨミ" CSV or {"単語": "ヨミ"} JSON, sorted by surface."""
+    snapshot = _current()
+    pairs = [(surface, snapshot.entries[surface]) for surface in snapshot.sorted_surfaces]
+    if fmt == "json":
+        return json.dumps(dict(pairs), ensure_ascii=False, indent=1).encode('utf-8')
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(pairs)
+    return buffer.getvalue().encode('utf-8')
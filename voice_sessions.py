@@ -0,0 +1,167 @@
+# voice_sessions.py
+import asyncio
+
+import discord
+
+import config # To access VOICE_* settings
+
+# --- Voice session pool ---
+# - After the last listener leaves, the connection lingers for VOICE_LINGER_SECONDS
+#   and is reused if someone comes back, instead of a fresh connect() handshake.
+# - connect() retries failed handshakes (timeouts, closed voice websockets) with backoff.
+# - Dropped voice websockets are resumed by discord.py itself (connect(reconnect=True)).
+#   If the voice client is still there but hasn't come back by the time playback needs
+#   it, the session is rebuilt on the same channel.
+# - A disconnect the bot didn't ask for (kicked or moved out by a moderator) is
+#   respected: the bot doesn't rejoin on its own.
+# - Queue items don't hold a voice client; playback resolves the guild's current
+#   one through get_voice_client(), so audio queued before a reconnect still plays.
+
+_get_guild = None # guild_id -> discord.Guild, set by init_voice_sessions
+pending_disconnects = {} # guild_id -> linger task
+reconnect_tasks = {} # guild_id -> reconnect task
+_intentional_disconnects = set() # Guild ids the bot is leaving on purpose
+
+# Handshake failures worth retrying; other ClientExceptions (e.g. already connected) are not
+RETRYABLE_CONNECT_ERRORS = (asyncio.TimeoutError, discord.errors.ConnectionClosed, OSError)
+
+
+def init_voice_sessions(get_guild):
+    """Sets the guild lookup used to resolve voice clients (e.g. bot.get_guild)."""
+    global _get_guild
+    _get_guild = get_guild
+
+
+def get_voice_client(guild_id: int):
+    """Returns the guild's current voice client, or None."""
+    guild = _get_guild(guild_id) if _get_guild else None
+    return guild.voice_client if guild else None
+
+
+async def wait_for_voice_client(guild_id: int, timeout: float):
+    """Returns the guild's connected voice client, waiting up to `timeout` seconds if it is reconnecting.
+
+    A voice client that is still present but not connected after `timeout` gets its session rebuilt.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        voice_client = get_voice_client(guild_id)
+        if voice_client and voice_client.is_connected():
+            return voice_client
+        if voice_client is None and guild_id not in reconnect_tasks:
+            return None # Not in a voice channel (left, or disconnected by someone)
+        if loop.time() >= deadline:
+            if voice_client is not None:
+                _start_reconnect(_get_guild(guild_id), voice_client.channel)
+            return None
+        await asyncio.sleep(0.1)
+
+
+def _has_listeners(channel) -> bool:
+    return any(not m.bot for m in channel.members)
+
+
+async def connect(channel):
+    """Connects to `channel`, retrying failed handshakes up to VOICE_RECONNECT_ATTEMPTS times."""
+    delay = 1.0
+    attempt = 0
+    while True:
+        try:
+            return await channel.connect()
+        except RETRYABLE_CONNECT_ERRORS as e:
+            attempt += 1
+            if attempt > config.VOICE_RECONNECT_ATTEMPTS:
+                raise
+            print(f"Voice connection to {channel.name} failed ({e!r}); retrying in {delay:.0f}s.")
+            stale = channel.guild.voice_client
+            if stale: # Half-open session from the failed handshake
+                _intentional_disconnects.add(channel.guild.id)
+                await stale.disconnect(force=True)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+
+def cancel_disconnect(guild_id: int):
+    """Keeps a lingering connection (someone joined again)."""
+    task = pending_disconnects.pop(guild_id, None)
+    if task:
+        task.cancel()
+        print(f"Listener returned; keeping voice connection for guild {guild_id}.")
+
+
+async def release(guild):
+    """Called when the last listener leaves: disconnects now, or after VOICE_LINGER_SECONDS."""
+    if config.VOICE_LINGER_SECONDS <= 0:
+        await disconnect(guild)
+        return
+    if guild.id not in pending_disconnects:
+        pending_disconnects[guild.id] = asyncio.create_task(_disconnect_after_linger(guild))
+
+
+async def _disconnect_after_linger(guild):
+    await asyncio.sleep(config.VOICE_LINGER_SECONDS)
+    pending_disconnects.pop(guild.id, None)
+    voice_client = guild.voice_client
+    if voice_client and voice_client.is_connected() and not _has_listeners(voice_client.channel):
+        print(f"No listeners in {voice_client.channel.name} for {config.VOICE_LINGER_SECONDS:.0f}s. Disconnecting bot.")
+        await disconnect(guild)
+
+
+def _cancel_reconnect(guild_id: int):
+    task = reconnect_tasks.pop(guild_id, None)
+    if task:
+        task.cancel()
+
+
+async def disconnect(guild, force: bool = False):
+    """Disconnects on purpose."""
+    cancel_disconnect(guild.id)
+    _cancel_reconnect(guild.id)
+    voice_client = guild.voice_client
+    if voice_client:
+        _intentional_disconnects.add(guild.id)
+        await voice_client.disconnect(force=force)
+
+
+def handle_bot_voice_state(guild, before, after):
+    """Tracks the bot's own voice state; a disconnect the bot didn't ask for is not undone."""
+    if after.channel:
+        _intentional_disconnects.discard(guild.id)
+        return
+    if not before.channel:
+        return
+    if guild.id in _intentional_disconnects:
+        _intentional_disconnects.discard(guild.id)
+        return
+    cancel_disconnect(guild.id)
+    _cancel_reconnect(guild.id)
+    print(f"Disconnected from {before.channel.name} ({guild.name}) by someone else; not rejoining.")
+
+
+def _start_reconnect(guild, channel):
+    if guild is None or guild.id in reconnect_tasks or config.VOICE_RECONNECT_ATTEMPTS <= 0:
+        return
+    if not _has_listeners(channel):
+        return
+    print(f"Voice connection to {channel.name} ({guild.name}) did not recover; reconnecting.")
+    reconnect_tasks[guild.id] = asyncio.create_task(_reconnect(guild, channel))
+
+
+async def _reconnect(guild, channel):
+    try:
+        voice_client = guild.voice_client
+        if voice_client and voice_client.is_connected():
+            return # discord.py recovered the session in the meantime
+        if voice_client: # Stale client from the dropped session
+            _intentional_disconnects.add(guild.id)
+            await voice_client.disconnect(force=True)
+        await connect(channel)
+        print(f"Reconnected to {channel.name} ({guild.name}).")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Giving up reconnecting to {channel.name} ({guild.name}): {e!r}")
+    finally:
+        if reconnect_tasks.get(guild.id) is asyncio.current_task():
+            del reconnect_tasks[guild.id]